@@ -1,22 +1,244 @@
 import base64
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import functools
+import io
+import itertools
 import json
 import logging
 import os
 import pathlib
+import random
+import re
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
 
 import boto3
+import botocore.config
+import urllib3
 
 # This library included as an example for how to get Boto3 autocomplete
-# in VSCode. Could be removed when creating your Production image for minor
-# storage saving.
-from mypy_boto3_secretsmanager import SecretsManagerClient
+# in VSCode. It is only imported by type checkers/editors (it isn't installed in the Lambda image - see
+# requirements-dev.txt), so it adds nothing to cold-start time. Type checkers treat TYPE_CHECKING as True;
+# defining it here rather than importing it from `typing` keeps that module off the cold-start path too.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from mypy_boto3_secretsmanager import SecretsManagerClient
 
 # Create logger. Set to DEBUG by default for testing. Change level via SSM Parameter.
 logger = logging.getLogger("lambda_tutorial")
 logger.setLevel(logging.DEBUG)
 
+# Per-stage latency metrics (see `stage_timer`), emitted in CloudWatch embedded metric format.
+#   - LAMBDA_TUTORIAL_METRICS: Set to 'false' to disable stage timing and metric output.
+#   - LAMBDA_TUTORIAL_METRICS_NAMESPACE: CloudWatch namespace the metrics are published under.
+METRICS_ENABLED = os.environ.get("LAMBDA_TUTORIAL_METRICS", "true").lower() == "true"
+METRICS_NAMESPACE = os.environ.get(
+    "LAMBDA_TUTORIAL_METRICS_NAMESPACE", "lambda_tutorial"
+)
+_metrics_state = {"cold_start": True}
+_metrics_local = threading.local()
+
+# Warm-container cache for the boto3 session and clients.
+# Lambda reuses the execution environment (and therefore anything held at module level) between invocations,
+# so the session and clients only need to be built on a cold start or when the assumed-role credentials
+# used during local testing are about to expire. Boto3 clients are thread-safe once created, but creating them
+# from a shared session is not, hence the lock.
+#   - LAMBDA_TUTORIAL_SESSION_REFRESH_MARGIN: Seconds before credential expiry at which the session is rebuilt.
+#   - LAMBDA_TUTORIAL_SKIP_IDENTITY_PROBE: Set to 'true' to skip the `get_caller_identity` call used for logging.
+SESSION_REFRESH_MARGIN = datetime.timedelta(
+    seconds=int(os.environ.get("LAMBDA_TUTORIAL_SESSION_REFRESH_MARGIN", "300"))
+)
+SKIP_IDENTITY_PROBE = (
+    os.environ.get("LAMBDA_TUTORIAL_SKIP_IDENTITY_PROBE", "false").lower() == "true"
+)
+_session_cache = {"session": None, "expiration": None, "clients": {}}
+_session_lock = threading.Lock()
+
+# Maximum number of records from a single event that are processed concurrently.
+MAX_RECORD_WORKERS = int(os.environ.get("LAMBDA_TUTORIAL_MAX_RECORD_WORKERS", "8"))
+
+# Run independent stages concurrently (secret retrieval alongside S3 transfers, individual SSM calls).
+CONCURRENT_STAGES = (
+    os.environ.get("LAMBDA_TUTORIAL_CONCURRENT_STAGES", "false").lower() == "true"
+)
+
+# Init-phase prewarming (see `prewarm`).
+#   - LAMBDA_TUTORIAL_PREWARM: Set to 'true' to build the session and retrieve parameters and the Tower PAT while
+#     the module is imported (Lambda's init phase) instead of during the first invocation.
+PREWARM = os.environ.get("LAMBDA_TUTORIAL_PREWARM", "false").lower() == "true"
+_prewarm_state = {"status": "disabled", "duration_ms": None}
+
+# In-process cache for SSM parameters (see `get_parameters`).
+#   - LAMBDA_TUTORIAL_PARAMETER_TTL: Seconds a retrieved parameter set is reused before SSM is queried again.
+#   - LAMBDA_TUTORIAL_SSM_BATCH_RETRIEVAL: Set to 'false' to fall back to one GetParameter call per parameter.
+PARAMETER_CACHE_TTL = int(os.environ.get("LAMBDA_TUTORIAL_PARAMETER_TTL", "300"))
+SSM_BATCH_RETRIEVAL = (
+    os.environ.get("LAMBDA_TUTORIAL_SSM_BATCH_RETRIEVAL", "true").lower() == "true"
+)
+_parameter_cache = {"values": {}, "fetched_at": None}
+_parameter_lock = threading.Lock()
+
+# Step-level retries (see `retry_step`). Transient failures of a single AWS or Tower call are retried in place
+# with full-jitter exponential backoff, rather than failing the record and having Lambda re-run everything.
+#   - LAMBDA_TUTORIAL_RETRY_MAX_ATTEMPTS: Attempts per call (including the first). `1` disables step retries.
+#   - LAMBDA_TUTORIAL_RETRY_BASE_DELAY: Seconds the backoff starts from (doubling per attempt).
+#   - LAMBDA_TUTORIAL_RETRY_MAX_DELAY: Upper bound (seconds) on a single backoff.
+#   - LAMBDA_TUTORIAL_RETRY_BUDGET: Seconds a call may spend retrying in total before giving up.
+RETRY_MAX_ATTEMPTS = int(os.environ.get("LAMBDA_TUTORIAL_RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.environ.get("LAMBDA_TUTORIAL_RETRY_BASE_DELAY", "0.2"))
+RETRY_MAX_DELAY = float(os.environ.get("LAMBDA_TUTORIAL_RETRY_MAX_DELAY", "5"))
+RETRY_BUDGET = float(os.environ.get("LAMBDA_TUTORIAL_RETRY_BUDGET", "20"))
+#   - LAMBDA_TUTORIAL_AWS_RETRY_MODE: botocore retry mode for AWS calls (`standard` or `adaptive`). AWS calls use
+#     botocore's own backoff and jitter, capped at RETRY_MAX_ATTEMPTS (see `get_client`).
+AWS_CLIENT_CONFIG = botocore.config.Config(
+    retries={
+        "mode": os.environ.get("LAMBDA_TUTORIAL_AWS_RETRY_MODE", "standard"),
+        "max_attempts": RETRY_MAX_ATTEMPTS,
+    }
+)
+
+# Tower circuit breaker (see `TowerCircuitBreaker`). Shared by every record and invocation in the container.
+#   - LAMBDA_TUTORIAL_BREAKER_WINDOW: Recent Tower calls the failure rate is measured over.
+#   - LAMBDA_TUTORIAL_BREAKER_MIN_CALLS: Calls needed in the window before the breaker can open.
+#   - LAMBDA_TUTORIAL_BREAKER_FAILURE_RATE: Fraction of transient failures at which the breaker opens.
+#   - LAMBDA_TUTORIAL_BREAKER_COOLDOWN: Seconds the breaker stays open before letting a trial call through.
+BREAKER_WINDOW = int(os.environ.get("LAMBDA_TUTORIAL_BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.environ.get("LAMBDA_TUTORIAL_BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATE = float(
+    os.environ.get("LAMBDA_TUTORIAL_BREAKER_FAILURE_RATE", "0.5")
+)
+BREAKER_COOLDOWN = float(os.environ.get("LAMBDA_TUTORIAL_BREAKER_COOLDOWN", "30"))
+# HTTP status in tw's error output, e.g. `[500]`, `HTTP 502`, `status: 429` or `code 503`. Only digits in one of
+# these forms count, so a number in a dataset or pipeline name (e.g. `run_500`) isn't read as a status.
+TW_ERROR_STATUS = re.compile(
+    r"(?:\bhttp(?:/[\d.]+)?|\bstatus(?:\s+code)?|\bcode)\W{0,3}([1-5]\d\d)\b|\[([1-5]\d\d)\]",
+    re.IGNORECASE,
+)
+
+# Pooled HTTP client for the Tower API (used when the `tower_client` SSM parameter is set to `api`).
+#   - LAMBDA_TUTORIAL_TOWER_POOL_SIZE: Connections kept alive per Tower host.
+#   - LAMBDA_TUTORIAL_TOWER_TIMEOUT: Read timeout (seconds) for Tower API calls.
+TOWER_API_POOL_SIZE = int(os.environ.get("LAMBDA_TUTORIAL_TOWER_POOL_SIZE", "10"))
+TOWER_API_TIMEOUT = float(os.environ.get("LAMBDA_TUTORIAL_TOWER_TIMEOUT", "30"))
+_tower_http = {"pool": None}
+_tower_http_lock = threading.Lock()
+
+# In-container index of Tower names to IDs (see `resolve_dataset_id` and `resolve_pipeline_id`), so warm
+# invocations don't look up the same dataset or pipeline again.
+#   - LAMBDA_TUTORIAL_TOWER_INDEX_TTL: Seconds an indexed name is trusted before it is looked up again.
+TOWER_INDEX_TTL = int(os.environ.get("LAMBDA_TUTORIAL_TOWER_INDEX_TTL", "3600"))
+# Datasets requested per page when the workspace is searched for an existing dataset's ID.
+TOWER_LIST_PAGE_SIZE = 100
+_tower_index = {"datasets": {}, "pipelines": {}}
+_tower_index_lock = threading.Lock()
+
+# Streaming samplesheet transfer (used when the `samplesheet_transfer_mode` SSM parameter is set to `stream`).
+#   - LAMBDA_TUTORIAL_STREAM_CHUNK_SIZE: Bytes read from S3 (and sent to Tower) at a time.
+#   - LAMBDA_TUTORIAL_STREAM_IN_MEMORY_THRESHOLD: Objects up to this many bytes are read in a single call.
+STREAM_CHUNK_SIZE = int(os.environ.get("LAMBDA_TUTORIAL_STREAM_CHUNK_SIZE", "1048576"))
+STREAM_IN_MEMORY_THRESHOLD = int(
+    os.environ.get("LAMBDA_TUTORIAL_STREAM_IN_MEMORY_THRESHOLD", "8388608")
+)
+
+# Compressed samplesheets (see `DecompressedBody`). Keys ending in one of these suffixes (e.g. `run.csv.gz`) are
+# decompressed as they are read, and the inner filename (`run.csv`) determines the dataset name and file type.
+# Add the compressed file types (e.g. `csv.gz,tsv.zst`) to `samplesheet_file_types` to accept them.
+SAMPLESHEET_COMPRESSION = {"gz": "gzip", "zst": "zstd"}
+
+# Local workspace for every file written to /tmp (see `Workspace`).
+#   - LAMBDA_TUTORIAL_WORKSPACE_DIR: Directory the workspace lives in. Each process works in a directory of its
+#     own under it, so processes sharing it (e.g. several workers on one host) never touch each other's files.
+#     Directories left by processes that are no longer running are removed when a process starts using it.
+#   - LAMBDA_TUTORIAL_WORKSPACE_MAX_BYTES: Bytes of downloaded samplesheets kept between invocations, keyed by
+#     S3 ETag. The least recently used are evicted first. `0` disables the cache.
+WORKSPACE_DIR = os.environ.get("LAMBDA_TUTORIAL_WORKSPACE_DIR", "/tmp/workspace")
+WORKSPACE_MAX_BYTES = int(
+    os.environ.get("LAMBDA_TUTORIAL_WORKSPACE_MAX_BYTES", "268435456")
+)
+
+# Bulk backfill over an existing S3 prefix (see `backfill`).
+#   - LAMBDA_TUTORIAL_BACKFILL_WORKERS: Objects processed concurrently.
+#   - LAMBDA_TUTORIAL_BACKFILL_TOWER_RATE: Tower calls per second allowed across all workers. `0` disables the limit.
+#   - LAMBDA_TUTORIAL_BACKFILL_TOWER_BURST: Tower calls allowed back-to-back before the rate applies.
+#   - LAMBDA_TUTORIAL_BACKFILL_CHECKPOINT_INTERVAL: Seconds between checkpoint saves (and progress logs).
+#   - LAMBDA_TUTORIAL_BACKFILL_TIME_MARGIN: Seconds before the Lambda timeout at which `backfill_handler` stops.
+BACKFILL_WORKERS = int(os.environ.get("LAMBDA_TUTORIAL_BACKFILL_WORKERS", "8"))
+BACKFILL_TOWER_RATE = float(os.environ.get("LAMBDA_TUTORIAL_BACKFILL_TOWER_RATE", "5"))
+BACKFILL_TOWER_BURST = int(os.environ.get("LAMBDA_TUTORIAL_BACKFILL_TOWER_BURST", "10"))
+BACKFILL_CHECKPOINT_INTERVAL = float(
+    os.environ.get("LAMBDA_TUTORIAL_BACKFILL_CHECKPOINT_INTERVAL", "10")
+)
+BACKFILL_TIME_MARGIN = float(
+    os.environ.get("LAMBDA_TUTORIAL_BACKFILL_TIME_MARGIN", "60")
+)
+# Token bucket applied to every Tower call while it is set (see `acquire_tower_token`).
+_tower_rate_limit = {"bucket": None}
+
+# Long-running worker outside Lambda (see `worker`, started with `python app.py worker --source ...`).
+#   - LAMBDA_TUTORIAL_WORKER_CONCURRENCY: Batches processed at the same time.
+#   - LAMBDA_TUTORIAL_WORKER_BATCH_SIZE: Messages (or spool files) per batch. SQS returns at most 10.
+#   - LAMBDA_TUTORIAL_WORKER_POLL_SECONDS: Seconds a receive waits for work (SQS long polling / spool polling).
+#   - LAMBDA_TUTORIAL_WORKER_PORT: Port serving `/health` and `/metrics`. `0` disables the endpoint.
+#   - LAMBDA_TUTORIAL_WORKER_VISIBILITY_TIMEOUT: Seconds an SQS message stays hidden after it is received. It is
+#     extended by as much every third of that while its batch runs, so a long batch isn't redelivered mid-way.
+WORKER_CONCURRENCY = int(os.environ.get("LAMBDA_TUTORIAL_WORKER_CONCURRENCY", "4"))
+WORKER_BATCH_SIZE = int(os.environ.get("LAMBDA_TUTORIAL_WORKER_BATCH_SIZE", "10"))
+WORKER_POLL_SECONDS = int(os.environ.get("LAMBDA_TUTORIAL_WORKER_POLL_SECONDS", "10"))
+WORKER_PORT = int(os.environ.get("LAMBDA_TUTORIAL_WORKER_PORT", "8080"))
+WORKER_VISIBILITY_TIMEOUT = int(
+    os.environ.get("LAMBDA_TUTORIAL_WORKER_VISIBILITY_TIMEOUT", "120")
+)
+_worker_state = {"status": "stopped"}
+_worker_lock = threading.Lock()
+
+# Compiled prefix/file-type routing table (see `get_routing_table`).
+_routing_cache = {"source": None, "table": None}
+_routing_lock = threading.Lock()
+
+# Compiled per-pipeline samplesheet schemas (see `get_samplesheet_schema`).
+#   - LAMBDA_TUTORIAL_VALIDATION_MAX_ERRORS: Row-level errors kept in a failed record's result. All are counted.
+VALIDATION_MAX_ERRORS = int(
+    os.environ.get("LAMBDA_TUTORIAL_VALIDATION_MAX_ERRORS", "50")
+)
+# Rows `validate_samplesheet` reads and checks at a time.
+VALIDATION_BLOCK_ROWS = 4096
+_schema_cache = {"source": None, "schemas": None}
+_schema_lock = threading.Lock()
+
+# Idempotency store (configured by the `idempotency_store` SSM parameter - see `get_idempotency_store`).
+#   - LAMBDA_TUTORIAL_IDEMPOTENCY_RETENTION: Seconds before DynamoDB records expire (via the table's TTL).
+#   - LAMBDA_TUTORIAL_IDEMPOTENCY_CLAIM_MARGIN: Seconds a Lambda invocation's claims outlive its timeout (see
+#     `get_claim_expiry`). A claim left behind by an invocation that was killed can only be taken over once it expires.
+#   - LAMBDA_TUTORIAL_IDEMPOTENCY_CLAIM_TTL: Seconds a claim lasts when there is no invocation deadline (worker,
+#     local runs).
+IDEMPOTENCY_STAGES = ["dataset_created", "dataset_url", "pipeline_launched"]
+IDEMPOTENCY_RETENTION = int(
+    os.environ.get("LAMBDA_TUTORIAL_IDEMPOTENCY_RETENTION", str(30 * 24 * 3600))
+)
+IDEMPOTENCY_CLAIM_MARGIN = int(
+    os.environ.get("LAMBDA_TUTORIAL_IDEMPOTENCY_CLAIM_MARGIN", "10")
+)
+IDEMPOTENCY_CLAIM_TTL = int(
+    os.environ.get("LAMBDA_TUTORIAL_IDEMPOTENCY_CLAIM_TTL", "900")
+)
+_idempotency_store = {"spec": None, "store": None}
+_idempotency_lock = threading.Lock()
+
+# In-process cache for the Tower PAT (see `get_secrets`).
+#   - LAMBDA_TUTORIAL_SECRET_TTL: Seconds the cached PAT is used before checking whether the secret was rotated.
+SECRET_CACHE_TTL = int(os.environ.get("LAMBDA_TUTORIAL_SECRET_TTL", "300"))
+_secret_cache = {"values": None, "version_id": None, "checked_at": None}
+_secret_lock = threading.Lock()
+
 
 # Custom error defintion to use when we need to stop mid-function and NOT retry.
 # The `handler` function exception block looks for this error and returns, meaning native Lambda
@@ -25,6 +247,160 @@ class CeaseEventProcessing(Exception):
     pass
 
 
+# Raised (instead of a plain CeaseEventProcessing) when Tower rejects a name that is already taken, so that
+# `create_tower_dataset` can add a version to the existing dataset. Any other caller treats it as a cease.
+class TowerNameConflict(CeaseEventProcessing):
+    pass
+
+
+def start_invocation_metrics(context=None):
+    """
+    Create the metrics collector for an invocation and bind it to the current thread.
+    The first invocation in a container is flagged as a cold start.
+    """
+    collector = {
+        "cold_start": _metrics_state["cold_start"],
+        "request_id": getattr(context, "aws_request_id", None),
+        "started": time.perf_counter(),
+        "spans": [],
+        "lock": threading.Lock(),
+    }
+    _metrics_state["cold_start"] = False
+    _metrics_local.collector = collector
+    _metrics_local.spans = []
+
+    return collector
+
+
+def bind_invocation_metrics(collector=None, function=None):
+    """
+    Wrap a function submitted to a thread pool so spans recorded on the worker thread are
+    attributed to the invocation's collector.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        _metrics_local.collector = collector
+        _metrics_local.spans = []
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _metrics_local.collector = None
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def stage_timer(stage=None, **fields):
+    """
+    Time a block of work as a named stage. Extra fields (e.g. `bytes_downloaded`, `tw_return_code`) can be
+    passed in or added to the yielded span, or added from deeper in the call stack with `annotate_stage`.
+    Spans are only kept if a collector is bound to the current thread.
+    """
+    collector = getattr(_metrics_local, "collector", None)
+    if not METRICS_ENABLED or collector is None:
+        yield {}
+        return
+
+    span = {"stage": stage, **fields}
+    _metrics_local.spans.append(span)
+    start = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        _metrics_local.spans.pop()
+        with collector["lock"]:
+            collector["spans"].append(span)
+
+
+def timed_stage(stage=None):
+    """
+    Decorator form of `stage_timer`.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage=stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def annotate_stage(**fields):
+    """
+    Add fields to the innermost stage currently being timed on this thread.
+    """
+    spans = getattr(_metrics_local, "spans", None)
+    if spans:
+        spans[-1].update(fields)
+
+
+def finish_invocation_metrics(collector=None):
+    """
+    Emit one CloudWatch embedded metric format (EMF) line per stage and return a per-invocation summary.
+    Lines are written to stdout in a single call, which Lambda forwards to CloudWatch Logs where the
+    `Duration` and `BytesDownloaded` metrics are extracted with `Stage` and `ColdStart` as dimensions.
+    """
+    _metrics_local.collector = None
+    if not METRICS_ENABLED:
+        return {}
+
+    total_ms = round((time.perf_counter() - collector["started"]) * 1000, 3)
+    timestamp = int(time.time() * 1000)
+    cold_start = collector["cold_start"]
+
+    lines = []
+    stages = {}
+    for span in collector["spans"]:
+        metric_definitions = [{"Name": "Duration", "Unit": "Milliseconds"}]
+        entry = {
+            "_aws": {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": METRICS_NAMESPACE,
+                        "Dimensions": [["Stage", "ColdStart"]],
+                        "Metrics": metric_definitions,
+                    }
+                ],
+            },
+            "Stage": span["stage"],
+            "ColdStart": str(cold_start).lower(),
+            "Duration": span["duration_ms"],
+        }
+        if "bytes_downloaded" in span:
+            metric_definitions.append({"Name": "BytesDownloaded", "Unit": "Bytes"})
+            entry["BytesDownloaded"] = span["bytes_downloaded"]
+        if "tw_return_code" in span:
+            entry["TwReturnCode"] = span["tw_return_code"]
+        if "cache_hit" in span:
+            entry["CacheHit"] = span["cache_hit"]
+        if collector["request_id"]:
+            entry["RequestId"] = collector["request_id"]
+        lines.append(json.dumps(entry))
+
+        summary = stages.setdefault(
+            span["stage"], {"count": 0, "total_ms": 0.0, "max_ms": 0.0}
+        )
+        summary["count"] += 1
+        summary["total_ms"] = round(summary["total_ms"] + span["duration_ms"], 3)
+        summary["max_ms"] = max(summary["max_ms"], span["duration_ms"])
+
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+    summary = {"cold_start": cold_start, "duration_ms": total_ms, "stages": stages}
+    if cold_start and PREWARM:
+        summary["prewarm"] = dict(_prewarm_state)
+
+    return summary
+
+
 def generate_session(execution_role=None):
     """
     The Lambda function needs to be able to access other AWS service like Secrets Manager
@@ -42,6 +418,9 @@ def generate_session(execution_role=None):
 
     When the function is first invoked, check for the presence of the mounted credentials file.
     If the file is present, we know its a local run. If not, the function is being executed in AWS.
+
+    Returns the session and the expiry time of its credentials. Expiry is None when running in Lambda
+    since the platform manages the execution role credentials for the lifetime of the container.
     """
     # Check if the .aws file is mounted into the container.
     mounted_credentials_file = pathlib.Path("/root/.aws/credentials")
@@ -54,6 +433,7 @@ def generate_session(execution_role=None):
 
     # Create Session
     session = boto3.Session()
+    expiration = None
 
     if credentials_present:
         # Assume the execution Role
@@ -86,6 +466,7 @@ def generate_session(execution_role=None):
                 aws_secret_access_key=credentials["SecretAccessKey"],
                 aws_session_token=credentials["SessionToken"],
             )
+            expiration = credentials["Expiration"]
 
         except KeyError as e:
             # Transaction may have failed due to networking. Retryable.
@@ -95,16 +476,75 @@ def generate_session(execution_role=None):
                 retry_transaction=True,
             )
 
-    return session
+    return session, expiration
+
+
+@timed_stage(stage="get_session")
+def get_session(execution_role=None):
+    """
+    Return the cached session, generating a new one on a cold start or when the assumed-role
+    credentials are within SESSION_REFRESH_MARGIN of expiring. Clients created from the previous
+    session are discarded alongside it.
+
+    Returns the session and a flag indicating whether it was newly generated.
+    """
+    with _session_lock:
+        session = _session_cache["session"]
+        expiration = _session_cache["expiration"]
+
+        if session is not None:
+            if expiration is None:
+                return session, False
+
+            now = datetime.datetime.now(tz=expiration.tzinfo)
+            if expiration - now > SESSION_REFRESH_MARGIN:
+                return session, False
+
+            logger.debug(f"Session credentials expire at {expiration}. Refreshing.")
+
+        session, expiration = generate_session(execution_role=execution_role)
+        _session_cache["session"] = session
+        _session_cache["expiration"] = expiration
+        _session_cache["clients"] = {}
+
+    return session, True
+
+
+def get_client(session=None, service_name=None):
+    """
+    Return a boto3 client for the named service, reusing the one cached for the current session if it exists.
+    Clients retry throttling and transient errors themselves (see AWS_CLIENT_CONFIG).
+    """
+    with _session_lock:
+        clients = _session_cache["clients"]
+        if session is not _session_cache["session"]:
+            # Session was not produced by `get_session` (e.g. created ad hoc). Don't pollute the cache.
+            return session.client(service_name, config=AWS_CLIENT_CONFIG)
+
+        if service_name not in clients:
+            clients[service_name] = session.client(
+                service_name, config=AWS_CLIENT_CONFIG
+            )
+
+        return clients[service_name]
 
 
-def get_parameters(session=None, params_to_retrieve=None):
+@timed_stage(stage="get_parameters")
+def get_parameters(session=None, params_to_retrieve=None, optional_params=None):
     """
     Pipeline-related values like workspace ID and pipeline name need to be available so that the
     tower cli creates a Dataset in the right Workspace and invokes the correct pipeline.
     Externalize these in AWS SSM so they can be changed without requiring modification of the
     underlying image or Lambda function code.
 
+    Values are held in an in-process cache for PARAMETER_CACHE_TTL seconds, so warm invocations make no
+    SSM calls until the TTL expires. When a refresh is required, values are retrieved in batches of up
+    to 10 names per GetParameters call (unless SSM_BATCH_RETRIEVAL is switched off, in which case the
+    original one-call-per-parameter behaviour is used).
+
+    `optional_params` maps parameter names to the default value used when the parameter doesn't exist
+    in SSM. This allows new settings to be introduced without breaking existing deployments.
+
     Example: {'Parameter':
         {'Name': '/lambda_tutorial/workspace_id',
         'Type': 'String',
@@ -112,33 +552,154 @@ def get_parameters(session=None, params_to_retrieve=None):
         'Version': 3,
         ...
     """
-    tw_params = {}
-    ssm_client = session.client("ssm")
+    optional_params = optional_params or {}
+    params_to_retrieve = list(params_to_retrieve) + [
+        param for param in optional_params if param not in params_to_retrieve
+    ]
 
-    for param in params_to_retrieve:
-        try:
-            # My SSM keys aren't KMS encrypted, so we can treat them as strings.
-            response = ssm_client.get_parameter(Name=param, WithDecryption=False)
-            tw_params[param] = response["Parameter"]["Value"]
-            logger.debug(tw_params[param])
+    with _parameter_lock:
+        fetched_at = _parameter_cache["fetched_at"]
+        cached_values = _parameter_cache["values"]
+        cache_is_fresh = (
+            fetched_at is not None
+            and time.monotonic() - fetched_at < PARAMETER_CACHE_TTL
+            and all(param in cached_values for param in params_to_retrieve)
+        )
+
+        if cache_is_fresh:
+            logger.debug("Using cached SSM parameters.")
+            return {param: cached_values[param] for param in params_to_retrieve}
+
+        ssm_client = get_client(session=session, service_name="ssm")
+        if SSM_BATCH_RETRIEVAL:
+            tw_params = get_parameters_batched(
+                ssm_client=ssm_client,
+                params_to_retrieve=params_to_retrieve,
+                optional_params=optional_params,
+            )
+        else:
+            tw_params = get_parameters_individually(
+                ssm_client=ssm_client,
+                params_to_retrieve=params_to_retrieve,
+                optional_params=optional_params,
+            )
 
-            # Update logging_level based on logging_level key.
-            if param == "/lambda_tutorial/logging_level":
-                desired_level = tw_params[param]
+        # Apply the logging_level side effect before anything else is logged, and again whenever a
+        # refreshed value differs from the one currently in effect.
+        logging_level_param = "/lambda_tutorial/logging_level"
+        if logging_level_param in tw_params:
+            previous_level = cached_values.get(logging_level_param)
+            desired_level = tw_params[logging_level_param]
+            if previous_level is None:
                 if desired_level.upper() != "DEBUG":
                     update_logging_level(desired_level=desired_level)
+            elif previous_level.upper() != desired_level.upper():
+                update_logging_level(desired_level=desired_level)
+
+        for param, value in tw_params.items():
+            logger.debug(f"{param}: {value}")
+
+        _parameter_cache["values"] = {**cached_values, **tw_params}
+        _parameter_cache["fetched_at"] = time.monotonic()
+
+    return tw_params
+
 
+def get_parameters_batched(
+    ssm_client=None, params_to_retrieve=None, optional_params=None
+):
+    """
+    Retrieve parameters with GetParameters. The API accepts a maximum of 10 names per call.
+    Names SSM can't find are returned in `InvalidParameters` rather than raising ParameterNotFound.
+    """
+    tw_params = {}
+    batch_size = 10
+
+    for i in range(0, len(params_to_retrieve), batch_size):
+        batch = params_to_retrieve[i : i + batch_size]
+        try:
+            # My SSM keys aren't KMS encrypted, so we can treat them as strings.
+            response = ssm_client.get_parameters(Names=batch, WithDecryption=False)
             logger.debug(response)
+        except Exception as e:
+            # Transaction may have failed due to networking or throttling. Retryable.
+            log_error_and_raise_exception(
+                errorstring=f"Failed to retrieve parameters {batch}",
+                e=e,
+                retry_transaction=True,
+            )
 
-        except ssm_client.exceptions.ParameterNotFound as e:
+        # The botocore model gives the list a minimum length of 1, so it may be absent rather than empty.
+        invalid_params = response.get("InvalidParameters", [])
+        missing = [param for param in invalid_params if param not in optional_params]
+        if missing:
             # Transaction may have failed due to networking. Retryable.
             log_error_and_raise_exception(
-                errorstring=f"Parameter {param} not found", e=e, retry_transaction=True
+                errorstring=f"Parameters {missing} not found",
+                e=None,
+                retry_transaction=True,
             )
 
+        for param in invalid_params:
+            tw_params[param] = optional_params[param]
+
+        for parameter in response["Parameters"]:
+            tw_params[parameter["Name"]] = parameter["Value"]
+
     return tw_params
 
 
+def get_parameters_individually(
+    ssm_client=None, params_to_retrieve=None, optional_params=None
+):
+    """
+    Retrieve parameters with one GetParameter call each (original behaviour).
+    The calls are independent of each other, so they're made concurrently when CONCURRENT_STAGES is set.
+    """
+    if CONCURRENT_STAGES:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(params_to_retrieve)
+        ) as executor:
+            futures = {
+                param: executor.submit(
+                    get_parameter_value,
+                    ssm_client=ssm_client,
+                    param=param,
+                    optional_params=optional_params,
+                )
+                for param in params_to_retrieve
+            }
+            return {param: future.result() for param, future in futures.items()}
+
+    return {
+        param: get_parameter_value(
+            ssm_client=ssm_client, param=param, optional_params=optional_params
+        )
+        for param in params_to_retrieve
+    }
+
+
+def get_parameter_value(ssm_client=None, param=None, optional_params=None):
+    """
+    Retrieve a single parameter's value, falling back to its default if it is optional and doesn't exist.
+    """
+    try:
+        # My SSM keys aren't KMS encrypted, so we can treat them as strings.
+        response = ssm_client.get_parameter(Name=param, WithDecryption=False)
+        logger.debug(response)
+        return response["Parameter"]["Value"]
+
+    except ssm_client.exceptions.ParameterNotFound as e:
+        if param in optional_params:
+            return optional_params[param]
+
+        # Transaction may have failed due to networking. Retryable.
+        log_error_and_raise_exception(
+            errorstring=f"Parameter {param} not found", e=e, retry_transaction=True
+        )
+
+
+@timed_stage(stage="get_secrets")
 def get_secrets(session=None):
     """
     Need to protect the Tower PAT more securely. Could use SSM with KMS, but I'm using Secrets Manager
@@ -149,10 +710,47 @@ def get_secrets(session=None):
         'Name': 'lambda_tutorial/tower_PAT',
         'SecretString': 'eyJ0.....',
        ...
+
+    The PAT is cached in-process. Once SECRET_CACHE_TTL seconds have passed, a DescribeSecret call checks
+    which version currently holds the AWSCURRENT stage. The value is only retrieved again if that version has
+    changed (i.e. the secret was rotated) or if the check fails. When Tower rejects the cached token,
+    `invalidate_secrets_cache` discards it, so the retried event retrieves it again.
     """
-    tw_secrets = {}
     secret_name = "lambda_tutorial/tower_PAT"
-    secrets_client: SecretsManagerClient = session.client("secretsmanager")
+    secrets_client: "SecretsManagerClient" = get_client(
+        session=session, service_name="secretsmanager"
+    )
+
+    with _secret_lock:
+        cached_secrets = _secret_cache["values"]
+        checked_at = _secret_cache["checked_at"]
+
+        if cached_secrets is not None:
+            if time.monotonic() - checked_at < SECRET_CACHE_TTL:
+                logger.debug("Using cached secrets.")
+                return dict(cached_secrets)
+
+            current_version = get_current_secret_version(
+                secrets_client=secrets_client, secret_name=secret_name
+            )
+            if (
+                current_version is not None
+                and current_version == _secret_cache["version_id"]
+            ):
+                logger.debug(
+                    f"Secret version {current_version} unchanged. Using cached secrets."
+                )
+                _secret_cache["checked_at"] = time.monotonic()
+                return dict(cached_secrets)
+
+        return fetch_secrets(secrets_client=secrets_client, secret_name=secret_name)
+
+
+def fetch_secrets(secrets_client=None, secret_name=None):
+    """
+    Retrieve the secret value from Secrets Manager and store it in the cache. Caller must hold `_secret_lock`.
+    """
+    tw_secrets = {}
 
     try:
         get_secret_value_response = secrets_client.get_secret_value(
@@ -196,20 +794,65 @@ def get_secrets(session=None):
                 get_secret_value_response["SecretBinary"]
             )
 
+        _secret_cache["values"] = dict(tw_secrets)
+        _secret_cache["version_id"] = get_secret_value_response.get("VersionId")
+        _secret_cache["checked_at"] = time.monotonic()
+
     return tw_secrets
 
 
+def get_current_secret_version(secrets_client=None, secret_name=None):
+    """
+    Return the ID of the secret version currently labelled AWSCURRENT, or None if it can't be determined.
+    Failure here isn't fatal: the caller falls back to retrieving the secret value.
+
+    Example: {'VersionIdsToStages':
+        {'a1b2c3d4-...': ['AWSCURRENT'],
+        'e5f6a7b8-...': ['AWSPREVIOUS']},
+        ...
+    """
+    try:
+        response = secrets_client.describe_secret(SecretId=secret_name)
+    except Exception as e:
+        logger.debug(f"Could not describe secret {secret_name}. Refetching value. {e}")
+        return None
+
+    for version_id, stages in response.get("VersionIdsToStages", {}).items():
+        if "AWSCURRENT" in stages:
+            return version_id
+
+    return None
+
+
+def invalidate_secrets_cache():
+    """
+    Discard the cached Tower PAT so the next `get_secrets` call retrieves it from Secrets Manager.
+    Called when Tower rejects the token, since that usually means the secret was rotated.
+    """
+    with _secret_lock:
+        _secret_cache["values"] = None
+        _secret_cache["version_id"] = None
+        _secret_cache["checked_at"] = None
+
+
 def set_environment_variables(tw_params=None, tw_secrets=None):
     """
     Define TOWER_ACCESS_TOKEN and TOWER_API_ENDPOINT environment variables for use
     by the tw cli.
     Set this before running tw transactions.
+    Values are only rewritten when they've changed (e.g. after a PAT rotation) since secrets and
+    parameters are usually served from cache on warm containers.
     """
-    os.environ["TOWER_ACCESS_TOKEN"] = tw_secrets["tower_PAT"]
-    os.environ["TOWER_API_ENDPOINT"] = tw_params["/lambda_tutorial/tower_api_endpoint"]
+    tower_environment = {
+        "TOWER_ACCESS_TOKEN": tw_secrets["tower_PAT"],
+        "TOWER_API_ENDPOINT": tw_params["/lambda_tutorial/tower_api_endpoint"],
+    }
+    for name, value in tower_environment.items():
+        if os.environ.get(name) != value:
+            os.environ[name] = value
 
 
-def check_if_event_in_scope(event=None, tw_params=None):
+def check_if_event_in_scope(record=None, tw_params=None):
     """
     Check if event is for a file that must be convert to a Dataset.
     Notes:
@@ -218,14 +861,19 @@ def check_if_event_in_scope(event=None, tw_params=None):
             so we add this back in since the split function removes it
     Example of object key:
         "lambda_tutorial/samplesheet_full.csv"
+    Operates on a single entry from the event's `Records` list.
+
+    Keys are matched against the compiled routing table (see `get_routing_table`). Returns a copy of
+    `tw_params` with the matched route's workspace ID and target pipeline name applied.
     """
     # Check if event should be processed or ignored. Cease processing if:
     #   1) Notification isn't from designated prefix.
     #   2) Notification doesn't match file type trigger.
-    event_key = event["Records"][0]["s3"]["object"]["key"]
-    filetype = event_key.rsplit(".", 1)[1]
+    event_key = record["s3"]["object"]["key"]
+    routing_table = get_routing_table(tw_params=tw_params)
+    prefix_routes, route = match_route(routing_table=routing_table, key=event_key)
 
-    if not event_key.startswith(tw_params["/lambda_tutorial/s3_root_prefix"]):
+    if not prefix_routes:
         # Event is out of scope and should not be retried.
         log_error_and_raise_exception(
             errorstring=f"Event key: {event_key} does not match designated prefix. Cease processing.",
@@ -233,7 +881,7 @@ def check_if_event_in_scope(event=None, tw_params=None):
             retry_transaction=False,
         )
 
-    if filetype not in tw_params["/lambda_tutorial/samplesheet_file_types"].split(","):
+    if route is None:
         # Event is out of scope and should not be retried.
         log_error_and_raise_exception(
             errorstring=f"Event key: {event_key} not a trigger file type. Cease processing.",
@@ -241,294 +889,3984 @@ def check_if_event_in_scope(event=None, tw_params=None):
             retry_transaction=False,
         )
 
+    logger.debug(f"Event key: {event_key} matched route {route}")
+    record_params = dict(tw_params)
+    record_params["/lambda_tutorial/workspace_id"] = route["workspace_id"]
+    record_params["/lambda_tutorial/target_pipeline_name"] = route[
+        "target_pipeline_name"
+    ]
+
+    return record_params
 
-def download_samplesheet(session=None, event=None):
+
+def get_routing_table(tw_params=None):
     """
-    Download the S3 file to a local directory.
-    Return two paths:
-        1) Absolute path to the local file;
-        2) Filename without extension (to use as the dataset name)
+    Return the compiled routing table, compiling it only when its source values change (i.e. once per
+    container in practice).
+
+    Routes come from the `routing_table` SSM parameter, a JSON document such as:
+        {"routes": [
+            {"prefix": "lambda_tutorial/", "file_types": ["csv", "tsv"],
+             "workspace_id": "34830707738561", "target_pipeline_name": "nf-core-rnaseq"},
+            ...
+        ]}
+    `workspace_id` and `target_pipeline_name` default to the standalone SSM parameters if omitted.
+    If the parameter is empty, a single route is built from `s3_root_prefix` and `samplesheet_file_types`.
     """
-    s3_client = session.client("s3")
+    source = (
+        tw_params.get("/lambda_tutorial/routing_table", ""),
+        tw_params["/lambda_tutorial/s3_root_prefix"],
+        tw_params["/lambda_tutorial/samplesheet_file_types"],
+        tw_params["/lambda_tutorial/workspace_id"],
+        tw_params["/lambda_tutorial/target_pipeline_name"],
+    )
 
-    try:
-        s3bucket = event["Records"][0]["s3"]["bucket"]["name"]
-        s3key = event["Records"][0]["s3"]["object"]["key"]
-        # Example of key: "lambda_tutorial/complete.txt"
-        samplesheet_filename = s3key.rsplit("/", maxsplit=1)[1]
-        dataset_name = samplesheet_filename.split(".")[0]
+    with _routing_lock:
+        if _routing_cache["source"] != source:
+            _routing_cache["table"] = compile_routing_table(tw_params=tw_params)
+            _routing_cache["source"] = source
 
-    except Exception as e:
-        # Failure to extract and parse data will not change if retried. Do not retry.
-        log_error_and_raise_exception(
-            errorstring=f"Failed to prepare file details for download",
-            e=e,
-            retry_transaction=False,
-        )
+        return _routing_cache["table"]
+
+
+def compile_routing_table(tw_params=None):
+    """
+    Compile routes into:
+        1) A character trie over prefixes. Each node lists the routes whose prefix ends there.
+        2) A suffix map from file type (e.g. 'csv' or 'csv.gz') to the set of routes accepting it.
+    Together these let `match_route` resolve a key in a single pass over its characters.
+    """
+    routing_document = tw_params.get("/lambda_tutorial/routing_table", "").strip()
 
     try:
-        # Make local directory and download file:
-        p = pathlib.Path("/tmp/s3files/")
-        p.mkdir(parents=True, exist_ok=True)
+        if routing_document:
+            routes = json.loads(routing_document)["routes"]
+        else:
+            routes = [
+                {
+                    "prefix": tw_params["/lambda_tutorial/s3_root_prefix"],
+                    "file_types": tw_params["/lambda_tutorial/samplesheet_file_types"],
+                }
+            ]
 
-        p_posix = p.as_posix()
-        local_samplesheet = f"{p_posix}/{samplesheet_filename}"
+        trie = {"children": {}, "routes": []}
+        suffixes = {}
+        compiled_routes = []
 
-        s3_client.download_file(s3bucket, s3key, local_samplesheet)
-        logger.debug(f"File downloaded locally: {os.listdir(p_posix)}")
+        for index, route in enumerate(routes):
+            file_types = route["file_types"]
+            if isinstance(file_types, str):
+                file_types = file_types.split(",")
+            file_types = [ft.strip().lstrip(".") for ft in file_types if ft.strip()]
+
+            compiled_routes.append(
+                {
+                    "prefix": route["prefix"],
+                    "file_types": file_types,
+                    "workspace_id": route.get(
+                        "workspace_id", tw_params["/lambda_tutorial/workspace_id"]
+                    ),
+                    "target_pipeline_name": route.get(
+                        "target_pipeline_name",
+                        tw_params["/lambda_tutorial/target_pipeline_name"],
+                    ),
+                }
+            )
+
+            node = trie
+            for char in route["prefix"]:
+                node = node["children"].setdefault(char, {"children": {}, "routes": []})
+            node["routes"].append(index)
+
+            for file_type in file_types:
+                suffixes.setdefault(file_type, set()).add(index)
 
     except Exception as e:
-        # Transaction may have failed due to networking. Retryable.
+        # A malformed routing table will not fix itself on retry. Do not retry.
         log_error_and_raise_exception(
-            errorstring="Failed to create temporary folder or download S3 file.",
-            e=e,
-            retry_transaction=True,
+            errorstring="Failed to compile routing table.", e=e, retry_transaction=False
         )
 
-    return local_samplesheet, dataset_name
+    logger.debug(f"Compiled {len(compiled_routes)} route(s).")
+    return {"trie": trie, "suffixes": suffixes, "routes": compiled_routes}
 
 
-def create_tower_dataset(
-    local_samplesheet=None, dataset_name=None, event=None, tw_params=None
-):
+def get_file_type_candidates(key=None):
     """
-    Use the tw cli to create a dataset in Tower.
-    Assumption: Header is always present.
+    Return every multi-dot suffix of the key's filename, longest first.
+    Example: 'lambda_tutorial/run.1.csv.gz' -> ['1.csv.gz', 'csv.gz', 'gz']
     """
-    s3bucket = event["Records"][0]["s3"]["bucket"]["name"]
-    s3key = event["Records"][0]["s3"]["object"]["key"]
-    s3source = f"s3://{s3bucket}/{s3key}"
+    filename = key.rsplit("/", 1)[-1]
+    parts = filename.split(".")[1:]
 
-    workspace_id = tw_params["/lambda_tutorial/workspace_id"]
-    description = f"Generated by Lambda {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')} from {s3source}"
+    return [".".join(parts[i:]) for i in range(len(parts))]
 
-    # Python subprocess module works best with command split into array.
-    # Using split(' ') mostly works but fails on multi-word description. Adding description and filepath after split.
-    # Use the JSON output option to make it easier to work with Tower's response.
-    command = f"tw -o json datasets add --workspace={workspace_id} --name={dataset_name} --header"
-    command = command.split(" ")
-    # DONT put spaces before hyphens or else `tw` throws error `unmatched argument`
-    command.append(f"--description='{description}'")
-    command.append(f"{local_samplesheet}")
-    logger.debug(f"command is: {command}")
 
-    # Transaction could fail due to networking. Retryable.
-    result = invoke_tw_cli(
-        command=command,
-        errorstring=f"Failed to create dataset for file {s3source}",
-        retry_transaction=True,
-    )
-    logger.debug(f"Dataset creation confirmation is: {result}")
+def match_route(routing_table=None, key=None):
+    """
+    Resolve a key against the compiled routing table. The most specific (longest) matching prefix wins,
+    and within it the longest matching file type.
+    Return two values:
+        1) Whether any route's prefix matched (used to distinguish the two out-of-scope reasons);
+        2) The matched route, or None.
+    """
+    # Walk the trie along the key, collecting routes from each node the key passes through.
+    matched_prefixes = []
+    node = routing_table["trie"]
+    if node["routes"]:
+        matched_prefixes.append(node["routes"])
+    for char in key:
+        node = node["children"].get(char)
+        if node is None:
+            break
+        if node["routes"]:
+            matched_prefixes.append(node["routes"])
 
-    # Extract dataset ID from positive response
-    try:
-        datasetid = result["datasetId"]
-        logger.debug(f"Datasetid is: {datasetid}")
-    except Exception as e:
-        # Failure to extract and parse data will not change if retried. Do not retry.
-        log_error_and_raise_exception(
-            errorstring="Failed extract dataset ID.", e=e, retry_transaction=False
-        )
+    if not matched_prefixes:
+        return False, None
+
+    suffixes = routing_table["suffixes"]
+    candidates = [
+        suffixes[file_type]
+        for file_type in get_file_type_candidates(key=key)
+        if file_type in suffixes
+    ]
+
+    for route_indices in reversed(matched_prefixes):
+        for accepted in candidates:
+            for index in route_indices:
+                if index in accepted:
+                    return True, routing_table["routes"][index]
 
-    return datasetid
+    return True, None
 
 
-def launch_tower_pipeline(datasetid=None, tw_params=None):
+def is_process_running(pid=None):
     """
-    With the datasetid in hand, launch a pipeline. To do so:
-        1) Get the URL for the newly-created samplesheet.
-        2) Specify the URL as the input source parameter.
-        3) Invoke the target pipeline passing the parameter file with the defined input source.
+    Return whether a process with this PID exists on the host.
     """
-    # Extract parameters for inclusion in tw commands
-    workspace_id = tw_params["/lambda_tutorial/workspace_id"]
-    target_pipeline_name = tw_params["/lambda_tutorial/target_pipeline_name"]
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running, but owned by another user.
+        return True
+    return True
 
-    # Generate command for dataset URL retrieval (required for subsequent pipeline launch comand)
-    command = f"tw -o json datasets url --workspace={workspace_id} --id={datasetid}"
-    command = command.split(" ")
-    logger.debug(f"command is: {command}")
 
-    # Transaction could fail due to networking. Retryable.
-    result = invoke_tw_cli(
-        command=command,
-        errorstring=f"Could not retrieve URL for dataset {datasetid} from workspace {workspace_id}",
-        retry_transaction=True,
-    )
-    logger.debug(f"Dataset URL is: {result}")
+class Workspace:
+    """
+    Bounded local storage for the files the function writes. Lambda keeps /tmp for the life of a warm
+    container, so anything left behind accumulates across invocations.
+        - Each download, parameters file and set of shards gets a scratch directory of its own
+          (`scratch_dir`), removed once the record is done with it (`release`). Files with the same name from
+          different prefixes or records never collide.
+        - Downloaded samplesheets are moved into a cache addressed by S3 ETag, size and filename (`add`), so an
+          object that is redelivered or reprocessed isn't downloaded again (`checkout`). The cache holds at
+          most `max_bytes`, evicting the least recently used samplesheets that no record is using.
+    The index lives in memory, which lasts exactly as long as /tmp does in Lambda. Since an index only
+    describes its own files, each Workspace keeps them in a directory of its own under `root`. The only
+    other directories it deletes are those left under `root` by processes that are no longer running.
+    """
 
-    # Extract dataset URL from response and add to parameters file as input source.
-    try:
-        dataset_url = result["datasetUrl"]
-        logger.debug(f"Dataset URL is: {dataset_url}")
+    def __init__(self, root=None, max_bytes=None):
+        self._root = pathlib.Path(root)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._dir = None
+        # Cache key -> {'path', 'size', 'pins'}, least recently used first.
+        self._entries = collections.OrderedDict()
+        self._keys_by_path = {}
+        self._total = 0
 
-        # Create parameters file (JSON) to pass to pipeline (with dataset specified as input source)
-        input_params = {}
-        input_params["input"] = dataset_url
+    def _prepare(self):
+        # Called with the lock held. Other processes may be using `root`, so create a directory only this
+        # Workspace uses rather than emptying it.
+        if self._dir is None:
+            self._root.mkdir(parents=True, exist_ok=True)
+            self._remove_orphans()
+            self._dir = pathlib.Path(
+                tempfile.mkdtemp(prefix=f"{os.getpid()}-", dir=self._root)
+            )
+            (self._dir / "cache").mkdir()
+            (self._dir / "scratch").mkdir()
 
-        # Make local directory and write file:
-        p = pathlib.Path("/tmp/tower_input_files/")
-        p.mkdir(parents=True, exist_ok=True)
+    def _remove_orphans(self):
+        # Directories are named `<pid>-<random>`. A process that exited (or was killed) without `close` leaves
+        # its directory behind, and nothing else would ever remove it.
+        for path in self._root.iterdir():
+            pid = path.name.partition("-")[0]
+            if not path.is_dir() or not pid.isdigit() or is_process_running(int(pid)):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            logger.info(f"Removed {path}, left by process {pid}.")
 
-        p_posix = p.as_posix()
-        filepath = f"{p_posix}/{datasetid}.json"
-        with open(filepath, "w") as f:
-            json.dump(input_params, f)
+    def _evict(self, incoming=0):
+        # Called with the lock held. Entries pinned by a record in progress are skipped.
+        for key in list(self._entries):
+            if self._total + incoming <= self._max_bytes:
+                return
+            entry = self._entries[key]
+            if entry["pins"]:
+                continue
+            del self._entries[key]
+            del self._keys_by_path[entry["path"]]
+            self._total -= entry["size"]
+            shutil.rmtree(pathlib.Path(entry["path"]).parent, ignore_errors=True)
+            with contextlib.suppress(OSError):
+                # The ETag directory, once no filename is left under it.
+                pathlib.Path(entry["path"]).parent.parent.rmdir()
+            logger.debug(f"Evicted {key} from the workspace cache.")
 
-    except Exception as e:
-        # Failure to extract and parse data will not change if retried. Do not retry.
-        log_error_and_raise_exception(
-            errorstring=f"Failed to create json file for pipeline input.",
-            e=e,
-            retry_transaction=False,
-        )
+    def scratch_dir(self):
+        """
+        Create and return a directory for files only needed by the current record.
+        """
+        with self._lock:
+            self._prepare()
+        path = self._dir / "scratch" / uuid.uuid4().hex
+        path.mkdir()
+        return path
 
-    # Invoke pipeline (passing parameters file)
-    command = f"tw -o json launch --workspace={workspace_id} --params-file={filepath} {target_pipeline_name}"
-    command = command.split(" ")
-    logger.debug(f"command is: {command}")
+    def checkout(self, key=None):
+        """
+        Return the cached file for `key`, pinned until `release`d, or None if it isn't cached.
+        """
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry["pins"] += 1
+            self._entries.move_to_end(key)
+            return entry["path"]
 
-    result = invoke_tw_cli(
-        # This transaction may have failed due to networking but - based on the current logic - it cannot be
-        # retried. If we rerun the whole function, and error will be thrown earlier when the Lambda function tries
-        # to create a Dataset in Tower which already exists.
-        # This function can become retryable once the Dataset creation code is made more robust.
-        command=command,
-        errorstring=f"Could not invoke target pipeline.",
-        retry_transaction=False,
-    )
+    def reserve(self, size=None):
+        """
+        Evict least recently used samplesheets until `size` more bytes fit in the cache.
+        """
+        with self._lock:
+            self._evict(incoming=min(size or 0, self._max_bytes))
 
+    def add(self, key=None, path=None):
+        """
+        Move a file from its scratch directory into the cache under `key`, pinned until `release`d, and return
+        its new path. A file without a key (or larger than the whole cache) stays in scratch. If another record
+        cached the same key first, that copy is returned and this one removed.
+        """
+        size = os.path.getsize(path)
+        if key is None or size > self._max_bytes:
+            return path
 
-def invoke_tw_cli(command=None, errorstring=None, retry_transaction=None):
+        scratch = pathlib.Path(path).parent
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._evict(incoming=size)
+                cached = self._dir / "cache" / key / pathlib.Path(path).name
+                cached.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(path, cached)
+                entry = {"path": cached.as_posix(), "size": size, "pins": 0}
+                self._entries[key] = entry
+                self._keys_by_path[entry["path"]] = key
+                self._total += size
+            entry["pins"] += 1
+            self._entries.move_to_end(key)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+        return entry["path"]
+
+    def release(self, path=None):
+        """
+        Hand back a file (or directory) from `scratch_dir`, `checkout` or `add`. Scratch directories are removed;
+        cached files are unpinned, and evicted straight away if the cache is over its limit.
+        """
+        if path is None or self._dir is None:
+            return
+        with self._lock:
+            key = self._keys_by_path.get(path)
+            if key is not None:
+                self._entries[key]["pins"] -= 1
+                self._evict()
+                return
+
+        scratch = self._dir / "scratch"
+        path = pathlib.Path(path)
+        for parent in [path, *path.parents]:
+            if parent.parent == scratch:
+                shutil.rmtree(parent, ignore_errors=True)
+                return
+
+    def close(self):
+        """
+        Remove this Workspace's directory (e.g. when a worker process exits). It is recreated if used again.
+        """
+        with self._lock:
+            if self._dir is not None:
+                shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+            self._entries.clear()
+            self._keys_by_path.clear()
+            self._total = 0
+
+
+_workspace = Workspace(root=WORKSPACE_DIR, max_bytes=WORKSPACE_MAX_BYTES)
+
+
+def get_workspace_cache_key(record=None):
     """
-    Generic function to invoke subprocess calls to tw cli.
-    Invoking functions must pass:
-        1) Tokenized command (to facilitate use of python `subprocess` module),
-        2) Error string for logging purposes in event of failure.
-    NOTE: Function must convert the string-represented JSON returned  by tw to a dictionary for use by Python.
+    Return the workspace cache key for a record's samplesheet, '<eTag>-<size>/<filename>', or None if the
+    record carries no eTag. The filename is part of the key since it decides the dataset's file type.
+    """
+    s3_object = record["s3"]["object"]
+    etag = s3_object.get("eTag", "").strip('"')
+    if not etag:
+        return None
+
+    return f"{etag}-{s3_object.get('size', 0)}/{s3_object['key'].rsplit('/', 1)[-1]}"
+
+
+def split_compression_suffix(filename=None):
+    """
+    Split a samplesheet filename into its inner filename and compression (None when uncompressed).
+    Example: 'run.csv.gz' -> ('run.csv', 'gzip')
+    """
+    stem, dot, suffix = filename.rpartition(".")
+    if dot and stem and suffix.lower() in SAMPLESHEET_COMPRESSION:
+        return stem, SAMPLESHEET_COMPRESSION[suffix.lower()]
+
+    return filename, None
+
+
+def get_samplesheet_location(record=None):
+    """
+    Extract the bucket, key and filename of the samplesheet from an event record.
+    Return the location and the filename without extension (to use as the dataset name).
     """
     try:
-        result = subprocess.run(command, capture_output=True)
+        s3bucket = record["s3"]["bucket"]["name"]
+        s3key = record["s3"]["object"]["key"]
+        # Example of key: "lambda_tutorial/complete.txt"
+        samplesheet_filename = s3key.rsplit("/", maxsplit=1)[1]
+        # Drop the compression suffix and file type only: 'run.1.csv.gz' -> 'run_1'. Tower dataset names
+        # can't contain dots.
+        inner_filename, _ = split_compression_suffix(filename=samplesheet_filename)
+        dataset_name = inner_filename.rsplit(".", 1)[0].replace(".", "_")
+
     except Exception as e:
-        # Depending on command being invoked, may be retryable. Use value passed in from source to determine.
+        # Failure to extract and parse data will not change if retried. Do not retry.
         log_error_and_raise_exception(
-            errorstring=errorstring, e=e, retry_transaction=retry_transaction
+            errorstring=f"Failed to prepare file details for download",
+            e=e,
+            retry_transaction=False,
         )
 
-    # Log output of tw calls (for troubleshooting purposes)
-    logger.debug(f"Return code from tw was: {result.returncode}")
-    logger.debug(f"Stdout from tw was: {result.stdout}")
-    logger.debug(f"Stderr from tw was: {result.stderr}")
+    return s3bucket, s3key, samplesheet_filename, dataset_name
 
-    if result.returncode != 0:
-        # Indicates something is wrong with the request itself. Do not retry as the outcome will not change.
+
+@timed_stage(stage="download_samplesheet")
+def download_samplesheet(session=None, record=None):
+    """
+    Download the S3 file to the workspace (see `Workspace`), unless the same object is already cached there.
+    The caller hands the file back with `_workspace.release` once it is done with it.
+    Return two paths:
+        1) Absolute path to the local file;
+        2) Filename without extension (to use as the dataset name)
+    """
+    s3_client = get_client(session=session, service_name="s3")
+    s3bucket, s3key, samplesheet_filename, dataset_name = get_samplesheet_location(
+        record=record
+    )
+
+    # The same object (same ETag) may already be in the workspace, e.g. a redelivered event or a retry.
+    cache_key = get_workspace_cache_key(record=record)
+    cached_samplesheet = _workspace.checkout(key=cache_key)
+    if cached_samplesheet is not None:
+        logger.debug(f"Using cached copy of s3://{s3bucket}/{s3key}.")
+        annotate_stage(bytes_downloaded=0, cache_hit=True)
+        return cached_samplesheet, dataset_name
+
+    p_posix = None
+    try:
+        # Make local directory and download file:
+        # Each download gets its own scratch directory, so records with the same filename (processed
+        # concurrently) don't overwrite each other.
+        _workspace.reserve(size=record["s3"]["object"].get("size"))
+        p_posix = _workspace.scratch_dir().as_posix()
+        local_samplesheet = f"{p_posix}/{samplesheet_filename}"
+        _, compression = split_compression_suffix(filename=samplesheet_filename)
+
+        s3_client.download_file(s3bucket, s3key, local_samplesheet)
+        logger.debug(f"File downloaded locally: {os.listdir(p_posix)}")
+        annotate_stage(
+            bytes_downloaded=os.path.getsize(local_samplesheet), cache_hit=False
+        )
+
+    except Exception as e:
+        # Transaction may have failed due to networking. Retryable.
+        _workspace.release(path=p_posix)
         log_error_and_raise_exception(
-            errorstring=f"TW returned non-zero code:\nCode: {result.returncode}\nOriginal Error: {result.stderr}",
-            e=None,
-            retry_transaction=False,
+            errorstring="Failed to create temporary folder or download S3 file.",
+            e=e,
+            retry_transaction=True,
         )
 
-    return json.loads(result.stdout)
+    if compression is not None:
+        try:
+            local_samplesheet = decompress_samplesheet(
+                local_samplesheet=local_samplesheet,
+                samplesheet_filename=samplesheet_filename,
+                compression=compression,
+            )
+        except Exception:
+            _workspace.release(path=p_posix)
+            raise
 
+    return _workspace.add(key=cache_key, path=local_samplesheet), dataset_name
 
-def log_error_and_raise_exception(errorstring=None, e=None, retry_transaction=True):
+
+@timed_stage(stage="stream_samplesheet")
+def stream_samplesheet(session=None, record=None):
     """
-    This function is used to capture the reasons for why the Lambda code ceased prematurely.
-    Can be triggered for two reasons:
-        1) Actual programming exception which was not properly handled.
-        2) Deliberate invocation when evaluation logic determines the event is OOS and should be ignored.
+    Open the S3 object for streaming rather than downloading it to /tmp.
+    Objects up to STREAM_IN_MEMORY_THRESHOLD bytes are read with a single `get_object` call and held in memory
+    (cheaper than spinning up the transfer manager and round-tripping through disk). Larger objects keep the
+    response body open so it can be read in STREAM_CHUNK_SIZE chunks while being uploaded.
+    Return two values:
+        1) Dictionary describing the samplesheet (filename, size and either `content` or `body`);
+        2) Filename without extension (to use as the dataset name)
+    """
+    s3_client = get_client(session=session, service_name="s3")
+    s3bucket, s3key, samplesheet_filename, dataset_name = get_samplesheet_location(
+        record=record
+    )
 
-    Lambda retry logic is powerful and we want to leverage it for handling event like networking hiccups that could
-    cause a transaction to fail, but we don't want to retry events that we failed on purpose (e.g. because
-    the file type was wrong and indicated the file was not a sample sheet).
+    try:
+        response = s3_client.get_object(Bucket=s3bucket, Key=s3key)
+        size = response["ContentLength"]
 
-    The handler function has been configured to return when it detects a CeaseEventProcessing exception
-    (ending the event processing cleanly and not triggering a Lambda retry), but will return a generic
-    Exception in any other case, which will cause Lambda to retry the event.
+        samplesheet_stream = {
+            "filename": samplesheet_filename,
+            "size": size,
+            "content": None,
+            "body": None,
+        }
+        if size <= STREAM_IN_MEMORY_THRESHOLD:
+            samplesheet_stream["content"] = response["Body"].read()
+        else:
+            samplesheet_stream["body"] = response["Body"]
+        logger.debug(f"Opened s3://{s3bucket}/{s3key} for streaming ({size} bytes).")
+        annotate_stage(bytes_downloaded=size)
+
+    except Exception as e:
+        # Transaction may have failed due to networking. Retryable.
+        log_error_and_raise_exception(
+            errorstring="Failed to retrieve S3 file.",
+            e=e,
+            retry_transaction=True,
+        )
+
+    inner_filename, compression = split_compression_suffix(
+        filename=samplesheet_filename
+    )
+    if compression is not None:
+        # The decompressed size isn't known up front, so a compressed samplesheet is always sent as a stream
+        # (see `tower_api_upload_dataset`), even when the compressed object was small enough to read in one call.
+        try:
+            raw = (
+                io.BytesIO(samplesheet_stream["content"])
+                if samplesheet_stream["content"] is not None
+                else samplesheet_stream["body"]
+            )
+            body = DecompressedBody(raw=raw, compression=compression)
+            filename = detect_samplesheet_file_type(
+                filename=inner_filename, first_chunk=body.peek()
+            )
+        except Exception as e:
+            # Corrupt archive, not a samplesheet inside, or no zstandard package. Will not change if retried.
+            log_error_and_raise_exception(
+                errorstring=f"Failed to decompress samplesheet {samplesheet_filename}.",
+                e=e,
+                retry_transaction=False,
+            )
+        samplesheet_stream.update(filename=filename, size=None, content=None, body=body)
+
+    return samplesheet_stream, dataset_name
+
+
+class DecompressedBody:
+    """
+    Decompressing reader over a gzip or zstd samplesheet. Wraps anything with `read` (a local file or an S3
+    streaming body) and offers the `iter_chunks`/`close` methods of botocore's StreamingBody, so
+    `iter_samplesheet_chunks` treats it like any other S3 body. At most one chunk of decompressed output is
+    held in memory at a time, however well the samplesheet compresses.
     """
-    logger.debug(f"[EXCEPTION]: {errorstring}")
-    if e:
-        logger.debug(f"{e}")
 
-    if retry_transaction:
-        raise Exception("Transaction failed but may succeed on retry. Retrying.")
-    else:
-        raise CeaseEventProcessing("Transaction ceased deliberately. Do not retry.")
+    def __init__(self, raw=None, compression=None):
+        self._raw = raw
+        self._pending = b""
+        if compression == "gzip":
+            import gzip
 
+            self._reader = gzip.GzipFile(fileobj=raw, mode="rb")
+        else:
+            # Imported lazily since only .zst samplesheets need it. Keeps it off the cold-start path.
+            import zstandard
 
-def update_logging_level(desired_level=None):
+            self._reader = zstandard.ZstdDecompressor().stream_reader(
+                raw, read_across_frames=True
+            )
+
+    def peek(self):
+        """
+        Return the first chunk of decompressed output without consuming it.
+        """
+        if not self._pending:
+            self._pending = self._reader.read(STREAM_CHUNK_SIZE)
+        return self._pending
+
+    def iter_chunks(self, chunk_size=STREAM_CHUNK_SIZE):
+        if self._pending:
+            chunk, self._pending = self._pending, b""
+            yield chunk
+        while True:
+            chunk = self._reader.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self._reader.close()
+        self._raw.close()
+
+
+def detect_samplesheet_file_type(filename=None, first_chunk=None):
     """
-    Change logger level without requiring deployment of new image.
+    Return the filename Tower should see for a decompressed samplesheet. An inner filename ending in `.csv` or
+    `.tsv` is kept as is. Otherwise (e.g. 'run.gz' -> 'run') the type comes from the header line: tab-separated
+    if it contains a tab, comma-separated if not.
+    Raises if the header line isn't text, i.e. the archive doesn't hold a samplesheet.
     """
-    log_levels = ["DEBUG", "INFO", "WARN", "ERROR", "CRITICAL"]
-    desired_level = desired_level.upper()
+    header = first_chunk.split(b"\n", 1)[0]
+    if b"\x00" in header:
+        raise ValueError("Decompressed content is not a text samplesheet.")
+    header.decode("utf-8")
+
+    stem, dot, extension = filename.rpartition(".")
+    if dot and extension.lower() in ("csv", "tsv"):
+        return filename
+
+    extension = "tsv" if b"\t" in header else "csv"
+    return f"{filename}.{extension}"
+
+
+def decompress_samplesheet(
+    local_samplesheet=None, samplesheet_filename=None, compression=None
+):
+    """
+    Decompress a downloaded samplesheet alongside the compressed copy, one chunk at a time, then remove the
+    compressed copy. Return the path to the decompressed samplesheet, named after its inner format
+    (see `detect_samplesheet_file_type`).
+    """
+    compressed = pathlib.Path(local_samplesheet)
+    inner_filename, _ = split_compression_suffix(filename=samplesheet_filename)
+    partial = compressed.with_name(f"{compressed.name}.part")
+
+    try:
+        with stage_timer(stage="decompress_samplesheet"):
+            body = DecompressedBody(raw=open(compressed, "rb"), compression=compression)
+            try:
+                decompressed = compressed.with_name(
+                    detect_samplesheet_file_type(
+                        filename=inner_filename, first_chunk=body.peek()
+                    )
+                )
+                with open(partial, "wb") as f:
+                    for chunk in body.iter_chunks():
+                        f.write(chunk)
+            finally:
+                body.close()
+                compressed.unlink()
+            os.replace(partial, decompressed)
+            logger.debug(f"Decompressed {samplesheet_filename} to {decompressed.name}.")
+
+    except Exception as e:
+        # Corrupt archive, not a samplesheet inside, or no zstandard package. Will not change if retried.
+        partial.unlink(missing_ok=True)
+        log_error_and_raise_exception(
+            errorstring=f"Failed to decompress samplesheet {samplesheet_filename}.",
+            e=e,
+            retry_transaction=False,
+        )
+
+    return decompressed.as_posix()
+
+
+def iter_samplesheet_chunks(local_samplesheet=None, samplesheet_stream=None):
+    """
+    Yield the samplesheet's bytes in chunks of at most STREAM_CHUNK_SIZE, whether it is on local disk, in
+    memory, or still being read (and possibly decompressed) from S3. Memory use is bounded by the chunk size
+    (except for in-memory content, which is already below STREAM_IN_MEMORY_THRESHOLD).
+    """
+    if samplesheet_stream is None:
+        with open(local_samplesheet, "rb") as f:
+            while True:
+                chunk = f.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    elif samplesheet_stream["content"] is not None:
+        yield samplesheet_stream["content"]
 
-    if desired_level in log_levels:
-        logger.setLevel(desired_level)
-        logger.warning(f"Modified logging level to {desired_level}")
     else:
-        # Create logger alert and stick with default DEBUG
-        logger.error(
-            f"SSM parameter 'lambda_tutorial/logging_level' value {desired_level} is not a valid logging level. Continuing with DEBUG."
+        body = samplesheet_stream["body"]
+        try:
+            for chunk in body.iter_chunks(chunk_size=STREAM_CHUNK_SIZE):
+                yield chunk
+        finally:
+            body.close()
+
+
+def samplesheet_transfer_mode(tw_params=None):
+    """
+    Return how the samplesheet gets from S3 to Tower: `file` (download to /tmp, default) or `stream`.
+    Streaming is only possible with the API client since tw reads the samplesheet from disk.
+    """
+    mode = tw_params.get("/lambda_tutorial/samplesheet_transfer_mode", "file")
+    mode = mode.strip().lower()
+
+    if mode == "stream" and tower_client(tw_params=tw_params) != "api":
+        logger.warning(
+            "Samplesheet streaming requires `tower_client` set to `api`. Downloading to /tmp instead."
         )
+        return "file"
 
+    return mode
 
-def handler(event, context):
+
+@timed_stage(stage="create_tower_dataset")
+def create_tower_dataset(
+    local_samplesheet=None,
+    dataset_name=None,
+    record=None,
+    tw_params=None,
+    samplesheet_stream=None,
+):
     """
-    The first function that will be invoked when Lambda is activated.
+    Use the tw cli (or the Tower API directly - see `tower_client`) to upload the samplesheet to Tower.
+    A samplesheet named after an existing dataset is uploaded as a new version of it (see `resolve_dataset_id`).
+    Redelivered notifications and retried events are told apart from re-uploads by the idempotency store, if
+    one is configured (see `process_record`).
+    The samplesheet is either a local file (`local_samplesheet`) or, for the API client only, a
+    `samplesheet_stream` returned by `stream_samplesheet`.
+    Returns the dataset ID and the URL of the uploaded version. The URL is only known when Tower's response
+    includes it (API client). Otherwise it is None and must be retrieved with `get_dataset_url`.
+    Assumption: Header is always present.
     """
-    try:
-        # Hard-coded value to simplify the generation of a session.
-        # Could be externalized but would require more complicated logic to retrieve externalized value (when
-        # testing locally).
-        execution_role = "lambda_tutorial"
-        session = generate_session(execution_role=execution_role)
-        logger.debug(
-            f"Session client is: {session.client('sts').get_caller_identity()}"
-        )
-
-        # Get parameters from SSM
-        # Update function logging level (if necessary) when `logging_level` parameter is retrieved.
-        # NOTE:
-        #   Keynames are odd for a Python dictionary, but it works and aligns with required AWS set-up commands.
-        #   Keep logging_level as first entry to control logging behaviour of other values when retrieved.
-        params_to_retrieve = [
-            "/lambda_tutorial/logging_level",
-            "/lambda_tutorial/workspace_id",
-            "/lambda_tutorial/s3_root_prefix",
-            "/lambda_tutorial/samplesheet_file_types",
-            "/lambda_tutorial/target_pipeline_name",
-            "/lambda_tutorial/tower_api_endpoint",
-        ]
-        tw_params = get_parameters(
-            session=session, params_to_retrieve=params_to_retrieve
+    s3bucket = record["s3"]["bucket"]["name"]
+    s3key = record["s3"]["object"]["key"]
+    s3source = f"s3://{s3bucket}/{s3key}"
+
+    workspace_id = tw_params["/lambda_tutorial/workspace_id"]
+    description = f"Generated by Lambda {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')} from {s3source}"
+    errorstring = f"Failed to create dataset for file {s3source}"
+    use_api = tower_client(tw_params=tw_params) == "api"
+
+    # Only names already known to exist are looked up here. A new name (the normal case) goes straight to the
+    # create call, and the workspace is only searched if Tower rejects it as a duplicate.
+    datasetid = get_cached_tower_id(
+        kind="datasets", workspace_id=workspace_id, name=dataset_name
+    )
+    indexed = datasetid is not None
+    result = None
+
+    if datasetid is None:
+        try:
+            # Transaction could fail due to networking. Retryable.
+            if use_api:
+                datasetid = tower_api_create_dataset(
+                    workspace_id=workspace_id,
+                    dataset_name=dataset_name,
+                    description=description,
+                    tw_params=tw_params,
+                    errorstring=errorstring,
+                )
+            else:
+                # `tw datasets add` creates the dataset and uploads its first version in one call.
+                result = tw_cli_add_dataset(
+                    workspace_id=workspace_id,
+                    dataset_name=dataset_name,
+                    description=description,
+                    local_samplesheet=local_samplesheet,
+                    errorstring=errorstring,
+                )
+                datasetid = result.get("datasetId")
+
+        except TowerNameConflict:
+            # Tower rejects a duplicate name. Upload a new version of the existing dataset instead. Any other
+            # rejection ceases the record as before.
+            datasetid = resolve_dataset_id(
+                workspace_id=workspace_id,
+                dataset_name=dataset_name,
+                tw_params=tw_params,
+            )
+            if datasetid is None:
+                raise
+            logger.debug(f"Dataset {dataset_name} already exists. Adding a version.")
+            result = None
+
+        if datasetid is not None:
+            cache_tower_id(
+                kind="datasets",
+                workspace_id=workspace_id,
+                name=dataset_name,
+                value=datasetid,
+            )
+
+    if result is None and datasetid is not None:
+        try:
+            if use_api:
+                result = tower_api_upload_dataset(
+                    workspace_id=workspace_id,
+                    datasetid=datasetid,
+                    local_samplesheet=local_samplesheet,
+                    samplesheet_stream=samplesheet_stream,
+                    tw_params=tw_params,
+                    errorstring=errorstring,
+                )
+            else:
+                result = tw_cli_update_dataset(
+                    workspace_id=workspace_id,
+                    datasetid=datasetid,
+                    local_samplesheet=local_samplesheet,
+                    errorstring=errorstring,
+                )
+        except CeaseEventProcessing as e:
+            if not indexed:
+                raise
+            # The indexed dataset may have been deleted in Tower. Forget it so the retry looks it up again.
+            invalidate_tower_id(
+                kind="datasets", workspace_id=workspace_id, name=dataset_name
+            )
+            log_error_and_raise_exception(
+                errorstring=f"Failed to add a version to indexed dataset {datasetid} ({dataset_name}).",
+                e=e,
+                retry_transaction=True,
+            )
+    logger.debug(f"Dataset creation confirmation is: {result}")
+
+    if datasetid is None:
+        # Failure to extract and parse data will not change if retried. Do not retry.
+        log_error_and_raise_exception(
+            errorstring="Failed extract dataset ID.", e=None, retry_transaction=False
         )
-        logger.debug(f"Parameters are: {tw_params}")
+    logger.debug(f"Datasetid is: {datasetid}")
+
+    return datasetid, (result or {}).get("datasetUrl")
 
-        # Check event to see if newly-arrived file needs to be processed. If yes, continue.
-        check_if_event_in_scope(event=event, tw_params=tw_params)
 
-        # Get Secrets from AWS Secrets Manager & set as environment variables
-        tw_secrets = get_secrets(session=session)
-        logger.debug(f"Secrets are: {tw_secrets}")
-        set_environment_variables(tw_params=tw_params, tw_secrets=tw_secrets)
+def resolve_dataset_id(workspace_id=None, dataset_name=None, tw_params=None):
+    """
+    Return the ID of the workspace's dataset called `dataset_name`, or None if there isn't one.
+    The workspace's datasets are searched for the name (a page of TOWER_LIST_PAGE_SIZE at a time with the API
+    client; `tw` pages through them itself) and every name returned is indexed. Only called after Tower rejects
+    a duplicate name, so creating a dataset under a new name never costs a search.
+    """
+    errorstring = f"Could not list datasets in workspace {workspace_id}"
+    datasets = []
+    if tower_client(tw_params=tw_params) == "api":
+        seen = set()
+        while True:
+            # Transaction could fail due to networking. Retryable.
+            result = invoke_tower_api(
+                method="GET",
+                path=f"/workspaces/{workspace_id}/datasets",
+                tw_params=tw_params,
+                query={
+                    "search": dataset_name,
+                    "max": TOWER_LIST_PAGE_SIZE,
+                    "offset": len(datasets),
+                },
+                errorstring=errorstring,
+                retry_transaction=True,
+            )
+            page = [d for d in result.get("datasets", []) if d["id"] not in seen]
+            datasets.extend(page)
+            seen.update(d["id"] for d in page)
+            # A short page is the last one. So is a page with nothing new, in case the paging is ignored.
+            if len(page) < TOWER_LIST_PAGE_SIZE or any(
+                d["name"] == dataset_name for d in page
+            ):
+                break
+    else:
+        command = f"tw -o json datasets list --workspace={workspace_id}"
+        command = command.split(" ")
+        command.append(f"--filter={dataset_name}")
+        logger.debug(f"command is: {command}")
 
-        # Download the file from S3 and push to Tower as a new dataset
-        local_samplesheet, dataset_name = download_samplesheet(
-            session=session, event=event
+        # Transaction could fail due to networking. Retryable.
+        result = invoke_tw_cli(
+            command=command, errorstring=errorstring, retry_transaction=True
         )
+        datasets = result.get("datasetList", [])
 
-        datasetid = create_tower_dataset(
-            local_samplesheet=local_samplesheet,
-            dataset_name=dataset_name,
-            event=event,
+    with _tower_index_lock:
+        index = _tower_index["datasets"]
+        for dataset in datasets:
+            index[(workspace_id, dataset["name"])] = (dataset["id"], time.monotonic())
+    logger.debug(f"Indexed {len(datasets)} dataset(s) in workspace {workspace_id}.")
+
+    return get_cached_tower_id(
+        kind="datasets", workspace_id=workspace_id, name=dataset_name
+    )
+
+
+def get_cached_tower_id(kind=None, workspace_id=None, name=None):
+    """
+    Return the indexed ID for a dataset or pipeline name (`kind` is `datasets` or `pipelines`), or None if
+    it isn't indexed or its entry is older than TOWER_INDEX_TTL.
+    """
+    with _tower_index_lock:
+        entry = _tower_index[kind].get((workspace_id, name))
+    if entry is None or time.monotonic() - entry[1] >= TOWER_INDEX_TTL:
+        return None
+    return entry[0]
+
+
+def cache_tower_id(kind=None, workspace_id=None, name=None, value=None):
+    """
+    Add a name to ID mapping to the in-container index.
+    """
+    with _tower_index_lock:
+        _tower_index[kind][(workspace_id, name)] = (value, time.monotonic())
+
+
+def invalidate_tower_id(kind=None, workspace_id=None, name=None):
+    """
+    Drop a name from the in-container index (e.g. after Tower rejected its ID).
+    """
+    with _tower_index_lock:
+        _tower_index[kind].pop((workspace_id, name), None)
+
+
+def tw_cli_add_dataset(
+    workspace_id=None,
+    dataset_name=None,
+    description=None,
+    local_samplesheet=None,
+    errorstring=None,
+):
+    """
+    Create a dataset with `tw datasets add`.
+    """
+    # Python subprocess module works best with command split into array.
+    # Using split(' ') mostly works but fails on multi-word description. Adding description and filepath after split.
+    # Use the JSON output option to make it easier to work with Tower's response.
+    command = f"tw -o json datasets add --workspace={workspace_id} --name={dataset_name} --header"
+    command = command.split(" ")
+    # DONT put spaces before hyphens or else `tw` throws error `unmatched argument`
+    command.append(f"--description='{description}'")
+    command.append(f"{local_samplesheet}")
+    logger.debug(f"command is: {command}")
+
+    # Transaction could fail due to networking. Retryable.
+    return invoke_tw_cli(
+        command=command,
+        errorstring=errorstring,
+        retry_transaction=True,
+    )
+
+
+def tw_cli_update_dataset(
+    workspace_id=None, datasetid=None, local_samplesheet=None, errorstring=None
+):
+    """
+    Upload the samplesheet as a new version of an existing dataset with `tw datasets update`.
+    """
+    command = f"tw -o json datasets update --workspace={workspace_id} --id={datasetid} --header"
+    command = command.split(" ")
+    command.append(f"--file={local_samplesheet}")
+    logger.debug(f"command is: {command}")
+
+    # Transaction could fail due to networking. Retryable.
+    return invoke_tw_cli(
+        command=command,
+        errorstring=errorstring,
+        retry_transaction=True,
+    )
+
+
+@timed_stage(stage="get_dataset_url")
+def get_dataset_url(datasetid=None, tw_params=None):
+    """
+    Retrieve the URL for the newly-created samplesheet (required for subsequent pipeline launch comand).
+    """
+    workspace_id = tw_params["/lambda_tutorial/workspace_id"]
+
+    # Transaction could fail due to networking. Retryable.
+    errorstring = (
+        f"Could not retrieve URL for dataset {datasetid} from workspace {workspace_id}"
+    )
+    if tower_client(tw_params=tw_params) == "api":
+        result = tower_api_dataset_url(
+            workspace_id=workspace_id,
+            datasetid=datasetid,
             tw_params=tw_params,
+            errorstring=errorstring,
         )
+    else:
+        command = f"tw -o json datasets url --workspace={workspace_id} --id={datasetid}"
+        command = command.split(" ")
+        logger.debug(f"command is: {command}")
 
-        # Invoke a pre-existing pipeline with the newly-created dataset
-        launch_tower_pipeline(datasetid=datasetid, tw_params=tw_params)
-        return "Pipeline completed successfully."
+        result = invoke_tw_cli(
+            command=command,
+            errorstring=errorstring,
+            retry_transaction=True,
+        )
+    logger.debug(f"Dataset URL is: {result}")
 
-    except CeaseEventProcessing as e:
-        # Event was terminated on purpose. Do not retry.
-        return "Pipeline was terminated early."
+    try:
+        dataset_url = result["datasetUrl"]
+    except Exception as e:
+        # Failure to extract and parse data will not change if retried. Do not retry.
+        log_error_and_raise_exception(
+            errorstring="Failed extract dataset URL.", e=e, retry_transaction=False
+        )
+
+    return dataset_url
+
+
+@timed_stage(stage="launch_tower_pipeline")
+def launch_tower_pipeline(
+    datasetid=None, tw_params=None, dataset_url=None, retry_transaction=False
+):
+    """
+    With the datasetid in hand, launch a pipeline. To do so:
+        1) Get the URL for the newly-created samplesheet (unless already known, e.g. when resuming).
+        2) Specify the URL as the input source parameter.
+        3) Invoke the target pipeline passing the parameter file with the defined input source.
+    Returns Tower's launch response (e.g. {'workflowId': '...'}).
+    """
+    # Extract parameters for inclusion in tw commands
+    workspace_id = tw_params["/lambda_tutorial/workspace_id"]
+    target_pipeline_name = tw_params["/lambda_tutorial/target_pipeline_name"]
+    use_api = tower_client(tw_params=tw_params) == "api"
+
+    if dataset_url is None:
+        dataset_url = get_dataset_url(datasetid=datasetid, tw_params=tw_params)
+
+    # Add dataset URL to parameters file as input source.
+    try:
+        logger.debug(f"Dataset URL is: {dataset_url}")
+
+        # Create parameters file (JSON) to pass to pipeline (with dataset specified as input source)
+        input_params = {}
+        input_params["input"] = dataset_url
+
+        # The API client sends the parameters inline, so the file is only needed by tw.
+        filepath = None
+        if not use_api:
+            # Make local directory and write file (removed once tw has read it):
+            p_posix = _workspace.scratch_dir().as_posix()
+            filepath = f"{p_posix}/{datasetid}.json"
+            with open(filepath, "w") as f:
+                json.dump(input_params, f)
+
+    except Exception as e:
+        # Failure to extract and parse data will not change if retried. Do not retry.
+        log_error_and_raise_exception(
+            errorstring=f"Failed to create json file for pipeline input.",
+            e=e,
+            retry_transaction=False,
+        )
+
+    # This transaction may have failed due to networking but - without an idempotency store - it cannot be
+    # retried: Tower may have started the run, and a rerun of the whole function would upload another version
+    # of the Dataset and launch again.
+    # When an idempotency store is configured, the caller passes retry_transaction=True since a rerun
+    # resumes at this stage rather than re-uploading the Dataset.
+    if use_api:
+        result = tower_api_launch(
+            workspace_id=workspace_id,
+            pipeline_name=target_pipeline_name,
+            input_params=input_params,
+            tw_params=tw_params,
+            errorstring=f"Could not invoke target pipeline.",
+            retry_transaction=retry_transaction,
+        )
+    else:
+        # Invoke pipeline (passing parameters file)
+        command = f"tw -o json launch --workspace={workspace_id} --params-file={filepath} {target_pipeline_name}"
+        command = command.split(" ")
+        logger.debug(f"command is: {command}")
+
+        try:
+            result = invoke_tw_cli(
+                command=command,
+                errorstring=f"Could not invoke target pipeline.",
+                retry_transaction=retry_transaction,
+            )
+        finally:
+            _workspace.release(path=filepath)
+    logger.debug(f"Launch confirmation is: {result}")
+
+    return result
+
+
+def invoke_tw_cli(command=None, errorstring=None, retry_transaction=None):
+    """
+    Generic function to invoke subprocess calls to tw cli.
+    Invoking functions must pass:
+        1) Tokenized command (to facilitate use of python `subprocess` module),
+        2) Error string for logging purposes in event of failure.
+    NOTE: Function must convert the string-represented JSON returned  by tw to a dictionary for use by Python.
+
+    Transient failures (see `is_tower_transient_error`) of a retryable command are retried in place (see
+    `retry_step`). Every attempt goes through the Tower circuit breaker.
+    """
+    # Stage name is the tw subcommand (e.g. `tw_datasets_add`).
+    subcommand = [token for token in command[3:5] if not token.startswith("-")]
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        trial = check_tower_circuit(errorstring=errorstring)
+        acquire_tower_token()
+        try:
+            with stage_timer(stage="_".join(["tw"] + subcommand)) as span:
+                result = subprocess.run(command, capture_output=True)
+                span["tw_return_code"] = result.returncode
+        except Exception as e:
+            # tw couldn't be run, so Tower's health is unknown. Only a trial call reports back, to release it.
+            if trial:
+                _tower_breaker.record(success=False, trial=True)
+            # Depending on command being invoked, may be retryable. Use value passed in from source to determine.
+            log_error_and_raise_exception(
+                errorstring=errorstring, e=e, retry_transaction=retry_transaction
+            )
+
+        # Log output of tw calls (for troubleshooting purposes)
+        logger.debug(f"Return code from tw was: {result.returncode}")
+        logger.debug(f"Stdout from tw was: {result.stdout}")
+        logger.debug(f"Stderr from tw was: {result.stderr}")
+
+        transient = result.returncode != 0 and is_tower_transient_error(result.stderr)
+        _tower_breaker.record(success=not transient, trial=trial)
+        if not transient:
+            break
+        if not (
+            retry_transaction
+            and retry_step(attempt=attempt, started=started, step=command[3:5])
+        ):
+            # Tower is unreachable or overloaded. Retryable (by Lambda) if the command is.
+            log_error_and_raise_exception(
+                errorstring=f"{errorstring}\nCode: {result.returncode}\nOriginal Error: {result.stderr}",
+                e=None,
+                retry_transaction=retry_transaction,
+            )
+
+    if result.returncode != 0 and is_tower_authentication_error(result.stderr):
+        # The cached PAT was rejected, most likely because the secret was rotated. Drop it so the retried
+        # event retrieves the current value from Secrets Manager. Retryable.
+        invalidate_secrets_cache()
+        log_error_and_raise_exception(
+            errorstring=f"TW authentication failed:\nCode: {result.returncode}\nOriginal Error: {result.stderr}",
+            e=None,
+            retry_transaction=True,
+        )
+
+    if result.returncode != 0 and is_tower_name_conflict(result.stderr):
+        # The name is already taken. Do not retry; the caller may use the existing object instead.
+        logger.debug(
+            f"[EXCEPTION]: {errorstring}\nCode: {result.returncode}\nOriginal Error: {result.stderr}"
+        )
+        raise TowerNameConflict("Tower rejected a duplicate name. Do not retry.")
+
+    if result.returncode != 0:
+        # Indicates something is wrong with the request itself. Do not retry as the outcome will not change.
+        log_error_and_raise_exception(
+            errorstring=f"TW returned non-zero code:\nCode: {result.returncode}\nOriginal Error: {result.stderr}",
+            e=None,
+            retry_transaction=False,
+        )
+
+    return json.loads(result.stdout)
+
+
+def retry_step(attempt=None, started=None, step=None):
+    """
+    Decide whether a failed call gets another attempt and, if so, sleep before it.
+    A call is retried while it has attempts left (RETRY_MAX_ATTEMPTS) and the next attempt would start within
+    RETRY_BUDGET seconds of the first. The backoff is "full jitter": a random delay between zero and
+    RETRY_BASE_DELAY * 2^(attempt - 1) (capped at RETRY_MAX_DELAY), so concurrent callers don't retry in step.
+    """
+    if attempt >= RETRY_MAX_ATTEMPTS:
+        return False
+
+    delay = random.uniform(
+        0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    )
+    if time.monotonic() - started + delay > RETRY_BUDGET:
+        return False
+
+    logger.debug(f"Retrying {step} (attempt {attempt + 1}) in {delay:.2f}s.")
+    with stage_timer(stage="retry_backoff"):
+        time.sleep(delay)
+    return True
+
+
+class TowerCircuitBreaker:
+    """
+    Circuit breaker over Tower calls, shared by every thread in the container.
+    Tracks whether each of the last BREAKER_WINDOW calls failed transiently. Once at least BREAKER_MIN_CALLS
+    have been made and the failure rate reaches BREAKER_FAILURE_RATE, the breaker opens: Tower calls fail
+    fast for BREAKER_COOLDOWN seconds. A single trial call is then let through (half-open). If it succeeds
+    the breaker closes, otherwise it opens again.
+    """
+
+    def __init__(self):
+        self._outcomes = collections.deque(maxlen=BREAKER_WINDOW)
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < BREAKER_COOLDOWN:
+                return "open"
+            return "half_open"
+
+    def allow(self):
+        """
+        Return whether a Tower call may be made now, and whether it is the half-open trial call.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True, False
+            if time.monotonic() - self._opened_at < BREAKER_COOLDOWN:
+                return False, False
+            if self._trial_in_flight:
+                return False, False
+            self._trial_in_flight = True
+            return True, True
+
+    def record(self, success=None, trial=False):
+        """
+        Record the outcome of a Tower call. Only transient failures (network, throttling, server errors)
+        count as failures; a rejected request means Tower is up.
+        """
+        with self._lock:
+            if trial:
+                self._trial_in_flight = False
+                if success:
+                    logger.info("Tower circuit breaker closed.")
+                    self._opened_at = None
+                    self._outcomes.clear()
+                else:
+                    self._opened_at = time.monotonic()
+                return
+
+            if self._opened_at is not None:
+                # Call started before the breaker opened. The trial decides when it closes.
+                return
+
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if (
+                len(self._outcomes) >= BREAKER_MIN_CALLS
+                and failures / len(self._outcomes) >= BREAKER_FAILURE_RATE
+            ):
+                logger.warning(
+                    f"Tower circuit breaker opened: {failures} of the last {len(self._outcomes)} calls failed."
+                )
+                self._opened_at = time.monotonic()
+
+
+_tower_breaker = TowerCircuitBreaker()
+
+
+def check_tower_circuit(errorstring=None):
+    """
+    Fail fast while the Tower circuit breaker is open. No request is made, so handing the record back for a
+    later retry is always safe, whatever the step. Returns whether the call about to be made is the
+    breaker's half-open trial (to be passed back to `record`).
+    """
+    allowed, trial = _tower_breaker.allow()
+    if not allowed:
+        with stage_timer(stage="tower_circuit_open"):
+            log_error_and_raise_exception(
+                errorstring=f"{errorstring}\nTower circuit breaker is open. Failing fast.",
+                e=None,
+                retry_transaction=True,
+            )
+
+    return trial
+
+
+def tower_client(tw_params=None):
+    """
+    Return which client talks to Tower: `cli` (tw subprocess, default) or `api` (pooled HTTP client).
+    """
+    return tw_params.get("/lambda_tutorial/tower_client", "cli").strip().lower()
+
+
+def get_tower_http_pool():
+    """
+    Return the module-level urllib3 PoolManager used for Tower API calls.
+    Created once per container so TLS connections to Tower are kept alive and reused across
+    records and warm invocations (the tw cli pays a new process start and handshake on every call).
+    """
+    with _tower_http_lock:
+        if _tower_http["pool"] is None:
+            _tower_http["pool"] = urllib3.PoolManager(
+                maxsize=TOWER_API_POOL_SIZE,
+                retries=False,
+                timeout=urllib3.Timeout(connect=10.0, read=TOWER_API_TIMEOUT),
+            )
+        return _tower_http["pool"]
+
+
+def invoke_tower_api(
+    method=None,
+    path=None,
+    tw_params=None,
+    query=None,
+    payload=None,
+    body=None,
+    headers=None,
+    errorstring=None,
+    retry_transaction=None,
+):
+    """
+    Generic function to call the Tower REST API. The API counterpart of `invoke_tw_cli`.
+    Invoking functions must pass:
+        1) HTTP method and API path (e.g. '/workspaces/123/datasets'),
+        2) Either a JSON-serializable `payload` or a pre-encoded `body` (with matching headers),
+        3) Error string for logging purposes in event of failure.
+    Error handling mirrors the tw cli:
+        - Networking failures, throttling (429) and server errors (5xx) use the retry value passed in. If it is
+          retryable, the request is first retried in place (see `retry_step`).
+        - Authentication failures (401/403) drop the cached PAT and are retried.
+        - Any other 4xx indicates something is wrong with the request itself. Do not retry.
+    Every attempt goes through the Tower circuit breaker. A `body` that can't be replayed (e.g. a generator)
+    is only sent once; pass a function returning the body to allow in-place retries.
+    """
+    endpoint = tw_params["/lambda_tutorial/tower_api_endpoint"].rstrip("/")
+    url = f"{endpoint}{path}"
+    if query:
+        url = f"{url}?{urllib.parse.urlencode(query)}"
+
+    request_headers = {
+        "Authorization": f"Bearer {os.environ['TOWER_ACCESS_TOKEN']}",
+        "Accept": "application/json",
+    }
+    if payload is not None:
+        body = json.dumps(payload).encode("utf-8")
+        request_headers["Content-Type"] = "application/json"
+    request_headers.update(headers or {})
+
+    replayable = body is None or isinstance(body, bytes) or callable(body)
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        trial = check_tower_circuit(errorstring=errorstring)
+        acquire_tower_token()
+        error, response = None, None
+        try:
+            with stage_timer(stage=f"tower_api_{method.lower()}"):
+                response = get_tower_http_pool().request(
+                    method,
+                    url,
+                    body=body() if callable(body) else body,
+                    headers=request_headers,
+                )
+        except Exception as e:
+            error = e
+
+        transient = error is not None or (
+            response.status == 429 or response.status >= 500
+        )
+        _tower_breaker.record(success=not transient, trial=trial)
+        if not transient:
+            break
+        if not (
+            retry_transaction
+            and replayable
+            and retry_step(attempt=attempt, started=started, step=f"{method} {path}")
+        ):
+            if error is not None:
+                # Depending on request being made, may be retryable. Use value passed in from source to determine.
+                log_error_and_raise_exception(
+                    errorstring=errorstring,
+                    e=error,
+                    retry_transaction=retry_transaction,
+                )
+            break
+
+    logger.debug(f"Status from Tower API {method} {path} was: {response.status}")
+    logger.debug(f"Response from Tower API was: {response.data}")
+
+    if response.status in (401, 403):
+        # The cached PAT was rejected, most likely because the secret was rotated. Retryable.
+        invalidate_secrets_cache()
+        log_error_and_raise_exception(
+            errorstring=f"Tower API authentication failed:\nCode: {response.status}\nOriginal Error: {response.data}",
+            e=None,
+            retry_transaction=True,
+        )
+
+    if response.status == 429 or response.status >= 500:
+        log_error_and_raise_exception(
+            errorstring=f"{errorstring}\nCode: {response.status}\nOriginal Error: {response.data}",
+            e=None,
+            retry_transaction=retry_transaction,
+        )
+
+    if response.status == 409 or (
+        response.status >= 400 and is_tower_name_conflict(response.data)
+    ):
+        # The name is already taken. Do not retry; the caller may use the existing object instead.
+        logger.debug(
+            f"[EXCEPTION]: {errorstring}\nCode: {response.status}\nOriginal Error: {response.data}"
+        )
+        raise TowerNameConflict("Tower rejected a duplicate name. Do not retry.")
+
+    if response.status >= 400:
+        # Indicates something is wrong with the request itself. Do not retry as the outcome will not change.
+        log_error_and_raise_exception(
+            errorstring=f"Tower API returned error:\nCode: {response.status}\nOriginal Error: {response.data}",
+            e=None,
+            retry_transaction=False,
+        )
+
+    if not response.data:
+        return {}
+    return json.loads(response.data)
+
+
+def encode_multipart_file(field_name=None, filename=None, content_type=None):
+    """
+    Return the content type header plus the bytes that go before and after the file content in a
+    single-file multipart/form-data body. Splitting the envelope from the content lets callers send the
+    file without first assembling the whole body in memory.
+    """
+    boundary = uuid.uuid4().hex
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode("utf-8")
+    tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    return f"multipart/form-data; boundary={boundary}", head, tail
+
+
+def tower_api_create_dataset(
+    workspace_id=None,
+    dataset_name=None,
+    description=None,
+    tw_params=None,
+    errorstring=None,
+):
+    """
+    Create an empty dataset in the workspace and return its ID. The API half of `tw datasets add`; the
+    samplesheet is added with `tower_api_upload_dataset`.
+    """
+    result = invoke_tower_api(
+        method="POST",
+        path=f"/workspaces/{workspace_id}/datasets",
+        tw_params=tw_params,
+        payload={"name": dataset_name, "description": description},
+        errorstring=errorstring,
+        retry_transaction=True,
+    )
+
+    return result["dataset"]["id"]
+
+
+def tower_api_upload_dataset(
+    workspace_id=None,
+    datasetid=None,
+    local_samplesheet=None,
+    samplesheet_stream=None,
+    tw_params=None,
+    errorstring=None,
+):
+    """
+    Upload the samplesheet as the dataset's next version (the first, for a new dataset). The multipart body
+    is sent as a stream of chunks with an explicit Content-Length, so the file is never held in memory in full.
+    A compressed samplesheet's decompressed size isn't known up front, so it is sent with chunked transfer
+    encoding instead.
+    Returns the version number and the version's URL, which saves a separate `datasets url` lookup.
+
+    Example upload response: {'version':
+        {'datasetId': '2Ak7cUBuRqSVmKQJgbAmNG',
+        'version': 1,
+        'hasHeader': True,
+        'url': 'https://api.tower.nf/workspaces/34830707738561/datasets/2Ak7cUBuRqSVmKQJgbAmNG/v/1/n/samplesheet_full.csv',
+        ...
+    """
+    if samplesheet_stream is None:
+        filename = pathlib.Path(local_samplesheet).name
+        size = os.path.getsize(local_samplesheet)
+    else:
+        filename = samplesheet_stream["filename"]
+        size = samplesheet_stream["size"]
+
+    # Same part type `tw datasets add` sends for the file's extension.
+    file_type = (
+        "text/tab-separated-values"
+        if filename.rpartition(".")[2].lower() == "tsv"
+        else "text/csv"
+    )
+    content_type, head, tail = encode_multipart_file(
+        field_name="file", filename=filename, content_type=file_type
+    )
+
+    def multipart_body():
+        yield head
+        yield from iter_samplesheet_chunks(
+            local_samplesheet=local_samplesheet, samplesheet_stream=samplesheet_stream
+        )
+        yield tail
+
+    result = invoke_tower_api(
+        method="POST",
+        path=f"/workspaces/{workspace_id}/datasets/{datasetid}/upload",
+        tw_params=tw_params,
+        query={"header": "true"},
+        # A streamed S3 body can only be read once, so only a local or in-memory samplesheet is replayable.
+        body=(
+            multipart_body
+            if samplesheet_stream is None or samplesheet_stream["content"] is not None
+            else multipart_body()
+        ),
+        headers=(
+            {
+                "Content-Type": content_type,
+                "Content-Length": str(len(head) + size + len(tail)),
+            }
+            if size is not None
+            else {"Content-Type": content_type}
+        ),
+        errorstring=errorstring,
+        retry_transaction=True,
+    )
+
+    return {
+        "datasetId": datasetid,
+        "version": result["version"]["version"],
+        "datasetUrl": result["version"].get("url"),
+    }
+
+
+def tower_api_dataset_url(
+    workspace_id=None, datasetid=None, tw_params=None, errorstring=None
+):
+    """
+    API equivalent of `tw datasets url`: return the URL of the dataset's latest version.
+    """
+    result = invoke_tower_api(
+        method="GET",
+        path=f"/workspaces/{workspace_id}/datasets/{datasetid}/versions",
+        tw_params=tw_params,
+        errorstring=errorstring,
+        retry_transaction=True,
+    )
+    latest = max(result["versions"], key=lambda version: version["version"])
+
+    return {"datasetUrl": latest["url"]}
+
+
+def tower_api_launch(
+    workspace_id=None,
+    pipeline_name=None,
+    input_params=None,
+    tw_params=None,
+    errorstring=None,
+    retry_transaction=None,
+):
+    """
+    API equivalent of `tw launch --params-file=... <pipeline_name>`:
+        1) Resolve the Launchpad pipeline ID from its name (see `resolve_pipeline_id`).
+        2) Retrieve the pipeline's launch configuration.
+        3) Submit the launch with `input_params` merged into the pipeline's default parameters.
+    """
+    pipelineid = get_cached_tower_id(
+        kind="pipelines", workspace_id=workspace_id, name=pipeline_name
+    )
+    indexed = pipelineid is not None
+    if pipelineid is None:
+        pipelineid = resolve_pipeline_id(
+            workspace_id=workspace_id,
+            pipeline_name=pipeline_name,
+            tw_params=tw_params,
+            errorstring=errorstring,
+        )
+
+    try:
+        result = invoke_tower_api(
+            method="GET",
+            path=f"/pipelines/{pipelineid}/launch",
+            tw_params=tw_params,
+            query={"workspaceId": workspace_id},
+            errorstring=errorstring,
+            retry_transaction=True,
+        )
+    except CeaseEventProcessing as e:
+        if not indexed:
+            raise
+        # The indexed pipeline may have been deleted or recreated. Forget it so the retry looks it up again.
+        invalidate_tower_id(
+            kind="pipelines", workspace_id=workspace_id, name=pipeline_name
+        )
+        log_error_and_raise_exception(
+            errorstring=f"Failed to retrieve launch configuration for indexed pipeline {pipelineid} ({pipeline_name}).",
+            e=e,
+            retry_transaction=True,
+        )
+    launch = result["launch"]
+
+    params = json.loads(launch.get("paramsText") or "{}")
+    params.update(input_params)
+
+    launch_request = {
+        "computeEnvId": launch["computeEnv"]["id"],
+        "pipeline": launch["pipeline"],
+        "workDir": launch.get("workDir"),
+        "revision": launch.get("revision"),
+        "configProfiles": launch.get("configProfiles"),
+        "configText": launch.get("configText"),
+        "preRunScript": launch.get("preRunScript"),
+        "postRunScript": launch.get("postRunScript"),
+        "mainScript": launch.get("mainScript"),
+        "entryName": launch.get("entryName"),
+        "schemaName": launch.get("schemaName"),
+        "pullLatest": launch.get("pullLatest"),
+        "stubRun": launch.get("stubRun"),
+        "paramsText": json.dumps(params),
+    }
+    launch_request = {k: v for k, v in launch_request.items() if v is not None}
+
+    return invoke_tower_api(
+        method="POST",
+        path="/workflow/launch",
+        tw_params=tw_params,
+        query={"workspaceId": workspace_id},
+        payload={"launch": launch_request},
+        errorstring=errorstring,
+        retry_transaction=retry_transaction,
+    )
+
+
+def resolve_pipeline_id(
+    workspace_id=None, pipeline_name=None, tw_params=None, errorstring=None
+):
+    """
+    Look up a Launchpad pipeline's ID from its name and add it to the in-container index.
+    """
+    result = invoke_tower_api(
+        method="GET",
+        path="/pipelines",
+        tw_params=tw_params,
+        query={"workspaceId": workspace_id, "search": pipeline_name},
+        errorstring=errorstring,
+        retry_transaction=True,
+    )
+    matches = [p for p in result.get("pipelines", []) if p["name"] == pipeline_name]
+    if not matches:
+        # Pipeline isn't defined in the workspace. Retrying won't change that. Do not retry.
+        log_error_and_raise_exception(
+            errorstring=f"Pipeline {pipeline_name} not found in workspace {workspace_id}.",
+            e=None,
+            retry_transaction=False,
+        )
+    pipelineid = matches[0]["pipelineId"]
+    cache_tower_id(
+        kind="pipelines",
+        workspace_id=workspace_id,
+        name=pipeline_name,
+        value=pipelineid,
+    )
+
+    return pipelineid
+
+
+def is_tower_authentication_error(output=None):
+    """
+    Check tw output for signs that Tower rejected the access token: a `401`/`403` status (see TW_ERROR_STATUS)
+    or its reason phrase.
+    """
+    if not output:
+        return False
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", errors="replace")
+
+    if get_tw_error_statuses(output) & {401, 403}:
+        return True
+
+    output = output.lower()
+    auth_markers = ["unauthorized", "forbidden", "access token"]
+    return any(marker in output for marker in auth_markers)
+
+
+def is_tower_name_conflict(output=None):
+    """
+    Check Tower's error output (tw stderr or an API response body) for a rejected duplicate name: a `409`
+    status (see TW_ERROR_STATUS) or Tower's message for it.
+    """
+    if not output:
+        return False
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", errors="replace")
+
+    if 409 in get_tw_error_statuses(output):
+        return True
+
+    output = output.lower()
+    conflict_markers = ["already exists", "duplicated element"]
+    return any(marker in output for marker in conflict_markers)
+
+
+def get_tw_error_statuses(output=None):
+    """
+    Return the HTTP statuses reported in tw's error output (see TW_ERROR_STATUS).
+    """
+    return {
+        int(bracketed or status)
+        for status, bracketed in TW_ERROR_STATUS.findall(output)
+    }
+
+
+def is_tower_transient_error(output=None):
+    """
+    Check tw output for signs of a failure that may clear up on its own: Tower unreachable (the JVM's network
+    exception messages), overloaded or returning a server error (`429` or `5xx`, as a status or reason phrase).
+    """
+    if not output:
+        return False
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", errors="replace")
+
+    if any(status == 429 or status >= 500 for status in get_tw_error_statuses(output)):
+        return True
+
+    output = output.lower()
+    transient_markers = [
+        "connection refused",
+        "connection reset",
+        "connect timed out",
+        "read timed out",
+        "unknownhostexception",
+        "sockettimeoutexception",
+        "too many requests",
+        "internal server error",
+        "bad gateway",
+        "service unavailable",
+        "gateway timeout",
+    ]
+    return any(marker in output for marker in transient_markers)
+
+
+def log_error_and_raise_exception(errorstring=None, e=None, retry_transaction=True):
+    """
+    This function is used to capture the reasons for why the Lambda code ceased prematurely.
+    Can be triggered for two reasons:
+        1) Actual programming exception which was not properly handled.
+        2) Deliberate invocation when evaluation logic determines the event is OOS and should be ignored.
+
+    Lambda retry logic is powerful and we want to leverage it for handling event like networking hiccups that could
+    cause a transaction to fail, but we don't want to retry events that we failed on purpose (e.g. because
+    the file type was wrong and indicated the file was not a sample sheet).
+
+    The handler function has been configured to return when it detects a CeaseEventProcessing exception
+    (ending the event processing cleanly and not triggering a Lambda retry), but will return a generic
+    Exception in any other case, which will cause Lambda to retry the event.
+    """
+    logger.debug(f"[EXCEPTION]: {errorstring}")
+    if e:
+        logger.debug(f"{e}")
+
+    if retry_transaction:
+        raise Exception("Transaction failed but may succeed on retry. Retrying.")
+    else:
+        raise CeaseEventProcessing("Transaction ceased deliberately. Do not retry.")
+
+
+def update_logging_level(desired_level=None):
+    """
+    Change logger level without requiring deployment of new image.
+    """
+    log_levels = ["DEBUG", "INFO", "WARN", "ERROR", "CRITICAL"]
+    desired_level = desired_level.upper()
+
+    if desired_level in log_levels:
+        logger.setLevel(desired_level)
+        logger.warning(f"Modified logging level to {desired_level}")
+    else:
+        # Create logger alert and stick with default DEBUG
+        logger.error(
+            f"SSM parameter 'lambda_tutorial/logging_level' value {desired_level} is not a valid logging level. Continuing with DEBUG."
+        )
+
+
+def get_idempotency_key(record=None):
+    """
+    Build the idempotency key for an event record from its bucket, key, eTag and sequencer.
+    Duplicate notifications for the same upload share all four values; a new upload of the same key
+    gets a new sequencer (and usually a new eTag).
+    """
+    s3 = record["s3"]
+    return ":".join(
+        [
+            s3["bucket"]["name"],
+            s3["object"]["key"],
+            s3["object"].get("eTag", ""),
+            s3["object"].get("sequencer", ""),
+        ]
+    )
+
+
+def get_claim_expiry(context=None):
+    """
+    Return when claims taken during an invocation expire (epoch seconds): IDEMPOTENCY_CLAIM_MARGIN seconds after
+    the Lambda invocation would time out. Lambda's retries of a timed-out invocation then find its claims gone
+    rather than in progress. Returns None without a context (worker, local runs), where claims last
+    IDEMPOTENCY_CLAIM_TTL seconds instead.
+    """
+    if context is None:
+        return None
+    return (
+        time.time()
+        + context.get_remaining_time_in_millis() / 1000
+        + IDEMPOTENCY_CLAIM_MARGIN
+    )
+
+
+def get_idempotency_store(session=None, tw_params=None):
+    """
+    Return the idempotency store configured by the `idempotency_store` SSM parameter, or None if disabled.
+    Supported values:
+        - `none`: Disabled (default).
+        - `sqlite:<path>`: Local SQLite database (e.g. `sqlite:/tmp/idempotency.db`). For local runs and tests.
+        - `dynamodb:<table>`: DynamoDB table with a string partition key named `idempotency_key`.
+    The store is created once per container and reused while the parameter value is unchanged.
+    """
+    spec = tw_params.get("/lambda_tutorial/idempotency_store", "none").strip()
+    if spec.lower() == "none":
+        return None
+
+    with _idempotency_lock:
+        if _idempotency_store["spec"] == spec:
+            return _idempotency_store["store"]
+
+        backend, _, location = spec.partition(":")
+        backend = backend.lower()
+        if backend == "sqlite":
+            store = SqliteIdempotencyStore(path=location)
+        elif backend == "dynamodb":
+            dynamodb_client = get_client(session=session, service_name="dynamodb")
+            store = DynamoDbIdempotencyStore(
+                client=dynamodb_client, table_name=location
+            )
+        else:
+            # Misconfiguration will not fix itself on retry. Do not retry.
+            log_error_and_raise_exception(
+                errorstring=f"Unsupported idempotency store: {spec}",
+                e=None,
+                retry_transaction=False,
+            )
+
+        _idempotency_store["spec"] = spec
+        _idempotency_store["store"] = store
+
+    return store
+
+
+class SqliteIdempotencyStore:
+    """
+    Idempotency store backed by a local SQLite database. Each completed stage is a row, and each claimed
+    record a row of `idempotency_claims`.
+    """
+
+    def __init__(self, path=None):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Imported lazily since only this store needs it. Keeps it off the cold-start path.
+        import sqlite3
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency ("
+                "idempotency_key TEXT, stage TEXT, outputs TEXT, updated_at REAL, "
+                "PRIMARY KEY (idempotency_key, stage))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency_claims ("
+                "idempotency_key TEXT PRIMARY KEY, owner TEXT, expires_at REAL)"
+            )
+
+    def _read_stages(self, idempotency_key):
+        rows = self._connection.execute(
+            "SELECT stage, outputs FROM idempotency WHERE idempotency_key = ?",
+            (idempotency_key,),
+        ).fetchall()
+        return {stage: json.loads(outputs) for stage, outputs in rows}
+
+    def get_stages(self, idempotency_key):
+        with self._lock:
+            return self._read_stages(idempotency_key)
+
+    def claim(self, idempotency_key, owner, expires_at):
+        """
+        Claim the record for `owner` until `expires_at` (epoch seconds). Returns its stages as recorded when
+        claimed, or None if another delivery holds an unexpired claim.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            claimed = self._connection.execute(
+                "INSERT OR IGNORE INTO idempotency_claims VALUES (?, ?, ?)",
+                (idempotency_key, owner, expires_at),
+            ).rowcount
+            if not claimed:
+                # Take over a claim left behind by a delivery that never released it.
+                claimed = self._connection.execute(
+                    "UPDATE idempotency_claims SET owner = ?, expires_at = ? "
+                    "WHERE idempotency_key = ? AND expires_at < ?",
+                    (owner, expires_at, idempotency_key, now),
+                ).rowcount
+            if not claimed:
+                return None
+            return self._read_stages(idempotency_key)
+
+    def release(self, idempotency_key, owner):
+        try:
+            with self._lock, self._connection:
+                self._connection.execute(
+                    "DELETE FROM idempotency_claims WHERE idempotency_key = ? AND owner = ?",
+                    (idempotency_key, owner),
+                )
+        except Exception as e:
+            # The claim expires by itself. A failed release only delays a redelivery.
+            logger.warning(f"Could not release claim on {idempotency_key}: {e}")
+
+    def put_stage(self, idempotency_key, stage, outputs):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO idempotency VALUES (?, ?, ?, ?)",
+                (idempotency_key, stage, json.dumps(outputs), time.time()),
+            )
+
+
+class DynamoDbIdempotencyStore:
+    """
+    Idempotency store backed by a DynamoDB table. Each item holds one attribute per completed stage
+    (JSON-encoded outputs) plus an `expires_at` epoch which can be used as the table's TTL attribute.
+    A claimed record also holds `claim_owner` and `claim_expires_at`.
+    """
+
+    def __init__(self, client=None, table_name=None):
+        self._client = client
+        self._table_name = table_name
+
+    def get_stages(self, idempotency_key):
+        try:
+            response = self._client.get_item(
+                TableName=self._table_name,
+                Key={"idempotency_key": {"S": idempotency_key}},
+                ConsistentRead=True,
+            )
+        except Exception as e:
+            # Transaction may have failed due to networking. Retryable.
+            log_error_and_raise_exception(
+                errorstring=f"Could not read idempotency record {idempotency_key}.",
+                e=e,
+                retry_transaction=True,
+            )
+
+        return self._stages(response.get("Item", {}))
+
+    @staticmethod
+    def _stages(item):
+        return {
+            name: json.loads(value["S"])
+            for name, value in item.items()
+            if name in IDEMPOTENCY_STAGES
+        }
+
+    def claim(self, idempotency_key, owner, expires_at):
+        """
+        Claim the record for `owner` until `expires_at` (epoch seconds) with a conditional write. Returns its
+        stages as recorded when claimed, or None if another delivery holds an unexpired claim.
+        """
+        now = int(time.time())
+        try:
+            response = self._client.update_item(
+                TableName=self._table_name,
+                Key={"idempotency_key": {"S": idempotency_key}},
+                UpdateExpression="SET claim_owner = :owner, claim_expires_at = :claim_expires_at, "
+                "expires_at = :expires_at",
+                ConditionExpression="attribute_not_exists(claim_owner) OR claim_expires_at < :now",
+                ExpressionAttributeValues={
+                    ":owner": {"S": owner},
+                    ":claim_expires_at": {"N": str(int(expires_at))},
+                    ":expires_at": {"N": str(now + IDEMPOTENCY_RETENTION)},
+                    ":now": {"N": str(now)},
+                },
+                ReturnValues="ALL_NEW",
+            )
+        except self._client.exceptions.ConditionalCheckFailedException:
+            return None
+        except Exception as e:
+            # Transaction may have failed due to networking. Retryable.
+            log_error_and_raise_exception(
+                errorstring=f"Could not claim idempotency record {idempotency_key}.",
+                e=e,
+                retry_transaction=True,
+            )
+
+        return self._stages(response["Attributes"])
+
+    def release(self, idempotency_key, owner):
+        try:
+            self._client.update_item(
+                TableName=self._table_name,
+                Key={"idempotency_key": {"S": idempotency_key}},
+                UpdateExpression="REMOVE claim_owner, claim_expires_at",
+                ConditionExpression="claim_owner = :owner",
+                ExpressionAttributeValues={":owner": {"S": owner}},
+            )
+        except Exception as e:
+            # The claim expires by itself. A failed release only delays a redelivery.
+            logger.warning(f"Could not release claim on {idempotency_key}: {e}")
+
+    def put_stage(self, idempotency_key, stage, outputs):
+        try:
+            self._client.update_item(
+                TableName=self._table_name,
+                Key={"idempotency_key": {"S": idempotency_key}},
+                UpdateExpression="SET #stage = :outputs, expires_at = :expires_at",
+                ExpressionAttributeNames={"#stage": stage},
+                ExpressionAttributeValues={
+                    ":outputs": {"S": json.dumps(outputs)},
+                    ":expires_at": {"N": str(int(time.time()) + IDEMPOTENCY_RETENTION)},
+                },
+            )
+        except Exception as e:
+            # Transaction may have failed due to networking. Retryable.
+            log_error_and_raise_exception(
+                errorstring=f"Could not record stage {stage} for {idempotency_key}.",
+                e=e,
+                retry_transaction=True,
+            )
+
+
+def process_record(
+    session=None,
+    record=None,
+    tw_params=None,
+    tower_credentials=None,
+    claim_expires_at=None,
+):
+    """
+    Download a single in-scope record's samplesheet, push it to Tower as a new dataset and launch the
+    target pipeline. Exceptions are captured rather than raised so that one failing record doesn't abort
+    the others being processed from the same event.
+
+    When an idempotency store is configured, each completed stage is recorded against the object's
+    bucket/key/eTag/sequencer. A duplicate notification for a fully-processed object returns immediately,
+    and a retried event resumes at the stage that failed. The record is claimed before any Tower call, so a
+    duplicate that arrives while another delivery is still processing it is retried rather than run twice.
+    The claim expires at `claim_expires_at` (see `get_claim_expiry`), or after IDEMPOTENCY_CLAIM_TTL seconds.
+
+    When the target pipeline has a samplesheet schema (see `get_samplesheet_schema`), the samplesheet is validated
+    before anything is created in Tower, and one that fails is ceased with its row-level errors in the result.
+
+    When sharding is enabled (see `get_sharding_config`) and the samplesheet splits into more than one shard,
+    each shard becomes its own dataset and pipeline run, and the result carries a `shards` manifest.
+
+    `tower_credentials` is an optional future for `prepare_tower_credentials` running concurrently (see
+    CONCURRENT_STAGES). The S3 transfer overlaps with it, and the record waits for it before any Tower call.
+    """
+    claim_owner = None
+    try:
+        store = get_idempotency_store(session=session, tw_params=tw_params)
+        idempotency_key = get_idempotency_key(record=record)
+        stages = store.get_stages(idempotency_key) if store else {}
+
+        if store and "pipeline_launched" not in stages:
+            # Stages are read again under the claim: a concurrent delivery may have completed in between.
+            claim_owner = uuid.uuid4().hex
+            stages = store.claim(
+                idempotency_key,
+                claim_owner,
+                expires_at=claim_expires_at or time.time() + IDEMPOTENCY_CLAIM_TTL,
+            )
+            if stages is None:
+                claim_owner = None
+                logger.debug(
+                    f"Record {idempotency_key} is being processed by another delivery. Retrying."
+                )
+                return record_result(record=record, status="retry", in_progress=True)
+
+        if "pipeline_launched" in stages:
+            logger.debug(f"Record {idempotency_key} already processed. Skipping.")
+            return record_result(
+                record=record,
+                status="completed",
+                duplicate=True,
+                **stages.get("dataset_created", {}),
+                **stages.get("dataset_url", {}),
+                **stages["pipeline_launched"],
+            )
+
+        local_samplesheet, samplesheet_stream, dataset_name = None, None, None
+        downloaded_samplesheet, streamed_body = None, None
+        sharding_config, shard_dir = None, None
+        try:
+            if "dataset_created" in stages:
+                logger.debug(f"Resuming record {idempotency_key}.")
+            else:
+                # Retrieve the file from S3 (download to /tmp or stream) and push to Tower as a new dataset
+                if samplesheet_transfer_mode(tw_params=tw_params) == "stream":
+                    samplesheet_stream, dataset_name = stream_samplesheet(
+                        session=session, record=record
+                    )
+                    streamed_body = samplesheet_stream["body"]
+                else:
+                    local_samplesheet, dataset_name = download_samplesheet(
+                        session=session, record=record
+                    )
+                    downloaded_samplesheet = local_samplesheet
+
+                schema = get_samplesheet_schema(tw_params=tw_params)
+                if schema is not None:
+                    spool = None
+                    if samplesheet_stream is not None and samplesheet_stream["body"]:
+                        # The S3 stream can only be read once. Keep a copy while validating and publish that.
+                        spool = (
+                            _workspace.scratch_dir() / samplesheet_stream["filename"]
+                        )
+                        downloaded_samplesheet = spool.as_posix()
+                    report = validate_samplesheet(
+                        local_samplesheet=local_samplesheet,
+                        samplesheet_stream=samplesheet_stream,
+                        schema=schema,
+                        spool=spool,
+                    )
+                    if spool is not None:
+                        local_samplesheet, samplesheet_stream = spool.as_posix(), None
+                    if report["error_count"]:
+                        # Fixing the samplesheet means uploading a new one. Do not retry.
+                        logger.error(
+                            f"Samplesheet {record['s3']['object']['key']} failed validation with "
+                            f"{report['error_count']} error(s): {report['errors'][:5]}"
+                        )
+                        return record_result(
+                            record=record, status="ceased", validation=report
+                        )
+
+                sharding_config = get_sharding_config(tw_params=tw_params)
+                if sharding_config:
+                    shard_dir, shards = split_samplesheet(
+                        local_samplesheet=local_samplesheet,
+                        samplesheet_stream=samplesheet_stream,
+                        dataset_name=dataset_name,
+                        sharding_config=sharding_config,
+                    )
+                    if len(shards) > 1:
+                        wait_for_tower_credentials(tower_credentials=tower_credentials)
+                        manifest = publish_shards(
+                            shards=shards,
+                            record=record,
+                            tw_params=tw_params,
+                            store=store,
+                            idempotency_key=idempotency_key,
+                            max_concurrency=sharding_config["max_concurrency"],
+                        )
+                        if store:
+                            store.put_stage(
+                                idempotency_key,
+                                "pipeline_launched",
+                                {"shards": manifest},
+                            )
+                        return record_result(
+                            record=record, status="completed", shards=manifest
+                        )
+
+                    # Samplesheet fits in a single shard (or has no rows). The S3 stream has been consumed by
+                    # the split, so publish the shard's copy under the original dataset name.
+                    local_samplesheet, samplesheet_stream = (
+                        shards[0]["local_samplesheet"],
+                        None,
+                    )
+
+            wait_for_tower_credentials(tower_credentials=tower_credentials)
+            outputs = publish_samplesheet(
+                local_samplesheet=local_samplesheet,
+                samplesheet_stream=samplesheet_stream,
+                dataset_name=dataset_name,
+                record=record,
+                tw_params=tw_params,
+                store=store,
+                idempotency_key=idempotency_key,
+                stages=stages,
+            )
+        finally:
+            # An S3 body is only closed once fully read. Close it (and return its connection to the pool) if a
+            # Tower call failed first.
+            if streamed_body is not None:
+                streamed_body.close()
+            _workspace.release(path=shard_dir)
+            # Removes a per-record download, or lets a cached one be evicted again.
+            _workspace.release(path=downloaded_samplesheet)
+
+        return record_result(record=record, status="completed", **outputs)
+
+    except CeaseEventProcessing:
+        # Record was terminated on purpose. Do not retry.
+        return record_result(record=record, status="ceased")
+
+    except Exception as e:
+        # Anything else may succeed if Lambda retries the event.
+        logger.debug(f"Record failed with retryable error: {e}")
+        return record_result(record=record, status="retry")
+
+    finally:
+        # Completed stages are recorded, so a later delivery that claims the record picks up where this one stopped.
+        if claim_owner is not None:
+            store.release(idempotency_key, claim_owner)
+
+
+def publish_samplesheet(
+    local_samplesheet=None,
+    samplesheet_stream=None,
+    dataset_name=None,
+    record=None,
+    tw_params=None,
+    store=None,
+    idempotency_key=None,
+    stages=None,
+):
+    """
+    Push a samplesheet to Tower as a dataset (or a new version of an existing one) and launch the target
+    pipeline with it, skipping any stage already recorded in `stages`. Each completed stage is recorded in the idempotency store (if any).
+    Returns the dataset ID, dataset URL and workflow ID.
+    """
+    if "dataset_created" in stages:
+        datasetid = stages["dataset_created"]["datasetId"]
+        logger.debug(f"Resuming {idempotency_key} with dataset {datasetid}.")
+    else:
+        datasetid, dataset_url = create_tower_dataset(
+            local_samplesheet=local_samplesheet,
+            samplesheet_stream=samplesheet_stream,
+            dataset_name=dataset_name,
+            record=record,
+            tw_params=tw_params,
+        )
+        if store:
+            store.put_stage(
+                idempotency_key, "dataset_created", {"datasetId": datasetid}
+            )
+        # The API client gets the URL from the upload response. Record it as if looked up separately.
+        if dataset_url is not None:
+            if store:
+                store.put_stage(
+                    idempotency_key, "dataset_url", {"datasetUrl": dataset_url}
+                )
+            stages = {**stages, "dataset_url": {"datasetUrl": dataset_url}}
+
+    if "dataset_url" in stages:
+        dataset_url = stages["dataset_url"]["datasetUrl"]
+    else:
+        dataset_url = get_dataset_url(datasetid=datasetid, tw_params=tw_params)
+        if store:
+            store.put_stage(idempotency_key, "dataset_url", {"datasetUrl": dataset_url})
+
+    # Invoke a pre-existing pipeline with the newly-created dataset.
+    # Only retryable if a rerun will resume here rather than try to recreate the dataset.
+    launch = launch_tower_pipeline(
+        datasetid=datasetid,
+        tw_params=tw_params,
+        dataset_url=dataset_url,
+        retry_transaction=store is not None,
+    )
+    launch_outputs = {"workflowId": launch.get("workflowId")}
+    if store:
+        store.put_stage(idempotency_key, "pipeline_launched", launch_outputs)
+
+    return {"datasetId": datasetid, "datasetUrl": dataset_url, **launch_outputs}
+
+
+def get_samplesheet_schema(tw_params=None):
+    """
+    Return the compiled schema the record's target pipeline validates samplesheets against, or None if it has
+    none. Schemas are compiled only when the `samplesheet_schema` SSM parameter changes.
+
+    The parameter is one of:
+        1) A column list applied to every pipeline, e.g. `sample,fastq_1,fastq_2,strandedness`;
+        2) A JSON schema applied to every pipeline (see `compile_samplesheet_schema`);
+        3) A JSON object mapping pipeline names to either of the above, with `*` matching any other pipeline:
+            {"nf-core-rnaseq": {"columns": ["sample", "fastq_1", "fastq_2", "strandedness"], ...},
+             "*": "sample,fastq_1,fastq_2"}
+    An empty parameter (default) disables validation.
+    """
+    source = tw_params.get("/lambda_tutorial/samplesheet_schema", "").strip()
+
+    with _schema_lock:
+        if _schema_cache["source"] != source:
+            try:
+                if not source:
+                    schemas = {}
+                elif source.startswith("{"):
+                    document = json.loads(source)
+                    if "columns" in document:
+                        schemas = {"*": compile_samplesheet_schema(schema=document)}
+                    else:
+                        schemas = {
+                            pipeline: compile_samplesheet_schema(schema=schema)
+                            for pipeline, schema in document.items()
+                        }
+                else:
+                    schemas = {"*": compile_samplesheet_schema(schema=source)}
+
+            except Exception as e:
+                # A malformed schema will not fix itself on retry. Do not retry.
+                log_error_and_raise_exception(
+                    errorstring="Failed to compile samplesheet schema.",
+                    e=e,
+                    retry_transaction=False,
+                )
+
+            logger.debug(f"Compiled {len(schemas)} samplesheet schema(s).")
+            _schema_cache["schemas"] = schemas
+            _schema_cache["source"] = source
+
+        schemas = _schema_cache["schemas"]
+
+    pipeline = tw_params["/lambda_tutorial/target_pipeline_name"]
+    return schemas.get(pipeline, schemas.get("*"))
+
+
+def compile_samplesheet_schema(schema=None):
+    """
+    Normalise a schema given as a column list or as a JSON object:
+        {"columns": ["sample", "fastq_1", "fastq_2", "strandedness"],
+         "required": ["sample", "fastq_1"],
+         "unique": ["sample"],
+         "uri_columns": ["fastq_1", "fastq_2"],
+         "enums": {"strandedness": ["auto", "forward", "reverse", "unstranded"]},
+         "allow_extra_columns": false}
+    Only `columns` is mandatory. `required` (may not be empty) and `unique` (may not repeat, combined if more
+    than one column) default to the first column. Without `uri_columns`, any column holding a `://` value is
+    checked as URIs. Empty values are only rejected by `required`.
+    A column can list its allowed values after `=`, separated by `|`, which is the only way to set them in the
+    column list form: `sample,fastq_1,fastq_2,strandedness=auto|forward|reverse|unstranded`. `enums` takes
+    precedence.
+    """
+    if isinstance(schema, str):
+        schema = {"columns": schema.split(",")}
+
+    def column_list(value):
+        if isinstance(value, str):
+            value = value.split(",")
+        return [column.strip() for column in value if column.strip()]
+
+    columns = []
+    enums = {}
+    for entry in column_list(schema["columns"]):
+        column, equals, values = entry.partition("=")
+        columns.append(column.strip())
+        if equals:
+            enums[column.strip()] = values.split("|")
+    enums.update(schema.get("enums", {}))
+    if not columns:
+        raise ValueError("Samplesheet schema has no columns.")
+
+    compiled = {
+        "columns": columns,
+        "required": column_list(schema.get("required", columns[:1])),
+        "unique": column_list(schema.get("unique", columns[:1])),
+        "uri_columns": (
+            column_list(schema["uri_columns"]) if "uri_columns" in schema else None
+        ),
+        "enums": {
+            column: frozenset(column_list(values)) for column, values in enums.items()
+        },
+        "allow_extra_columns": bool(schema.get("allow_extra_columns", False)),
+    }
+
+    referenced = (
+        compiled["required"]
+        + compiled["unique"]
+        + (compiled["uri_columns"] or [])
+        + list(compiled["enums"])
+    )
+    unknown = sorted(set(referenced) - set(columns))
+    if unknown:
+        raise ValueError(f"Samplesheet schema refers to unknown column(s) {unknown}.")
+
+    return compiled
+
+
+@timed_stage(stage="validate_samplesheet")
+def validate_samplesheet(
+    local_samplesheet=None, samplesheet_stream=None, schema=None, spool=None
+):
+    """
+    Check the samplesheet against `schema` in a single streamed pass: header columns, field counts, required
+    values, duplicate IDs, URI syntax and allowed enum values. Rows are checked VALIDATION_BLOCK_ROWS at a time,
+    a column at a time, so a clean block costs a few C-level passes per column rather than Python work per
+    value; only a block that fails a check is walked row by row to report its errors. Memory use is bounded by
+    the chunk and block sizes and the set of IDs seen so far.
+
+    Without `uri_columns` in the schema, every non-empty value in a column that holds a `://` value anywhere in
+    the samplesheet is checked as a URI, including values in rows before the first one that did.
+
+    If `spool` is set, the bytes read are also written to that path, so a one-shot S3 stream can still be
+    published after it has been validated.
+    Returns {'rows', 'error_count', 'errors'}, where `errors` holds the first VALIDATION_MAX_ERRORS messages by row.
+    Rows are numbered from the line after the header, e.g. "row 12: duplicate sample 'WT_REP1' (first seen in row 3)".
+    """
+    # Imported lazily since only validation needs it. Keeps it off the cold-start path.
+    import csv
+
+    samplesheet_filename = (
+        pathlib.Path(local_samplesheet).name
+        if samplesheet_stream is None
+        else samplesheet_stream["filename"]
+    )
+    delimiter = "\t" if samplesheet_filename.rpartition(".")[2] == "tsv" else ","
+
+    # (row number, message) pairs. Blocks are checked a column at a time, so errors are sorted by row and
+    # trimmed to VALIDATION_MAX_ERRORS after each block rather than kept in the order found.
+    errors = []
+    error_count = 0
+    rows, row_number = 0, 0
+
+    def add_error(row_number, message):
+        nonlocal error_count
+        error_count += 1
+        errors.append((row_number, message))
+
+    def trim_errors():
+        if len(errors) > VALIDATION_MAX_ERRORS:
+            errors.sort(key=lambda error: error[0])
+            del errors[VALIDATION_MAX_ERRORS:]
+
+    def tee(chunks, f):
+        for chunk in chunks:
+            f.write(chunk)
+            yield chunk
+
+    # Samplesheets tend to point into a handful of buckets, so a block's URI column passes if it has no whitespace
+    # and every value starts with a `scheme://host/` prefix already validated. Otherwise its values are checked
+    # one at a time, and a new prefix goes through the regex.
+    uri_syntax = re.compile(r"([A-Za-z][A-Za-z0-9+.-]*://[^/]+/).*").fullmatch
+    uri_prefixes = ()
+
+    spool_file = open(spool, "wb") if spool is not None else None
+    try:
+        if samplesheet_stream is None:
+            text = open(local_samplesheet, encoding="utf-8-sig", newline="")
+        else:
+            chunks = iter_samplesheet_chunks(samplesheet_stream=samplesheet_stream)
+            if spool_file is not None:
+                chunks = tee(chunks, spool_file)
+            text = io.TextIOWrapper(
+                io.BufferedReader(ChunkReader(chunks=chunks), STREAM_CHUNK_SIZE),
+                encoding="utf-8-sig",
+                newline="",
+            )
+
+        with text:
+            reader = csv.reader(text, delimiter=delimiter)
+            header = [column.strip() for column in next(reader, [])]
+
+            missing = [c for c in schema["columns"] if c not in header]
+            if missing:
+                add_error(0, f"header is missing column(s) {missing}")
+            repeated = sorted({c for c in header if header.count(c) > 1})
+            if repeated:
+                add_error(0, f"header repeats column(s) {repeated}")
+            if not schema["allow_extra_columns"]:
+                extra = [c for c in header if c not in schema["columns"]]
+                if extra:
+                    add_error(0, f"header has unexpected column(s) {extra}")
+            if error_count:
+                # Row checks are meaningless without the expected columns.
+                return {
+                    "rows": 0,
+                    "error_count": error_count,
+                    "errors": [message for _, message in errors],
+                }
+
+            index = {column: i for i, column in enumerate(header)}
+            field_count = len(header)
+            required = [(index[c], c) for c in schema["required"]]
+            unique = [index[c] for c in schema["unique"]]
+            unique_name = "/".join(schema["unique"])
+            enums = [
+                (index[c], c, allowed, sorted(allowed))
+                for c, allowed in schema["enums"].items()
+            ]
+            # IDs seen so far. Until the first duplicate only a set is kept, plus each block's IDs (references to
+            # strings already held) to look up the first row of a duplicate in; after it, IDs are mapped to rows.
+            seen = set()
+            seen_blocks = []
+            first_rows = None
+            if schema["uri_columns"] is None:
+                uri_columns = []
+                # Columns without a `://` value so far -> [non-empty values, first VALIDATION_MAX_ERRORS of them
+                # as (row number, value)]. They become errors if a later value in the column turns out to be a URI.
+                uri_candidates = {i: [0, []] for i in range(field_count)}
+            else:
+                uri_columns = [(index[c], c) for c in schema["uri_columns"]]
+                uri_candidates = {}
+
+            def check_block(numbers, block):
+                nonlocal error_count, uri_prefixes, first_rows
+                columns = list(zip(*block))
+
+                for i, column in required:
+                    if "" in columns[i]:
+                        for number, value in zip(numbers, columns[i]):
+                            if not value:
+                                add_error(number, f"{column} is empty")
+
+                if unique:
+                    keys = (
+                        columns[unique[0]]
+                        if len(unique) == 1
+                        else list(zip(*(columns[i] for i in unique)))
+                    )
+                    if first_rows is None:
+                        size = len(seen)
+                        seen.update(keys)
+                        if len(seen) == size + len(keys):
+                            seen_blocks.append((numbers, keys))
+                        else:
+                            first_rows = {}
+                            for block_numbers, block_keys in seen_blocks:
+                                first_rows.update(zip(block_keys, block_numbers))
+                            seen.clear()
+                            seen_blocks.clear()
+                    if first_rows is not None:
+                        block_first_rows = list(
+                            map(first_rows.setdefault, keys, numbers)
+                        )
+                        for number, first_row, key in zip(
+                            numbers, block_first_rows, keys
+                        ):
+                            if first_row != number:
+                                add_error(
+                                    number,
+                                    f"duplicate {unique_name} {key!r} (first seen in row {first_row})",
+                                )
+
+                for i in list(uri_candidates):
+                    values = columns[i]
+                    if "://" not in "\x00".join(values):
+                        candidate = uri_candidates[i]
+                        candidate[0] += len(values) - values.count("")
+                        if len(candidate[1]) < VALIDATION_MAX_ERRORS:
+                            candidate[1].extend(
+                                (number, value)
+                                for number, value in zip(numbers, values)
+                                if value
+                            )
+                            del candidate[1][VALIDATION_MAX_ERRORS:]
+                        continue
+                    # The column holds URIs after all, so its earlier values should have been URIs too.
+                    count, samples = uri_candidates.pop(i)
+                    for number, value in samples:
+                        add_error(number, f"{header[i]} is not a URI: {value!r}")
+                    error_count += count - len(samples)
+                    uri_columns.append((i, header[i]))
+
+                for i, column in uri_columns:
+                    values = columns[i]
+                    joined = "\x00".join(values)
+                    if joined.split() == [joined] and all(
+                        map(
+                            str.startswith,
+                            filter(None, values),
+                            itertools.repeat(uri_prefixes),
+                        )
+                    ):
+                        continue
+                    for number, value in zip(numbers, values):
+                        if not value:
+                            continue
+                        if value.split() == [value]:
+                            if value.startswith(uri_prefixes):
+                                continue
+                            match = uri_syntax(value)
+                            if match is not None:
+                                if len(uri_prefixes) < 64:
+                                    uri_prefixes += (match.group(1),)
+                                continue
+                        add_error(number, f"{column} is not a URI: {value!r}")
+
+                for i, column, allowed, listed in enums:
+                    unexpected = set(columns[i]).difference(allowed)
+                    unexpected.discard("")
+                    if unexpected:
+                        for number, value in zip(numbers, columns[i]):
+                            if value in unexpected:
+                                add_error(
+                                    number, f"{column} {value!r} is not one of {listed}"
+                                )
+
+            failure = None
+            while failure is None:
+                block = []
+                try:
+                    for row in itertools.islice(reader, VALIDATION_BLOCK_ROWS):
+                        block.append(row)
+                except (csv.Error, UnicodeDecodeError) as e:
+                    # Check the rows read before the failure, then report it.
+                    failure = e
+                if not block:
+                    break
+
+                numbers = range(row_number + 1, row_number + len(block) + 1)
+                row_number += len(block)
+                if set(map(len, block)) != {field_count}:
+                    # Blank lines (empty rows) are skipped silently. Other rows with the wrong number of
+                    # fields are reported and skipped.
+                    kept = []
+                    for number, row in zip(numbers, block):
+                        if len(row) == field_count:
+                            kept.append((number, row))
+                        elif row:
+                            add_error(
+                                number,
+                                f"expected {field_count} fields, found {len(row)}",
+                            )
+                    numbers = [number for number, _ in kept]
+                    block = [row for _, row in kept]
+                if block:
+                    rows += len(block)
+                    check_block(numbers, block)
+                trim_errors()
+
+            if isinstance(failure, csv.Error):
+                add_error(row_number + 1, f"unparseable row ({failure})")
+            elif failure is not None:
+                raise failure
+
+    except UnicodeDecodeError:
+        add_error(0, "samplesheet is not UTF-8 text")
+
+    finally:
+        if spool_file is not None:
+            spool_file.close()
+
+    errors.sort(key=lambda error: error[0])
+    logger.debug(
+        f"Validated {rows} row(s) of {samplesheet_filename}: {error_count} error(s)."
+    )
+    return {
+        "rows": rows,
+        "error_count": error_count,
+        "errors": [
+            f"row {number}: {message}" if number else message
+            for number, message in errors[:VALIDATION_MAX_ERRORS]
+        ],
+    }
+
+
+def get_sharding_config(tw_params=None):
+    """
+    Return the sharding settings, or None if sharding is disabled. Configured with SSM parameters:
+        - shard_size: Maximum rows per shard. `0` (default) disables sharding.
+        - shard_group_column: Column whose rows must stay in the same shard (e.g. `sample`). Optional.
+        - shard_max_concurrency: Maximum shards created/launched at the same time.
+    """
+    try:
+        shard_size = int(tw_params.get("/lambda_tutorial/shard_size", "0"))
+        max_concurrency = int(
+            tw_params.get("/lambda_tutorial/shard_max_concurrency", "4")
+        )
+    except ValueError as e:
+        # Misconfiguration will not fix itself on retry. Do not retry.
+        log_error_and_raise_exception(
+            errorstring="Invalid sharding configuration.", e=e, retry_transaction=False
+        )
+
+    if shard_size <= 0:
+        return None
+
+    return {
+        "shard_size": shard_size,
+        "group_column": tw_params.get(
+            "/lambda_tutorial/shard_group_column", ""
+        ).strip(),
+        "max_concurrency": max(1, max_concurrency),
+    }
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    Minimal read-only file object over an iterator of byte chunks, so `csv` can consume a
+    samplesheet as it is streamed.
+    """
+
+    def __init__(self, chunks=None):
+        self._chunks = chunks
+        self._buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        # Slicing the memoryview rather than the chunk avoids copying the rest of the chunk on every read.
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def split_samplesheet(
+    local_samplesheet=None,
+    samplesheet_stream=None,
+    dataset_name=None,
+    sharding_config=None,
+):
+    """
+    Split the samplesheet into shards of at most `shard_size` rows, each with the original header. Rows are
+    streamed through the csv module and written straight to the shard files, so memory use doesn't grow
+    with the samplesheet.
+
+    When a group column is set, rows are split in two passes: the first counts rows per group, the second
+    writes each group whole into the first shard with room for it (a group larger than `shard_size` gets a
+    shard of its own). A streamed samplesheet is spooled to the workspace for the second pass.
+
+    Returns two values:
+        1) The workspace scratch directory holding the shards, which the caller releases once done with them;
+        2) The list of shards: {'index', 'rows', 'local_samplesheet', 'dataset_name'}. A samplesheet without
+           rows gives a single header-only shard, so it is published like an unsharded samplesheet.
+    """
+    # Imported lazily since only sharding needs it. Keeps it off the cold-start path.
+    import csv
+
+    # The local or streamed filename, rather than the key, since a compressed samplesheet is split once
+    # decompressed (see `detect_samplesheet_file_type`).
+    samplesheet_filename = (
+        pathlib.Path(local_samplesheet).name
+        if samplesheet_stream is None
+        else samplesheet_stream["filename"]
+    )
+    stem, _, extension = samplesheet_filename.rpartition(".")
+    delimiter = "\t" if extension.lower() == "tsv" else ","
+    shard_size = sharding_config["shard_size"]
+
+    shard_dir = _workspace.scratch_dir()
+
+    def read_rows(local_samplesheet=None, samplesheet_stream=None):
+        chunks = iter_samplesheet_chunks(
+            local_samplesheet=local_samplesheet, samplesheet_stream=samplesheet_stream
+        )
+        text = io.TextIOWrapper(
+            io.BufferedReader(ChunkReader(chunks=chunks)),
+            encoding="utf-8-sig",
+            newline="",
+        )
+        return csv.reader(text, delimiter=delimiter)
+
+    shards = []
+    open_files = []
+    try:
+        group_to_shard = None
+        if sharding_config["group_column"]:
+            if samplesheet_stream is not None:
+                spool = shard_dir / f"{stem}.{extension}"
+                with open(spool, "wb") as f:
+                    for chunk in iter_samplesheet_chunks(
+                        samplesheet_stream=samplesheet_stream
+                    ):
+                        f.write(chunk)
+                local_samplesheet, samplesheet_stream = spool.as_posix(), None
+
+            reader = read_rows(local_samplesheet=local_samplesheet)
+            group_index = next(reader).index(sharding_config["group_column"])
+            group_sizes = {}
+            for row in reader:
+                if row:
+                    group_sizes[row[group_index]] = (
+                        group_sizes.get(row[group_index], 0) + 1
+                    )
+
+            # First-fit in order of first appearance keeps shard contents close to the original row order.
+            group_to_shard, shard_rows = {}, []
+            for group, size in group_sizes.items():
+                for index, rows in enumerate(shard_rows):
+                    if rows + size <= shard_size:
+                        break
+                else:
+                    index = len(shard_rows)
+                    shard_rows.append(0)
+                group_to_shard[group] = index
+                shard_rows[index] += size
+
+        reader = read_rows(
+            local_samplesheet=local_samplesheet, samplesheet_stream=samplesheet_stream
+        )
+        header = next(reader)
+        writers = []
+
+        def get_writer(index):
+            while len(shards) <= index:
+                shard_index = len(shards)
+                path = shard_dir / f"{stem}_shard{shard_index:03d}.{extension}"
+                f = open(path, "w", newline="")
+                open_files.append(f)
+                writer = csv.writer(f, delimiter=delimiter, lineterminator="\n")
+                writer.writerow(header)
+                writers.append(writer)
+                shards.append(
+                    {
+                        "index": shard_index,
+                        "rows": 0,
+                        "local_samplesheet": path.as_posix(),
+                        "dataset_name": f"{dataset_name}_shard{shard_index:03d}",
+                    }
+                )
+            return writers[index]
+
+        row_count = 0
+        for row in reader:
+            if not row:
+                continue
+            if group_to_shard is not None:
+                index = group_to_shard[row[group_index]]
+            else:
+                index = row_count // shard_size
+            get_writer(index).writerow(row)
+            shards[index]["rows"] += 1
+            row_count += 1
+
+        if not shards:
+            get_writer(0)
+
+    except Exception as e:
+        # Malformed samplesheet or missing group column. Will not change if retried. Do not retry.
+        for f in open_files:
+            f.close()
+        _workspace.release(path=shard_dir)
+        log_error_and_raise_exception(
+            errorstring=f"Failed to split samplesheet {samplesheet_filename} into shards.",
+            e=e,
+            retry_transaction=False,
+        )
+
+    for f in open_files:
+        f.close()
+    logger.debug(f"Split {samplesheet_filename} into {len(shards)} shard(s).")
+
+    return shard_dir, shards
+
+
+def publish_shards(
+    shards=None,
+    record=None,
+    tw_params=None,
+    store=None,
+    idempotency_key=None,
+    max_concurrency=None,
+):
+    """
+    Create a dataset and launch the pipeline for every shard, at most `max_concurrency` at a time.
+    Each shard is tracked under its own idempotency key, so a retry only redoes the shards that failed.
+    Returns the manifest mapping each shard to its dataset and launch IDs. If any shard failed, the
+    most severe failure is raised once every shard has finished (retryable over ceased).
+    """
+
+    def publish(shard):
+        shard_key = f"{idempotency_key}#shard{shard['index']:03d}"
+        shard_stages = store.get_stages(shard_key) if store else {}
+        if "pipeline_launched" in shard_stages:
+            return {
+                **shard_stages["dataset_created"],
+                **shard_stages["dataset_url"],
+                **shard_stages["pipeline_launched"],
+            }
+
+        return publish_samplesheet(
+            local_samplesheet=shard["local_samplesheet"],
+            dataset_name=shard["dataset_name"],
+            record=record,
+            tw_params=tw_params,
+            store=store,
+            idempotency_key=shard_key,
+            stages=shard_stages,
+        )
+
+    manifest = []
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_concurrency, len(shards))
+    ) as executor:
+        futures = {
+            executor.submit(
+                bind_invocation_metrics(
+                    collector=getattr(_metrics_local, "collector", None),
+                    function=publish,
+                ),
+                shard,
+            ): shard
+            for shard in shards
+        }
+        for future in concurrent.futures.as_completed(futures):
+            shard = futures[future]
+            try:
+                outputs = future.result()
+            except Exception as e:
+                failures.append(e)
+                continue
+            manifest.append(
+                {
+                    "shard": shard["index"],
+                    "rows": shard["rows"],
+                    "datasetName": shard["dataset_name"],
+                    **outputs,
+                }
+            )
+
+    if failures:
+        logger.debug(f"{len(failures)} of {len(shards)} shard(s) failed.")
+        retryable = [e for e in failures if not isinstance(e, CeaseEventProcessing)]
+        raise retryable[0] if retryable else failures[0]
+
+    return sorted(manifest, key=lambda entry: entry["shard"])
+
+
+def prepare_tower_credentials(session=None, tw_params=None):
+    """
+    Get Secrets from AWS Secrets Manager & set as environment variables.
+    """
+    tw_secrets = get_secrets(session=session)
+    logger.debug(f"Secrets are: {tw_secrets}")
+    set_environment_variables(tw_params=tw_params, tw_secrets=tw_secrets)
+
+
+def prewarm():
+    """
+    Do the first invocation's shared set-up while the module is being imported: build the session and
+    clients, retrieve parameters and the Tower PAT, compile the routing table and (for the API client) create
+    the Tower connection pool. Everything lands in the usual warm-container caches, so the first invocation
+    finds them populated.
+    Failures are logged and otherwise ignored. The first invocation then repeats the set-up itself, with the
+    usual retry/cease handling.
+    """
+    started = time.perf_counter()
+    try:
+        session, tw_params = get_session_and_parameters()
+        for service_name in ["s3", "secretsmanager"]:
+            get_client(session=session, service_name=service_name)
+        get_routing_table(tw_params=tw_params)
+        if tower_client(tw_params=tw_params) == "api":
+            get_tower_http_pool()
+        prepare_tower_credentials(session=session, tw_params=tw_params)
+        _prewarm_state["status"] = "completed"
+
+    except Exception as e:
+        logger.warning(
+            f"Prewarm failed. Set-up will be retried by the first invocation: {e}"
+        )
+        _prewarm_state["status"] = "failed"
+
+    _prewarm_state["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    logger.debug(
+        f"Prewarm {_prewarm_state['status']} in {_prewarm_state['duration_ms']} ms."
+    )
+
+
+def wait_for_tower_credentials(tower_credentials=None):
+    """
+    Block until the concurrent `prepare_tower_credentials` call finishes. Its exception (if any) is re-raised
+    here, so the record gets the same retry/cease classification it would have had if the secret had been
+    retrieved up front.
+    """
+    if tower_credentials is not None:
+        tower_credentials.result()
+
+
+def record_result(record=None, status=None, **outputs):
+    """
+    Build the per-record entry returned by the handler.
+    Status is one of `completed`, `ceased` (do not retry) or `retry`. The SQS batch handler also reports
+    `superseded` for older versions of a key that were skipped.
+    """
+    return {
+        "bucket": record["s3"]["bucket"]["name"],
+        "key": record["s3"]["object"]["key"],
+        "status": status,
+        **outputs,
+    }
+
+
+def summarize_results(results=None):
+    """
+    Combine per-record results into the handler's return value.
+    If any record failed with a retryable error, raise so that native Lambda retry logic re-runs the event.
+    """
+    if any(result["status"] == "retry" for result in results):
+        logger.debug(f"Record results: {results}")
+        raise Exception(
+            "One or more records failed but may succeed on retry. Retrying."
+        )
+
+    if all(result["status"] == "completed" for result in results):
+        message = "Pipeline completed successfully."
+    elif all(result["status"] == "ceased" for result in results):
+        message = "Pipeline was terminated early."
+    else:
+        message = "Pipeline completed for some records. Others were terminated early."
+
+    return {"message": message, "records": results}
+
+
+def handler(event, context):
+    """
+    The first function that will be invoked when Lambda is activated.
+    """
+    collector = start_invocation_metrics(context=context)
+    try:
+        result = process_event(
+            event=event, claim_expires_at=get_claim_expiry(context=context)
+        )
+    finally:
+        metrics = finish_invocation_metrics(collector=collector)
+
+    result["metrics"] = metrics
+    return result
+
+
+def sqs_handler(event, context):
+    """
+    Entry point for S3 notifications delivered in batches through SQS (configure the event source mapping
+    with `ReportBatchItemFailures`). Returns `batchItemFailures` listing only the messages that failed with
+    a retryable error, so the rest of the batch isn't redelivered.
+    """
+    collector = start_invocation_metrics(context=context)
+    try:
+        result = process_sqs_batch(
+            event=event, claim_expires_at=get_claim_expiry(context=context)
+        )
+    finally:
+        metrics = finish_invocation_metrics(collector=collector)
+
+    result["metrics"] = metrics
+    return result
+
+
+def process_sqs_batch(event=None, claim_expires_at=None):
+    """
+    Unwrap the S3 records in every SQS message, coalesce repeated uploads of the same key down to the newest
+    version, and process what remains as a single batch.
+    A message is reported as failed if any of its processed records should be retried. Messages that can't
+    be parsed, and records that are out of scope or superseded, are not retried.
+    """
+    entries = []
+    for message in event["Records"]:
+        for record in extract_sqs_records(message=message):
+            entries.append((message["messageId"], record))
+
+    latest = coalesce_records(entries=entries)
+    results = []
+    failed_messages = set()
+
+    to_process = [entry for index, entry in enumerate(entries) if index in latest]
+    if to_process:
+        try:
+            processed = process_records(
+                records=[record for _, record in to_process],
+                claim_expires_at=claim_expires_at,
+            )
+        except CeaseEventProcessing:
+            # Shared set-up was terminated on purpose. Do not retry.
+            processed = [
+                record_result(record=record, status="ceased")
+                for _, record in to_process
+            ]
+        except Exception as e:
+            # Shared set-up may succeed on redelivery. Retry every message carrying a record.
+            logger.debug(f"Batch set-up failed with retryable error: {e}")
+            processed = [
+                record_result(record=record, status="retry") for _, record in to_process
+            ]
+
+        for (message_id, _), result in zip(to_process, processed):
+            result["messageId"] = message_id
+            results.append(result)
+            if result["status"] == "retry":
+                failed_messages.add(message_id)
+
+    for index, (message_id, record) in enumerate(entries):
+        if index not in latest:
+            results.append(
+                record_result(record=record, status="superseded", messageId=message_id)
+            )
+
+    logger.debug(
+        f"Processed {len(to_process)} of {len(entries)} record(s) from {len(event['Records'])} message(s). "
+        f"{len(failed_messages)} message(s) will be retried."
+    )
+
+    # Preserve the original message order in the failure report.
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message["messageId"]}
+            for message in event["Records"]
+            if message["messageId"] in failed_messages
+        ],
+        "records": results,
+    }
+
+
+def extract_sqs_records(message=None):
+    """
+    Return the S3 notification records carried in an SQS message body. Handles notifications sent straight
+    from S3 to SQS as well as those fanned out through SNS (where the S3 event is nested in `Message`).
+    S3 test events and bodies that can't be parsed yield no records.
+    """
+    try:
+        body = json.loads(message["body"])
+        if "Records" not in body and "Message" in body:
+            body = json.loads(body["Message"])
+    except Exception as e:
+        # A malformed body will not parse on redelivery either. Do not retry.
+        logger.warning(
+            f"Ignoring unparseable SQS message {message.get('messageId')}: {e}"
+        )
+        return []
+
+    if body.get("Event") == "s3:TestEvent":
+        return []
+
+    return [record for record in body.get("Records", []) if "s3" in record]
+
+
+def coalesce_records(entries=None):
+    """
+    Given (messageId, record) pairs, return the indices of the records to process: the newest version of
+    each bucket/key. S3 sequencers are hex strings which only order events for the same key; compare them
+    numerically so values of different lengths still sort correctly.
+    """
+    latest = {}
+    for index, (_, record) in enumerate(entries):
+        s3 = record["s3"]
+        object_key = (s3["bucket"]["name"], s3["object"]["key"])
+        sequencer = int(s3["object"].get("sequencer") or "0", 16)
+        if object_key not in latest or sequencer >= latest[object_key][0]:
+            latest[object_key] = (sequencer, index)
+
+    return {index for _, index in latest.values()}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Holds up to `capacity` tokens and refills at `rate` tokens per second.
+    `acquire` takes a token, sleeping until one is available.
+    """
+
+    def __init__(self, rate=None, capacity=None):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def acquire_tower_token():
+    """
+    Wait for the Tower rate limiter (if one is set) before making a Tower call.
+    """
+    bucket = _tower_rate_limit["bucket"]
+    if bucket is not None:
+        bucket.acquire()
+
+
+def backfill_handler(event, context):
+    """
+    Entry point for backfilling samplesheets that already exist in S3 (see `backfill`). Example event:
+        {"bucket": "YOUR_S3_BUCKET", "prefix": "lambda_tutorial/", "checkpoint": {...}}
+    Stops taking new objects BACKFILL_TIME_MARGIN seconds before the function would time out. If the result's
+    `complete` is false, invoke again with its `checkpoint` to carry on where this invocation stopped.
+    """
+    deadline = None
+    if context is not None:
+        deadline = (
+            time.monotonic()
+            + context.get_remaining_time_in_millis() / 1000
+            - BACKFILL_TIME_MARGIN
+        )
+
+    collector = start_invocation_metrics(context=context)
+    try:
+        result = backfill(
+            bucket=event["bucket"],
+            prefix=event.get("prefix"),
+            checkpoint=event.get("checkpoint"),
+            max_workers=event.get("max_workers", BACKFILL_WORKERS),
+            tower_rate=event.get("tower_rate", BACKFILL_TOWER_RATE),
+            tower_burst=event.get("tower_burst", BACKFILL_TOWER_BURST),
+            deadline=deadline,
+            claim_expires_at=get_claim_expiry(context=context),
+        )
+    except CeaseEventProcessing:
+        # Shared set-up was terminated on purpose. Do not retry.
+        result = {"message": "Backfill was terminated early.", "complete": False}
+    finally:
+        metrics = finish_invocation_metrics(collector=collector)
+
+    result["metrics"] = metrics
+    return result
+
+
+def backfill(
+    bucket=None,
+    prefix=None,
+    checkpoint=None,
+    max_workers=None,
+    tower_rate=None,
+    tower_burst=None,
+    deadline=None,
+    save_checkpoint=None,
+    claim_expires_at=None,
+):
+    """
+    Process the samplesheets already under `prefix` (default: the `s3_root_prefix` parameter) as if each had
+    just been uploaded. Objects are listed page by page with list_objects_v2, filtered with the same scope
+    rules as S3 events (`check_if_event_in_scope`) and processed by `process_record` on a pool of
+    `max_workers` threads. Every Tower call made during the run waits on a token bucket of `tower_rate` calls
+    per second (bursts of up to `tower_burst`).
+
+    Progress is tracked as a checkpoint: `start_after`, the last key below which every listed object has
+    finished, plus the objects that failed with a retryable error. Passing a checkpoint back in retries those
+    objects, then resumes listing after `start_after`. `save_checkpoint` (if given) is called with the latest
+    checkpoint every BACKFILL_CHECKPOINT_INTERVAL seconds and at the end. New objects stop being taken once
+    `deadline` (a time.monotonic() value) passes. `claim_expires_at` is passed to each `process_record`.
+    Returns the run's counts, throughput and final checkpoint.
+    """
+    started = time.monotonic()
+    checkpoint = checkpoint or {}
+    counts = {"listed": 0, "out_of_scope": 0, "completed": 0, "ceased": 0, "retry": 0}
+
+    session, tw_params = get_session_and_parameters()
+    if prefix is None:
+        prefix = tw_params["/lambda_tutorial/s3_root_prefix"].rstrip("/") + "/"
+    prepare_tower_credentials(session=session, tw_params=tw_params)
+
+    watermark = {"start_after": checkpoint.get("start_after", "")}
+    # Listed keys in order, mapped to whether they have finished. Only the finished run at the front can
+    # move the watermark, since anything after an unfinished key would be skipped on resume.
+    in_order = collections.OrderedDict()
+    # Objects to retry on resume: carried over from the checkpoint until they succeed, plus new failures.
+    retry_pending = {obj["key"]: obj for obj in checkpoint.get("failed", [])}
+    failed = {}
+    lock = threading.Lock()
+    progress = {"saved_at": time.monotonic()}
+
+    def current_checkpoint():
+        with lock:
+            return {
+                "bucket": bucket,
+                "prefix": prefix,
+                "start_after": watermark["start_after"],
+                "failed": list(retry_pending.values()) + list(failed.values()),
+            }
+
+    def finish(obj, status=None, ordered=True):
+        with lock:
+            counts[status] += 1
+            if status == "retry":
+                failed[obj["key"]] = obj
+            if not ordered:
+                retry_pending.pop(obj["key"], None)
+                return
+            in_order[obj["key"]] = True
+            while in_order:
+                key, done = next(iter(in_order.items()))
+                if not done:
+                    break
+                in_order.popitem(last=False)
+                watermark["start_after"] = key
+
+    def report_progress(final=False):
+        if (
+            not final
+            and time.monotonic() - progress["saved_at"] < BACKFILL_CHECKPOINT_INTERVAL
+        ):
+            return
+        progress["saved_at"] = time.monotonic()
+        elapsed = time.monotonic() - started
+        logger.info(
+            f"Backfill of s3://{bucket}/{prefix}: {counts['listed']} listed, {counts['completed']} completed, "
+            f"{counts['ceased'] + counts['out_of_scope']} skipped, {counts['retry']} failed "
+            f"({counts['listed'] / elapsed:.1f} objects/sec)."
+        )
+        if save_checkpoint is not None:
+            save_checkpoint(current_checkpoint())
+
+    def list_objects():
+        # Objects that failed in a previous run come first (they sort before `start_after`), then the listing.
+        for obj in list(retry_pending.values()):
+            yield obj, False
+        s3_client = get_client(session=session, service_name="s3")
+        paginator = s3_client.get_paginator("list_objects_v2")
+        pages = paginator.paginate(
+            Bucket=bucket, Prefix=prefix, StartAfter=watermark["start_after"]
+        )
+        for page in pages:
+            for item in page.get("Contents", []):
+                yield {
+                    "key": item["Key"],
+                    "eTag": item["ETag"].strip('"'),
+                    "size": item["Size"],
+                }, True
+
+    previous_limit = _tower_rate_limit["bucket"]
+    if tower_rate:
+        _tower_rate_limit["bucket"] = TokenBucket(rate=tower_rate, capacity=tower_burst)
+    complete = True
+    futures = {}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for obj, ordered in list_objects():
+                if deadline is not None and time.monotonic() >= deadline:
+                    complete = False
+                    break
+
+                record = {
+                    "eventSource": "aws:s3",
+                    "eventName": "ObjectCreated:Backfill",
+                    "s3": {
+                        "bucket": {"name": bucket},
+                        "object": {
+                            "key": obj["key"],
+                            "size": obj["size"],
+                            "eTag": obj["eTag"],
+                        },
+                    },
+                }
+                if ordered:
+                    with lock:
+                        counts["listed"] += 1
+                        in_order[obj["key"]] = False
+
+                # Parameters and secrets are cached, so re-reading them per object is cheap. It keeps a long
+                # run working across parameter changes, PAT rotation and session expiry.
+                session, tw_params = get_session_and_parameters()
+                try:
+                    record_params = check_if_event_in_scope(
+                        record=record, tw_params=tw_params
+                    )
+                except CeaseEventProcessing:
+                    finish(obj, status="out_of_scope", ordered=ordered)
+                    continue
+                prepare_tower_credentials(session=session, tw_params=tw_params)
+
+                future = executor.submit(
+                    bind_invocation_metrics(
+                        collector=getattr(_metrics_local, "collector", None),
+                        function=process_record,
+                    ),
+                    session=session,
+                    record=record,
+                    tw_params=record_params,
+                    claim_expires_at=claim_expires_at,
+                )
+                futures[future] = (obj, ordered)
+
+                # Keep the listing only a little ahead of the workers.
+                while len(futures) >= max_workers * 2:
+                    done, _ = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        obj, ordered = futures.pop(future)
+                        finish(obj, status=future.result()["status"], ordered=ordered)
+                    report_progress()
+
+            for future in concurrent.futures.as_completed(list(futures)):
+                obj, ordered = futures.pop(future)
+                finish(obj, status=future.result()["status"], ordered=ordered)
+                report_progress()
+    finally:
+        _tower_rate_limit["bucket"] = previous_limit
+        report_progress(final=True)
+
+    elapsed = time.monotonic() - started
+    processed = counts["completed"] + counts["ceased"] + counts["retry"]
+    return {
+        "message": f"Backfill {'complete' if complete else 'stopped early'}.",
+        "complete": complete,
+        **counts,
+        "duration_s": round(elapsed, 3),
+        "objects_per_sec": round(counts["listed"] / elapsed, 3) if elapsed else 0.0,
+        "records_per_sec": round(processed / elapsed, 3) if elapsed else 0.0,
+        "checkpoint": current_checkpoint(),
+    }
+
+
+class SqsWorkerSource:
+    """
+    Worker source pulling S3 notifications from an SQS queue with long polling (the same queue an
+    `app.sqs_handler` event source mapping would read). Messages are received with a visibility timeout of
+    `visibility_timeout` seconds, which is extended while their batch runs (see `hold`). Processed messages are
+    deleted. Messages that failed with a retryable error are left alone, so they reappear once it lapses.
+    """
+
+    def __init__(self, queue_url=None, visibility_timeout=None):
+        self.name = f"sqs:{queue_url}"
+        self._queue_url = queue_url
+        self._visibility_timeout = visibility_timeout or WORKER_VISIBILITY_TIMEOUT
+
+    def _client(self):
+        # Looked up on every call so a refreshed session is picked up.
+        session, _ = get_session_and_parameters()
+        return get_client(session=session, service_name="sqs")
+
+    def receive(self, max_messages=None, wait_seconds=None, stop=None):
+        response = self._client().receive_message(
+            QueueUrl=self._queue_url,
+            MaxNumberOfMessages=min(max_messages, 10),
+            WaitTimeSeconds=min(wait_seconds, 20),
+            VisibilityTimeout=self._visibility_timeout,
+        )
+
+        return [
+            {
+                "messageId": message["MessageId"],
+                "receiptHandle": message["ReceiptHandle"],
+                "body": message["Body"],
+            }
+            for message in response.get("Messages", [])
+        ]
+
+    @contextlib.contextmanager
+    def hold(self, messages=None):
+        """
+        Keep `messages` hidden from other consumers while the block runs. Every third of the visibility
+        timeout, a heartbeat thread resets it to the full timeout, so no batch outlasts it however long it
+        runs (e.g. a sharded samplesheet waiting on Tower retries).
+        """
+        done = threading.Event()
+
+        def heartbeat():
+            while not done.wait(self._visibility_timeout / 3):
+                try:
+                    response = self._client().change_message_visibility_batch(
+                        QueueUrl=self._queue_url,
+                        Entries=[
+                            {
+                                "Id": str(index),
+                                "ReceiptHandle": message["receiptHandle"],
+                                "VisibilityTimeout": self._visibility_timeout,
+                            }
+                            for index, message in enumerate(messages)
+                        ],
+                    )
+                except Exception as e:
+                    # Networking or throttling. Tried again on the next beat, well before the timeout lapses.
+                    logger.warning(f"Failed to extend SQS message visibility: {e}")
+                    continue
+                for failure in response.get("Failed", []):
+                    logger.warning(
+                        f"Failed to extend SQS message visibility: {failure}"
+                    )
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def complete(self, messages=None, failed=None):
+        processed = [
+            message for message in messages if message["messageId"] not in failed
+        ]
+        for start in range(0, len(processed), 10):
+            response = self._client().delete_message_batch(
+                QueueUrl=self._queue_url,
+                Entries=[
+                    {"Id": str(index), "ReceiptHandle": message["receiptHandle"]}
+                    for index, message in enumerate(processed[start : start + 10])
+                ],
+            )
+            for failure in response.get("Failed", []):
+                # The message will be received again; the idempotency store (if any) makes that a no-op.
+                logger.warning(f"Failed to delete SQS message: {failure}")
+
+
+class SpoolWorkerSource:
+    """
+    Worker source pulling S3 notification events from a local directory: one `.json` file per event, in the
+    format Lambda receives (e.g. `testing/test_event_good.json`). Write files under another name and rename
+    them to `.json` once complete. A file is claimed by moving it into `processing/`. It is deleted once
+    processed, or moved to `failed/` if any of its records failed with a retryable error (move it back into
+    the directory to retry it). Use one worker per directory.
+    """
+
+    def __init__(self, directory=None):
+        self.name = f"spool:{directory}"
+        self._directory = pathlib.Path(directory)
+        (self._directory / "processing").mkdir(parents=True, exist_ok=True)
+        (self._directory / "failed").mkdir(exist_ok=True)
+        # Files still claimed by a worker that didn't shut down cleanly are picked up again.
+        for path in (self._directory / "processing").glob("*.json"):
+            os.replace(path, self._directory / path.name)
+
+    def receive(self, max_messages=None, wait_seconds=None, stop=None):
+        deadline = time.monotonic() + wait_seconds
+        while True:
+            messages = []
+            for path in sorted(self._directory.glob("*.json"))[:max_messages]:
+                claimed = self._directory / "processing" / path.name
+                os.replace(path, claimed)
+                messages.append({"messageId": path.name, "body": claimed.read_text()})
+
+            remaining = deadline - time.monotonic()
+            if messages or remaining <= 0 or stop.is_set():
+                return messages
+            stop.wait(min(1.0, remaining))
+
+    def hold(self, messages=None):
+        # A claimed file stays in `processing/` until completed, however long its batch runs.
+        return contextlib.nullcontext()
+
+    def complete(self, messages=None, failed=None):
+        for message in messages:
+            claimed = self._directory / "processing" / message["messageId"]
+            if message["messageId"] in failed:
+                os.replace(claimed, self._directory / "failed" / message["messageId"])
+            else:
+                claimed.unlink()
+
+
+def get_worker_source(source=None):
+    """
+    Build the worker's event source from its specification:
+        - `sqs:<queue_url>`: SQS queue of S3 notifications (see `SqsWorkerSource`).
+        - `spool:<directory>`: Local directory of S3 notification events (see `SpoolWorkerSource`).
+    """
+    kind, _, location = source.partition(":")
+    kind = kind.lower()
+    if kind == "sqs" and location:
+        return SqsWorkerSource(queue_url=location)
+    if kind == "spool" and location:
+        return SpoolWorkerSource(directory=location)
+
+    # Misconfiguration will not fix itself on retry. Do not retry.
+    log_error_and_raise_exception(
+        errorstring=f"Unsupported worker source: {source}",
+        e=None,
+        retry_transaction=False,
+    )
+
+
+def worker(
+    source=None,
+    concurrency=None,
+    batch_size=None,
+    poll_seconds=None,
+    port=None,
+    tower_rate=None,
+    tower_burst=None,
+    stop=None,
+):
+    """
+    Process S3 notifications from `source` (see `get_worker_source`) until `stop` is set. A long-running
+    alternative to the Lambda handlers, e.g. on ECS or Kubernetes during peaks when Lambda's per-invocation
+    overhead or concurrency limit is the bottleneck.
+
+    Each batch of up to `batch_size` messages goes through `process_sqs_batch`, exactly as in `sqs_handler`,
+    on a pool of `concurrency` threads. Threads rather than processes, so every batch shares the session,
+    parameters, secret, routing table, Tower connection pool and name index, which stay warm (refreshed by
+    their usual TTLs) for the life of the process. A new batch is only received when a thread is free, so
+    messages aren't held while they wait. Tower calls can be limited to `tower_rate` per second as in
+    `backfill`.
+
+    Once `stop` is set, no more messages are received and the batches in progress are finished. Progress is
+    served on `port` (see `start_worker_server`). Returns the final counters (see `get_worker_metrics`).
+    """
+    stop = stop or threading.Event()
+    worker_source = get_worker_source(source=source)
+    with _worker_lock:
+        _worker_state.clear()
+        _worker_state.update(
+            {
+                "status": "starting",
+                "source": worker_source.name,
+                "started_at": time.time(),
+                "in_flight": 0,
+                "batches": 0,
+                "messages": 0,
+                "batch_errors": 0,
+                "receive_errors": 0,
+                "last_batch_at": None,
+                "records": {},
+                "stages": {},
+            }
+        )
+    server = start_worker_server(port=port) if port else None
+
+    # The set-up Lambda's init phase does with LAMBDA_TUTORIAL_PREWARM, done once for the life of the worker.
+    prewarm()
+    previous_limit = _tower_rate_limit["bucket"]
+    if tower_rate:
+        _tower_rate_limit["bucket"] = TokenBucket(
+            rate=tower_rate, capacity=max(1, tower_burst)
+        )
+
+    logger.info(f"Worker started on {worker_source.name}.")
+    _worker_state["status"] = "running"
+    in_flight = set()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while not stop.is_set():
+                if len(in_flight) >= concurrency:
+                    _, in_flight = concurrent.futures.wait(
+                        in_flight,
+                        timeout=1,
+                        return_when=concurrent.futures.FIRST_COMPLETED,
+                    )
+                    continue
+
+                try:
+                    messages = worker_source.receive(
+                        max_messages=batch_size, wait_seconds=poll_seconds, stop=stop
+                    )
+                except Exception as e:
+                    # Networking or throttling. Back off and receive again.
+                    logger.warning(f"Failed to receive from {worker_source.name}: {e}")
+                    with _worker_lock:
+                        _worker_state["receive_errors"] += 1
+                    stop.wait(poll_seconds)
+                    continue
+
+                if messages:
+                    in_flight = {future for future in in_flight if not future.done()}
+                    in_flight.add(
+                        executor.submit(
+                            run_worker_batch, source=worker_source, messages=messages
+                        )
+                    )
+
+            _worker_state["status"] = "draining"
+            logger.info(
+                f"Worker stopping. Finishing {sum(not f.done() for f in in_flight)} batch(es) in progress."
+            )
+    finally:
+        _tower_rate_limit["bucket"] = previous_limit
+        _worker_state["status"] = "stopped"
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    return get_worker_metrics()
+
+
+def run_worker_batch(source=None, messages=None):
+    """
+    Process one batch from the worker's source as `sqs_handler` would, acknowledge it, and add its results
+    and stage timings to the worker's counters.
+    """
+    with _worker_lock:
+        _worker_state["in_flight"] += 1
+
+    result = None
+    collector = start_invocation_metrics(context=None)
+    try:
+        with source.hold(messages=messages):
+            result = process_sqs_batch(event={"Records": messages})
+        source.complete(
+            messages=messages,
+            failed={
+                failure["itemIdentifier"] for failure in result["batchItemFailures"]
+            },
+        )
+    except Exception as e:
+        # The messages will be received again (SQS, after its visibility timeout) or land in `failed/` (spool).
+        logger.warning(f"Batch from {source.name} failed: {e}")
+        result = None
+        with contextlib.suppress(Exception):
+            source.complete(
+                messages=messages,
+                failed={message["messageId"] for message in messages},
+            )
+    finally:
+        metrics = finish_invocation_metrics(collector=collector)
+
+    with _worker_lock:
+        _worker_state["in_flight"] -= 1
+        _worker_state["batches"] += 1
+        _worker_state["messages"] += len(messages)
+        _worker_state["last_batch_at"] = time.time()
+        if result is None:
+            _worker_state["batch_errors"] += 1
+        else:
+            for record in result["records"]:
+                records = _worker_state["records"]
+                records[record["status"]] = records.get(record["status"], 0) + 1
+        for stage, summary in metrics.get("stages", {}).items():
+            totals = _worker_state["stages"].setdefault(
+                stage, {"count": 0, "total_ms": 0.0, "max_ms": 0.0}
+            )
+            totals["count"] += summary["count"]
+            totals["total_ms"] = round(totals["total_ms"] + summary["total_ms"], 3)
+            totals["max_ms"] = max(totals["max_ms"], summary["max_ms"])
+
+
+def get_worker_metrics():
+    """
+    Return a snapshot of the worker's counters: status, batches/messages processed, records by status,
+    per-stage timings (as in the handlers' `metrics` summary, totalled over the worker's life) and the Tower
+    circuit breaker's state.
+    """
+    with _worker_lock:
+        snapshot = json.loads(json.dumps(_worker_state))
+
+    if snapshot.get("started_at"):
+        snapshot["uptime_s"] = round(time.time() - snapshot["started_at"], 3)
+    snapshot["tower_circuit"] = _tower_breaker.state
+
+    return snapshot
+
+
+def start_worker_server(port=None):
+    """
+    Serve the worker's endpoints on `port` from a background thread:
+        - `/health`: 200 while the worker is receiving, 503 while it starts up or drains (for load balancer or
+          orchestrator health checks).
+        - `/metrics`: JSON counters (see `get_worker_metrics`).
+    """
+    # Imported lazily since only the worker needs it. Keeps it off the cold-start path.
+    import http.server
+
+    class WorkerRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/health":
+                status = _worker_state.get("status")
+                code, payload = (200 if status == "running" else 503), {
+                    "status": status
+                }
+            elif self.path == "/metrics":
+                code, payload = 200, get_worker_metrics()
+            else:
+                self.send_error(404)
+                return
+
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(f"Worker endpoint: {format % args}")
+
+    server = http.server.ThreadingHTTPServer(("", port), WorkerRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Worker endpoints (/health, /metrics) listening on port {port}.")
+
+    return server
+
+
+def process_event(event=None, claim_expires_at=None):
+    """
+    Process every record in an S3 notification event and return the handler's result.
+    """
+    try:
+        results = process_records(
+            records=event["Records"], claim_expires_at=claim_expires_at
+        )
+        return summarize_results(results=results)
+
+    except CeaseEventProcessing as e:
+        # Event was terminated on purpose. Do not retry.
+        return {"message": "Pipeline was terminated early.", "records": []}
+
+
+def get_session_and_parameters():
+    """
+    Return the (cached) boto3 session and SSM parameters shared by every record, event and entry point.
+    """
+    # Hard-coded value to simplify the generation of a session.
+    # Could be externalized but would require more complicated logic to retrieve externalized value (when
+    # testing locally).
+    execution_role = "lambda_tutorial"
+    session, session_is_new = get_session(execution_role=execution_role)
+
+    # The identity probe is an extra STS round trip used purely for logging, so only make it when a new
+    # session is generated (and not at all if it has been switched off).
+    if session_is_new and not SKIP_IDENTITY_PROBE:
+        sts_client = get_client(session=session, service_name="sts")
+        logger.debug(f"Session client is: {sts_client.get_caller_identity()}")
+
+    # Get parameters from SSM
+    # Update function logging level (if necessary) when `logging_level` parameter is retrieved.
+    # NOTE:
+    #   Keynames are odd for a Python dictionary, but it works and aligns with required AWS set-up commands.
+    #   Keep logging_level as first entry to control logging behaviour of other values when retrieved.
+    params_to_retrieve = [
+        "/lambda_tutorial/logging_level",
+        "/lambda_tutorial/workspace_id",
+        "/lambda_tutorial/s3_root_prefix",
+        "/lambda_tutorial/samplesheet_file_types",
+        "/lambda_tutorial/target_pipeline_name",
+        "/lambda_tutorial/tower_api_endpoint",
+    ]
+    # Optional parameters fall back to the listed default if they don't exist in SSM.
+    #   - tower_client: `cli` to shell out to tw, `api` to use the pooled HTTP client.
+    #   - samplesheet_transfer_mode: `file` to download to /tmp, `stream` to stream from S3 (api client only).
+    #   - idempotency_store: `none`, `sqlite:<path>` or `dynamodb:<table>`.
+    #   - routing_table: JSON routes from prefix/file type to workspace/pipeline (see `get_routing_table`).
+    #   - shard_size, shard_group_column, shard_max_concurrency: see `get_sharding_config`.
+    #   - samplesheet_schema: Column list or JSON schema(s) samplesheets are validated against (see `get_samplesheet_schema`).
+    optional_params = {
+        "/lambda_tutorial/tower_client": "cli",
+        "/lambda_tutorial/samplesheet_transfer_mode": "file",
+        "/lambda_tutorial/idempotency_store": "none",
+        "/lambda_tutorial/routing_table": "",
+        "/lambda_tutorial/shard_size": "0",
+        "/lambda_tutorial/shard_group_column": "",
+        "/lambda_tutorial/shard_max_concurrency": "4",
+        "/lambda_tutorial/samplesheet_schema": "",
+    }
+    tw_params = get_parameters(
+        session=session,
+        params_to_retrieve=params_to_retrieve,
+        optional_params=optional_params,
+    )
+    logger.debug(f"Parameters are: {tw_params}")
+
+    return session, tw_params
+
+
+def process_records(records=None, claim_expires_at=None):
+    """
+    Process a list of S3 notification records and return one result per record (see `record_result`), in
+    the same order. Session, parameters and secrets are fetched once and shared by every record.
+    `claim_expires_at` is passed to each `process_record`.
+    Raises CeaseEventProcessing (or a retryable exception) if the shared set-up fails.
+    """
+    session, tw_params = get_session_and_parameters()
+
+    # Check each record to see if the newly-arrived file needs to be processed. Out-of-scope records are
+    # recorded as ceased without affecting the others.
+    results = [None] * len(records)
+    in_scope = []
+    for index, record in enumerate(records):
+        try:
+            record_params = check_if_event_in_scope(record=record, tw_params=tw_params)
+            in_scope.append((index, record_params))
+        except CeaseEventProcessing:
+            results[index] = record_result(record=record, status="ceased")
+
+    if in_scope:
+        # Secrets are fetched once and shared by every record in the event.
+        # In concurrent mode, retrieval runs on its own thread while records start their S3 transfers
+        # (which don't need the PAT). Otherwise it completes before any record is processed.
+        credentials_executor = None
+        tower_credentials = None
+        if CONCURRENT_STAGES:
+            credentials_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            tower_credentials = credentials_executor.submit(
+                bind_invocation_metrics(
+                    collector=getattr(_metrics_local, "collector", None),
+                    function=prepare_tower_credentials,
+                ),
+                session=session,
+                tw_params=tw_params,
+            )
+        else:
+            prepare_tower_credentials(session=session, tw_params=tw_params)
+
+        # Process in-scope records concurrently. Each gets its own retry/cease classification.
+        max_workers = min(MAX_RECORD_WORKERS, len(in_scope))
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        bind_invocation_metrics(
+                            collector=getattr(_metrics_local, "collector", None),
+                            function=process_record,
+                        ),
+                        session=session,
+                        record=records[index],
+                        tw_params=record_params,
+                        tower_credentials=tower_credentials,
+                        claim_expires_at=claim_expires_at,
+                    ): index
+                    for index, record_params in in_scope
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    results[futures[future]] = future.result()
+        finally:
+            if credentials_executor is not None:
+                credentials_executor.shutdown(wait=True)
+
+    return results
+
+
+# Runs during Lambda's init phase (i.e. on import), after everything above has been defined.
+if PREWARM:
+    prewarm()
+
+
+def main():
+    """
+    Command line entry point for running outside Lambda (e.g. `python app.py backfill --bucket ...` or
+    `python app.py worker --source sqs:<queue_url>`).
+    """
+    # Imported lazily since the Lambda handlers don't need it.
+    import argparse
+
+    parser = argparse.ArgumentParser(description="lambda_tutorial utilities.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backfill_parser = subparsers.add_parser(
+        "backfill", help="Process samplesheets already in S3 (see `backfill`)."
+    )
+    backfill_parser.add_argument("--bucket", required=True)
+    backfill_parser.add_argument(
+        "--prefix", help="Prefix to list (default: the s3_root_prefix parameter)."
+    )
+    backfill_parser.add_argument(
+        "--checkpoint",
+        default="backfill_checkpoint.json",
+        help="JSON file progress is saved to and resumed from.",
+    )
+    backfill_parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS)
+    backfill_parser.add_argument(
+        "--tower-rate", type=float, default=BACKFILL_TOWER_RATE
+    )
+    backfill_parser.add_argument(
+        "--tower-burst", type=int, default=BACKFILL_TOWER_BURST
+    )
+
+    worker_parser = subparsers.add_parser(
+        "worker",
+        help="Process S3 notifications from a queue or spool directory (see `worker`).",
+    )
+    worker_parser.add_argument(
+        "--source",
+        default=os.environ.get("LAMBDA_TUTORIAL_WORKER_SOURCE"),
+        required="LAMBDA_TUTORIAL_WORKER_SOURCE" not in os.environ,
+        help="`sqs:<queue_url>` or `spool:<directory>` (default: LAMBDA_TUTORIAL_WORKER_SOURCE).",
+    )
+    worker_parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY)
+    worker_parser.add_argument("--batch-size", type=int, default=WORKER_BATCH_SIZE)
+    worker_parser.add_argument("--poll-seconds", type=int, default=WORKER_POLL_SECONDS)
+    worker_parser.add_argument(
+        "--port", type=int, default=WORKER_PORT, help="`0` disables the endpoint."
+    )
+    worker_parser.add_argument(
+        "--tower-rate",
+        type=float,
+        default=0.0,
+        help="Tower calls per second. `0` (default) disables the limit.",
+    )
+    worker_parser.add_argument("--tower-burst", type=int, default=BACKFILL_TOWER_BURST)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+    if args.command == "worker":
+        run_worker_command(args=args)
+        return
+
+    checkpoint_path = pathlib.Path(args.checkpoint)
+    checkpoint = None
+    if checkpoint_path.exists():
+        checkpoint = json.loads(checkpoint_path.read_text())
+        logger.info(f"Resuming from checkpoint {checkpoint_path}.")
+
+    def save_checkpoint(state):
+        # Write then rename so an interrupted save never leaves a truncated checkpoint.
+        partial = checkpoint_path.with_suffix(".partial")
+        partial.write_text(json.dumps(state, indent=2))
+        os.replace(partial, checkpoint_path)
+
+    result = backfill(
+        bucket=args.bucket,
+        prefix=args.prefix,
+        checkpoint=checkpoint,
+        max_workers=args.workers,
+        tower_rate=args.tower_rate,
+        tower_burst=args.tower_burst,
+        save_checkpoint=save_checkpoint,
+    )
+    print(json.dumps(result, indent=2))
+
+
+def run_worker_command(args=None):
+    """
+    Run `worker` until SIGTERM (e.g. a container being stopped) or SIGINT, then finish the batches in
+    progress and print the final counters.
+    """
+    # Imported lazily since the Lambda handlers don't need it.
+    import signal
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info(f"Received signal {signum}.")
+        stop.set()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, request_stop)
+
+    result = worker(
+        source=args.source,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        poll_seconds=args.poll_seconds,
+        port=args.port,
+        tower_rate=args.tower_rate,
+        tower_burst=args.tower_burst,
+        stop=stop,
+    )
+    _workspace.close()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
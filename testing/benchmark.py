@@ -0,0 +1,642 @@
+"""
+Local benchmark harness for `app.handler` (and `app.sqs_handler`).
+
+Replays the sample events in this folder (plus synthetic multi-record and large-samplesheet events) through the
+handler without touching AWS or Tower. The `sqs_batch` scenario replays the SQS batch fixture through
+`app.sqs_handler` instead, `backfill` runs `app.backfill` over the stubbed bucket's benchmark prefix, and `worker`
+runs `app.worker` over a spool directory holding the multi-record event's records as separate events.
+    - SSM, Secrets Manager and S3 calls are answered by botocore `before-call` hooks registered on the session
+      (the same mechanism `botocore.stub.Stubber` uses), so no network traffic leaves the process.
+    - `tw` is replaced by a fake executable placed first on PATH which sleeps for a configurable delay and
+      prints the JSON the real cli would.
+    - When `--tower-client api` is used, Tower API calls go to a local stub HTTP server instead (see
+      `testing/stub_tower.py`).
+
+Per-stage latencies are taken from the embedded-metric lines the handler writes to stdout, so the numbers
+reported are the same ones CloudWatch would receive.
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python testing/benchmark.py --iterations 200 --concurrency 8 --tw-delay 0.05
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import logging
+import os
+import pathlib
+import random
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+
+import app
+from stub_tower import start_stub_tower
+
+TESTING_DIR = REPO_ROOT / "testing"
+SAMPLESHEET = REPO_ROOT / "datafiles" / "samplesheet_full.csv"
+
+SCENARIOS = [
+    "good",
+    "bad_prefix",
+    "bad_file",
+    "multi_record",
+    "large_samplesheet",
+    "sqs_batch",
+    "backfill",
+    "worker",
+]
+
+FAKE_TW = """#!{python}
+import json, os, sys, time, uuid
+
+time.sleep(float(os.environ.get("BENCHMARK_TW_DELAY", "0")))
+# Drop the `-o json` output option, then any flags.
+args = [a for a in sys.argv[3:] if not a.startswith("-")]
+if args[:2] == ["datasets", "add"]:
+    print(json.dumps({{"datasetId": uuid.uuid4().hex[:22]}}))
+elif args[:2] == ["datasets", "list"]:
+    print(json.dumps({{"datasetList": []}}))
+elif args[:2] == ["datasets", "update"]:
+    dataset_id = [a for a in sys.argv if a.startswith("--id=")][0].split("=", 1)[1]
+    print(json.dumps({{"datasetId": dataset_id}}))
+elif args[:2] == ["datasets", "url"]:
+    dataset_id = [a for a in sys.argv if a.startswith("--id=")][0].split("=", 1)[1]
+    print(json.dumps({{"datasetUrl": f"https://tower.stub/datasets/{{dataset_id}}/v/1/n/samplesheet.csv"}}))
+elif args[:1] == ["launch"]:
+    print(json.dumps({{"workflowId": uuid.uuid4().hex[:14]}}))
+else:
+    sys.stderr.write(f"Unsupported command: {{sys.argv}}")
+    sys.exit(1)
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument(
+        "--iterations", type=int, default=100, help="Events per scenario."
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="Concurrent handler invocations."
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=5, help="Untimed events per scenario."
+    )
+    parser.add_argument(
+        "--tower-client", default="cli", choices=["cli", "api"], help="Tower client."
+    )
+    parser.add_argument("--transfer-mode", default="file", choices=["file", "stream"])
+    parser.add_argument(
+        "--tw-delay", type=float, default=0.0, help="Seconds the fake tw sleeps."
+    )
+    parser.add_argument(
+        "--tower-delay",
+        type=float,
+        default=0.0,
+        help="Seconds the stub Tower API sleeps per request.",
+    )
+    parser.add_argument(
+        "--aws-delay",
+        type=float,
+        default=0.0,
+        help="Seconds each stubbed AWS call sleeps.",
+    )
+    parser.add_argument(
+        "--records", type=int, default=20, help="Records in the multi-record event."
+    )
+    parser.add_argument(
+        "--rows", type=int, default=50000, help="Rows in the large samplesheet."
+    )
+    parser.add_argument(
+        "--compression",
+        default="none",
+        choices=["none", "gz", "zst"],
+        help="Compress the large samplesheet (`large.csv.gz` / `large.csv.zst`).",
+    )
+    parser.add_argument(
+        "--workspace-max-bytes",
+        type=int,
+        help="Size of the workspace's samplesheet cache (LAMBDA_TUTORIAL_WORKSPACE_MAX_BYTES). 0 disables it.",
+    )
+    parser.add_argument(
+        "--cold",
+        action="store_true",
+        help="Reset the warm-container caches before every event.",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=0,
+        help="Rows per shard (`shard_size` parameter). 0 disables sharding.",
+    )
+    parser.add_argument(
+        "--shard-group-column",
+        default="",
+        help="Column kept together when sharding (`shard_group_column` parameter).",
+    )
+    parser.add_argument(
+        "--samplesheet-schema",
+        default="",
+        help="Schema samplesheets are validated against (`samplesheet_schema` parameter), "
+        "e.g. 'sample,fastq_1,fastq_2,strandedness'. Empty disables validation.",
+    )
+    parser.add_argument(
+        "--backfill-tower-rate",
+        type=float,
+        default=0.0,
+        help="Tower calls/sec allowed during the backfill scenario. 0 disables the limit.",
+    )
+    parser.add_argument(
+        "--prewarm",
+        action="store_true",
+        help="Run `app.prewarm` (as LAMBDA_TUTORIAL_PREWARM would at import) before the scenarios.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the report as JSON to this path.")
+    return parser.parse_args()
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# Stubbed AWS
+# ---------------------------------------------------------------------------------------------------------------
+def make_stub_session(parameters=None, objects=None, aws_delay=0.0):
+    """
+    Return a boto3 Session whose clients answer SSM, Secrets Manager and S3 calls from memory.
+    `parameters` maps SSM names to values and `objects` maps S3 keys to bytes.
+    """
+    session = boto3.Session(
+        aws_access_key_id="benchmark",
+        aws_secret_access_key="benchmark",
+        aws_session_token="benchmark",
+        region_name="us-east-1",
+    )
+
+    def capture_params(params=None, context=None, **kwargs):
+        # `before-call` only receives the serialized request, so keep the original API parameters.
+        context["benchmark_params"] = params
+
+    def respond(model=None, context=None, **kwargs):
+        if aws_delay:
+            time.sleep(aws_delay)
+        params = context["benchmark_params"]
+        operation = f"{model.service_model.service_name}.{model.name}"
+        return AWSResponse(None, 200, {}, None), stub_response(
+            operation=operation, params=params, parameters=parameters, objects=objects
+        )
+
+    session.events.register("before-parameter-build", capture_params)
+    session.events.register("before-call", respond)
+    return session
+
+
+def etag(data=None):
+    """
+    ETag S3 gives an object uploaded in a single part: the MD5 of its content.
+    """
+    return hashlib.md5(data).hexdigest()
+
+
+def stub_response(operation=None, params=None, parameters=None, objects=None):
+    if operation == "ssm.GetParameters":
+        found = [n for n in params["Names"] if n in parameters]
+        return {
+            "Parameters": [{"Name": n, "Value": parameters[n]} for n in found],
+            "InvalidParameters": [n for n in params["Names"] if n not in parameters],
+        }
+
+    if operation == "ssm.GetParameter":
+        if params["Name"] not in parameters:
+            raise RuntimeError(f"Benchmark has no value for {params['Name']}")
+        return {
+            "Parameter": {"Name": params["Name"], "Value": parameters[params["Name"]]}
+        }
+
+    if operation == "secretsmanager.GetSecretValue":
+        return {"SecretString": "benchmark-token", "VersionId": "v1"}
+
+    if operation == "secretsmanager.DescribeSecret":
+        return {"VersionIdsToStages": {"v1": ["AWSCURRENT"]}}
+
+    if operation == "sts.GetCallerIdentity":
+        return {"Account": "000000000000", "Arn": "arn:aws:sts::000000000000:benchmark"}
+
+    if operation in ("s3.HeadObject", "s3.GetObject"):
+        data = objects[params["Key"]]
+        if "Range" in params:
+            start, end = params["Range"].split("=", 1)[1].split("-")
+            data = data[int(start) : int(end) + 1]
+        response = {"ContentLength": len(data), "ETag": f'"{etag(data)}"'}
+        if operation == "s3.GetObject":
+            response["Body"] = StreamingBody(io.BytesIO(data), len(data))
+        return response
+
+    if operation == "s3.ListObjectsV2":
+        keys = sorted(
+            key
+            for key in objects
+            if key.startswith(params.get("Prefix", ""))
+            and key > params.get("StartAfter", "")
+        )
+        return {
+            "Contents": [
+                {
+                    "Key": key,
+                    "ETag": f'"{etag(objects[key])}"',
+                    "Size": len(objects[key]),
+                }
+                for key in keys
+            ],
+            "KeyCount": len(keys),
+            "IsTruncated": False,
+        }
+
+    raise RuntimeError(f"Benchmark does not stub {operation}")
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# Stubbed Tower
+# ---------------------------------------------------------------------------------------------------------------
+def install_fake_tw(directory=None, delay=0.0):
+    """
+    Write the fake `tw` executable and put it first on PATH.
+    """
+    tw = pathlib.Path(directory, "tw")
+    tw.write_text(FAKE_TW.format(python=sys.executable))
+    tw.chmod(tw.stat().st_mode | stat.S_IEXEC)
+    os.environ["PATH"] = f"{directory}{os.pathsep}{os.environ['PATH']}"
+    os.environ["BENCHMARK_TW_DELAY"] = str(delay)
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# Events
+# ---------------------------------------------------------------------------------------------------------------
+def load_event(name=None):
+    with open(TESTING_DIR / f"test_event_{name}.json") as f:
+        return json.load(f)
+
+
+def make_record(template=None, key=None, data=None, sequence=None):
+    record = json.loads(json.dumps(template))
+    record["s3"]["object"]["key"] = key
+    record["s3"]["object"]["size"] = len(data)
+    record["s3"]["object"]["eTag"] = etag(data)
+    record["s3"]["object"]["sequencer"] = f"{sequence:016X}"
+    return record
+
+
+def make_large_samplesheet(rows=None, rng=None):
+    """
+    Build a samplesheet with `rows` rows by cycling the example samplesheet's rows under new sample names.
+    """
+    lines = SAMPLESHEET.read_text().splitlines()
+    header, body = lines[0], lines[1:]
+    out = [header]
+    for i in range(rows):
+        fields = rng.choice(body).split(",")
+        fields[0] = f"{fields[0]}_{i}"
+        out.append(",".join(fields))
+    return ("\n".join(out) + "\n").encode("utf-8")
+
+
+def build_scenarios(args=None, rng=None):
+    """
+    Return the S3 objects the stubbed bucket holds and a factory per scenario producing a fresh event.
+    Sequencers increase per event so idempotency keys never collide between iterations.
+    """
+    template = load_event(name="good")["Records"][0]
+    samplesheet = SAMPLESHEET.read_bytes()
+    large = make_large_samplesheet(rows=args.rows, rng=rng)
+    large_key = "lambda_tutorial/bench/large.csv"
+    if args.compression == "gz":
+        import gzip
+
+        large, large_key = gzip.compress(large), f"{large_key}.gz"
+    elif args.compression == "zst":
+        import zstandard
+
+        large, large_key = (
+            zstandard.ZstdCompressor().compress(large),
+            f"{large_key}.zst",
+        )
+    objects = {
+        "lambda_tutorial/samplesheet_full.csv": samplesheet,
+        large_key: large,
+    }
+    for i in range(args.records):
+        objects[f"lambda_tutorial/bench/multi_{i}.csv"] = samplesheet
+
+    sequence = itertools.count(1)
+    lock = threading.Lock()
+
+    def next_sequence():
+        with lock:
+            return next(sequence)
+
+    def replay(name):
+        def factory():
+            event = load_event(name=name)
+            event["Records"][0]["s3"]["object"]["sequencer"] = f"{next_sequence():016X}"
+            return event
+
+        return factory
+
+    def multi_record():
+        return {
+            "Records": [
+                make_record(
+                    template=template,
+                    key=f"lambda_tutorial/bench/multi_{i}.csv",
+                    data=samplesheet,
+                    sequence=next_sequence(),
+                )
+                for i in range(args.records)
+            ]
+        }
+
+    def large_samplesheet():
+        return {
+            "Records": [
+                make_record(
+                    template=template,
+                    key=large_key,
+                    data=large,
+                    sequence=next_sequence(),
+                )
+            ]
+        }
+
+    def worker():
+        # One single-record event per spool file, as S3 notifications would arrive one by one.
+        return [{"Records": [record]} for record in multi_record()["Records"]]
+
+    def sqs_batch():
+        # Fresh, increasing sequencers per record while keeping their relative order within the batch.
+        event = load_event(name="sqs_batch")
+        for message in event["Records"]:
+            body = json.loads(message["body"])
+            for record in body.get("Records", []):
+                record["s3"]["object"]["sequencer"] = f"{next_sequence():016X}"
+            message["body"] = json.dumps(body)
+        return event
+
+    factories = {
+        "good": replay("good"),
+        "bad_prefix": replay("bad_prefix"),
+        "bad_file": replay("bad_file"),
+        "multi_record": multi_record,
+        "large_samplesheet": large_samplesheet,
+        "sqs_batch": sqs_batch,
+        # `app.backfill` lists the bucket itself.
+        "backfill": None,
+        "worker": worker,
+    }
+    return objects, factories
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------------------------------------------
+class MetricCapture(io.TextIOBase):
+    """
+    Stand-in for stdout which keeps the handler's embedded-metric lines and discards everything else.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def write(self, text):
+        for line in text.splitlines():
+            if line.startswith('{"_aws"'):
+                entry = json.loads(line)
+                with self.lock:
+                    self.spans.append((entry["Stage"], entry["Duration"]))
+        return len(text)
+
+
+# Workspaces replaced by `reset_caches`. Events still in flight may be using them, so they're closed at the end.
+_retired_workspaces = []
+
+
+def reset_caches():
+    """
+    Return the module to its cold-start state.
+    """
+    app._session_cache.update({"session": None, "expiration": None, "clients": {}})
+    app._parameter_cache.update({"values": {}, "fetched_at": None})
+    app._secret_cache.update({"values": None, "version_id": None, "checked_at": None})
+    app._routing_cache.update({"source": None, "table": None})
+    app._tower_index.update({"datasets": {}, "pipelines": {}})
+    _retired_workspaces.append(app._workspace)
+    app._workspace = app.Workspace(
+        root=app.WORKSPACE_DIR, max_bytes=app._workspace._max_bytes
+    )
+    app._metrics_state["cold_start"] = True
+
+
+def percentile(values=None, pct=None):
+    """
+    Nearest-rank percentile.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def run_worker(events=None, args=None):
+    """
+    Spool `events` into a temporary directory and run `app.worker` over it until every file is processed.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        for index, event in enumerate(events):
+            (pathlib.Path(directory) / f"{index:06d}.json").write_text(
+                json.dumps(event)
+            )
+
+        stop = threading.Event()
+
+        def stop_when_drained():
+            while not stop.is_set():
+                state = app.get_worker_metrics()
+                if (
+                    state.get("status") == "running"
+                    and state["messages"] >= len(events)
+                    and not state["in_flight"]
+                ):
+                    stop.set()
+                time.sleep(0.005)
+
+        threading.Thread(target=stop_when_drained, daemon=True).start()
+        return app.worker(
+            source=f"spool:{directory}",
+            concurrency=args.concurrency,
+            batch_size=app.WORKER_BATCH_SIZE,
+            poll_seconds=1,
+            port=0,
+            stop=stop,
+        )
+
+
+def run_scenario(name=None, factory=None, args=None, capture=None):
+    def invoke(_):
+        if args.cold:
+            reset_caches()
+        started = time.perf_counter()
+        try:
+            if name == "backfill":
+                result = app.backfill(
+                    bucket="benchmark",
+                    prefix="lambda_tutorial/bench/",
+                    max_workers=args.concurrency,
+                    tower_rate=args.backfill_tower_rate,
+                    tower_burst=args.backfill_tower_rate,
+                )
+                status = f"{result['message']} {result['completed']} completed"
+            elif name == "worker":
+                result = run_worker(events=factory(), args=args)
+                status = f"{result['records'].get('completed', 0)} completed"
+            elif name == "sqs_batch":
+                result = app.sqs_handler(factory(), None)
+                status = f"{len(result['batchItemFailures'])} batch item failure(s)"
+            else:
+                result = app.handler(factory(), None)
+                status = result["message"]
+        except Exception as e:
+            status = f"error: {e}"
+        return status, (time.perf_counter() - started) * 1000
+
+    # A worker already runs `args.concurrency` batches at a time, and there is one per process.
+    pool_size = 1 if name == "worker" else args.concurrency
+    with concurrent.futures.ThreadPoolExecutor(max_workers=pool_size) as pool:
+        list(pool.map(invoke, range(args.warmup)))
+
+        with capture.lock:
+            capture.spans.clear()
+        started = time.perf_counter()
+        outcomes = list(pool.map(invoke, range(args.iterations)))
+        elapsed = time.perf_counter() - started
+
+    with capture.lock:
+        spans = list(capture.spans)
+
+    stages = {}
+    for stage, duration in spans:
+        stages.setdefault(stage, []).append(duration)
+    latencies = [duration for _, duration in outcomes]
+
+    statuses = {}
+    for status, _ in outcomes:
+        statuses[status] = statuses.get(status, 0) + 1
+
+    def summary(values):
+        return {
+            "count": len(values),
+            "p50_ms": percentile(values, 50),
+            "p95_ms": percentile(values, 95),
+            "p99_ms": percentile(values, 99),
+        }
+
+    return {
+        "scenario": name,
+        "events": args.iterations,
+        "concurrency": args.concurrency,
+        "events_per_sec": round(args.iterations / elapsed, 2),
+        "statuses": statuses,
+        "end_to_end": summary(latencies),
+        "stages": {stage: summary(values) for stage, values in sorted(stages.items())},
+    }
+
+
+def print_report(reports=None):
+    for report in reports:
+        print(
+            f"\n== {report['scenario']}: {report['events']} events @ concurrency "
+            f"{report['concurrency']} -> {report['events_per_sec']} events/sec"
+        )
+        print(f"   outcomes: {report['statuses']}")
+        print(f"   {'stage':<28}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}")
+        rows = [("end_to_end", report["end_to_end"])] + list(report["stages"].items())
+        for stage, s in rows:
+            print(
+                f"   {stage:<28}{s['count']:>8}{s['p50_ms']:>12.2f}"
+                f"{s['p95_ms']:>12.2f}{s['p99_ms']:>12.2f}"
+            )
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    logging.getLogger("lambda_tutorial").setLevel(logging.ERROR)
+
+    objects, factories = build_scenarios(args=args, rng=rng)
+
+    server, endpoint = start_stub_tower(delay=args.tower_delay)
+    parameters = {
+        "/lambda_tutorial/logging_level": "ERROR",
+        "/lambda_tutorial/workspace_id": "34830707738561",
+        "/lambda_tutorial/s3_root_prefix": "lambda_tutorial",
+        "/lambda_tutorial/samplesheet_file_types": "csv,tsv,csv.gz,csv.zst",
+        "/lambda_tutorial/target_pipeline_name": "benchmark-pipeline",
+        "/lambda_tutorial/tower_api_endpoint": endpoint,
+        "/lambda_tutorial/tower_client": args.tower_client,
+        "/lambda_tutorial/samplesheet_transfer_mode": args.transfer_mode,
+        "/lambda_tutorial/shard_size": str(args.shard_size),
+        "/lambda_tutorial/shard_group_column": args.shard_group_column,
+        "/lambda_tutorial/samplesheet_schema": args.samplesheet_schema,
+    }
+
+    def stub_generate_session(execution_role=None):
+        session = make_stub_session(
+            parameters=parameters, objects=objects, aws_delay=args.aws_delay
+        )
+        return session, None
+
+    app.generate_session = stub_generate_session
+    if args.workspace_max_bytes is not None:
+        app._workspace = app.Workspace(
+            root=app.WORKSPACE_DIR, max_bytes=args.workspace_max_bytes
+        )
+    reset_caches()
+
+    reports = []
+    capture = MetricCapture()
+    with tempfile.TemporaryDirectory() as directory:
+        install_fake_tw(directory=directory, delay=args.tw_delay)
+        if args.prewarm:
+            app.PREWARM = True
+            app.prewarm()
+        for name in args.scenarios:
+            with contextlib.redirect_stdout(capture):
+                reports.append(
+                    run_scenario(
+                        name=name, factory=factories[name], args=args, capture=capture
+                    )
+                )
+
+    server.shutdown()
+    for workspace in [*_retired_workspaces, app._workspace]:
+        workspace.close()
+    print_report(reports=reports)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
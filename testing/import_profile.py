@@ -0,0 +1,140 @@
+"""
+Import-time profile for `app.py`.
+
+Imports the handler module in fresh interpreters with `python -X importtime` and reports the total import time
+plus the modules that contribute most to it. This is the part of a Lambda cold start the function's own code
+controls, so comparing the report between releases shows whether a change made cold starts slower.
+
+The Docker build runs this script and stores the report in the image at `/var/task/import_profile.txt`:
+    $ docker run --rm --entrypoint cat lambda_tutorial:v1.0 /var/task/import_profile.txt
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python testing/import_profile.py --runs 10 --top 25
+"""
+
+import argparse
+import datetime
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--module", default="app", help="Module to import (default: app)."
+    )
+    parser.add_argument(
+        "--path",
+        default=str(REPO_ROOT),
+        help="Directory the module is imported from (default: repository root).",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help="Timed imports. The median of each module's timings is reported.",
+    )
+    parser.add_argument(
+        "--top", type=int, default=20, help="Modules listed in the report."
+    )
+    parser.add_argument("--output", help="Also write the report to this path.")
+    return parser.parse_args()
+
+
+def profile_import(module=None, path=None):
+    """
+    Import `module` in a fresh interpreter and return {module name: (self us, cumulative us, depth)}.
+    Prewarming is switched off so the profile only covers imports, never AWS calls.
+    """
+    env = dict(os.environ, LAMBDA_TUTORIAL_PREWARM="false")
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=path,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    timings = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        timings[name.strip()] = (int(self_us), int(cumulative_us), depth)
+
+    return timings
+
+
+def build_report(module=None, runs=None, top=None):
+    """
+    Combine the timings from every run (median per module) into a plain-text report.
+    """
+    names = {}
+    for timings in runs:
+        for name, (self_us, cumulative_us, depth) in timings.items():
+            entry = names.setdefault(
+                name, {"self": [], "cumulative": [], "depth": depth}
+            )
+            entry["self"].append(self_us)
+            entry["cumulative"].append(cumulative_us)
+
+    rows = {
+        name: (
+            statistics.median(entry["self"]),
+            statistics.median(entry["cumulative"]),
+            entry["depth"],
+        )
+        for name, entry in names.items()
+    }
+    total_ms = rows[module][1] / 1000 if module in rows else 0.0
+    direct = sorted(
+        ((name, row) for name, row in rows.items() if row[2] == 1),
+        key=lambda item: item[1][1],
+        reverse=True,
+    )
+    heaviest = sorted(rows.items(), key=lambda item: item[1][0], reverse=True)
+
+    lines = [
+        f"Import-time profile for `{module}`",
+        f"Generated: {datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M UTC')}",
+        f"Python: {platform.python_version()} ({platform.machine()})",
+        f"Runs: {len(runs)} (median reported)",
+        "",
+        f"Total import time: {total_ms:.1f} ms",
+        "",
+        "Direct imports by cumulative time (ms):",
+    ]
+    for name, (self_us, cumulative_us, _) in direct[:top]:
+        lines.append(f"   {cumulative_us / 1000:10.2f}   {name}")
+    lines += ["", "Heaviest modules by self time (ms):"]
+    for name, (self_us, cumulative_us, _) in heaviest[:top]:
+        lines.append(f"   {self_us / 1000:10.2f}   {name}")
+
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    args = parse_args()
+
+    # The first import also compiles bytecode, which a deployed image has already done. Discard it.
+    profile_import(module=args.module, path=args.path)
+    runs = [
+        profile_import(module=args.module, path=args.path) for _ in range(args.runs)
+    ]
+
+    report = build_report(module=args.module, runs=runs, top=args.top)
+    sys.stdout.write(report)
+    if args.output:
+        pathlib.Path(args.output).write_text(report)
+
+
+if __name__ == "__main__":
+    main()
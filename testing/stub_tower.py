@@ -0,0 +1,168 @@
+"""
+Local stub of the Tower API endpoints used by `app.tower_api_*`, shared by `testing/benchmark.py` and the
+Tower API client tests (`testing/test_tower_api.py`).
+
+Example:
+    server, endpoint = start_stub_tower()
+    tw_params = {"/lambda_tutorial/tower_api_endpoint": endpoint, ...}
+    ...
+    server.shutdown()
+"""
+
+import http.server
+import itertools
+import json
+import threading
+import time
+import urllib.parse
+
+
+class StubTowerHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Minimal Tower API stub covering the endpoints used by `app.tower_api_*`.
+    Every request is appended to `requests` as `(method, path)`. Responses queued in `scripted` (as
+    `(status, payload)`) are returned, in order, ahead of the normal ones, e.g. to fail a call with a `503`.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this, delayed ACKs add ~40ms per request.
+    disable_nagle_algorithm = True
+    delay = 0.0
+    counter = itertools.count(1)
+    # Dataset id -> [name, latest version]. As in Tower, creating a dataset under a name that is taken is
+    # rejected with a 409, and the listing takes `search`, `max` and `offset`.
+    datasets = {}
+    datasets_lock = threading.Lock()
+    requests = []
+    scripted = []
+
+    @classmethod
+    def reset(cls):
+        """
+        Forget every dataset, request and scripted response.
+        """
+        with cls.datasets_lock:
+            cls.datasets.clear()
+            cls.requests.clear()
+            cls.scripted.clear()
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        """
+        Read the request body, whether sent with a Content-Length or with chunked transfer encoding
+        (compressed samplesheets).
+        """
+        if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b";", 1)[0], 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if size == 0:
+                return b"".join(chunks)
+
+    def respond(self, payload, status=200):
+        if self.delay:
+            time.sleep(self.delay)
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond_scripted(self):
+        """
+        Record the request and send the next scripted response, if any. Returns whether one was sent.
+        """
+        with self.datasets_lock:
+            self.requests.append((self.command, self.path))
+            scripted = self.scripted.pop(0) if self.scripted else None
+        if scripted is None:
+            return False
+        status, payload = scripted
+        self.respond(payload, status=status)
+        return True
+
+    def do_GET(self):
+        if self.respond_scripted():
+            return
+        path = self.path.split("?", 1)[0].strip("/").split("/")
+        if path[-1] == "datasets":
+            query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+            with self.datasets_lock:
+                listing = [
+                    {"id": dataset_id, "name": name}
+                    for dataset_id, (name, _) in self.datasets.items()
+                    if query.get("search", "") in name
+                ]
+            offset = int(query.get("offset", 0))
+            listing = listing[offset : offset + int(query.get("max", len(listing)))]
+            self.respond({"datasets": listing})
+        elif path[-1] == "versions":
+            url = f"https://tower.stub/datasets/{path[3]}/v/1/n/samplesheet.csv"
+            self.respond({"versions": [{"version": 1, "url": url}]})
+        elif path == ["pipelines"]:
+            name = self.path.split("search=", 1)[1].split("&", 1)[0]
+            self.respond({"pipelines": [{"pipelineId": 1, "name": name}]})
+        elif path[0] == "pipelines" and path[-1] == "launch":
+            launch = {
+                "computeEnv": {"id": "benchmark"},
+                "pipeline": "https://github.com/nf-core/rnaseq",
+                "workDir": "s3://benchmark/work",
+                "paramsText": "{}",
+            }
+            self.respond({"launch": launch})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        # Drain the request body so the connection can be reused.
+        body = self.read_body()
+        if self.respond_scripted():
+            return
+        path = self.path.split("?", 1)[0].strip("/").split("/")
+        if path[-1] == "datasets":
+            name = json.loads(body)["name"]
+            with self.datasets_lock:
+                taken = any(entry[0] == name for entry in self.datasets.values())
+                if not taken:
+                    dataset_id = f"ds{next(self.counter)}"
+                    self.datasets[dataset_id] = [name, 0]
+            if taken:
+                self.respond({"message": "Duplicated element"}, status=409)
+            else:
+                self.respond({"dataset": {"id": dataset_id}})
+        elif path[-1] == "upload":
+            with self.datasets_lock:
+                entry = self.datasets[path[3]]
+                entry[1] += 1
+                version = entry[1]
+            url = f"https://tower.stub/datasets/{path[3]}/v/{version}/n/samplesheet.csv"
+            self.respond(
+                {"version": {"datasetId": path[3], "version": version, "url": url}}
+            )
+        elif path == ["workflow", "launch"]:
+            launch = json.loads(body)["launch"]
+            self.respond(
+                {
+                    "workflowId": f"wf{next(self.counter)}",
+                    "paramsText": launch["paramsText"],
+                }
+            )
+        else:
+            self.send_error(404)
+
+
+def start_stub_tower(delay=0.0):
+    """
+    Start the stub Tower API on a free local port. Returns the server and its endpoint URL.
+    """
+    StubTowerHandler.delay = delay
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubTowerHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
@@ -0,0 +1,179 @@
+"""
+Tests for the bulk backfill (`app.backfill`): checkpointing an interrupted run, resuming from the checkpoint and
+retrying the objects that failed.
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python -m pytest testing
+"""
+
+import datetime
+import pathlib
+import sys
+import time
+import unittest
+from unittest import mock
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import boto3  # noqa: E402
+from botocore.stub import Stubber  # noqa: E402
+
+import app  # noqa: E402
+
+BUCKET = "bucket"
+PREFIX = "lambda_tutorial/"
+TW_PARAMS = {
+    "/lambda_tutorial/workspace_id": "34830707738561",
+    "/lambda_tutorial/s3_root_prefix": "lambda_tutorial",
+    "/lambda_tutorial/samplesheet_file_types": "csv",
+    "/lambda_tutorial/target_pipeline_name": "nf-core-rnaseq",
+}
+
+
+def listed(key=None):
+    return {
+        "Key": key,
+        "ETag": f'"{key[-5]}"',
+        "Size": 10,
+        "LastModified": datetime.datetime(2026, 10, 17),
+    }
+
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        client = boto3.client(
+            "s3",
+            region_name="us-east-1",
+            aws_access_key_id="test",
+            aws_secret_access_key="test",
+        )
+        self.stubber = Stubber(client)
+        self.stubber.activate()
+        # Key -> status returned by process_record (default "completed").
+        self.statuses = {}
+        self.processed = []
+        self.patches = [
+            mock.patch.object(app, "get_client", return_value=client),
+            mock.patch.object(
+                app, "get_session_and_parameters", return_value=(None, TW_PARAMS)
+            ),
+            mock.patch.object(app, "prepare_tower_credentials"),
+            mock.patch.object(app, "process_record", side_effect=self.process_record),
+            mock.patch.dict(app._routing_cache, {"source": None, "table": None}),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        self.stubber.deactivate()
+
+    def process_record(self, record=None, **kwargs):
+        key = record["s3"]["object"]["key"]
+        self.processed.append(key)
+        return {"status": self.statuses.get(key, "completed")}
+
+    def expect_listing(self, keys=None, start_after=""):
+        self.stubber.add_response(
+            "list_objects_v2",
+            {
+                "Contents": [listed(key=PREFIX + key) for key in keys],
+                "IsTruncated": False,
+            },
+            expected_params={
+                "Bucket": BUCKET,
+                "Prefix": PREFIX,
+                "StartAfter": start_after,
+            },
+        )
+
+    def run_backfill(self, checkpoint=None, deadline=None):
+        saved = []
+        result = app.backfill(
+            bucket=BUCKET,
+            checkpoint=checkpoint,
+            max_workers=1,
+            tower_rate=0,
+            deadline=deadline,
+            save_checkpoint=saved.append,
+        )
+        self.assertEqual(saved[-1], result["checkpoint"])
+        return result
+
+    def test_interrupted_run_resumes_from_its_checkpoint(self):
+        self.statuses[PREFIX + "a.csv"] = "retry"
+        self.expect_listing(keys=["a.csv", "b.csv", "c.csv", "d.csv"])
+
+        # The deadline passes once `a` and `b` have been taken (set-up is called once, then once per object).
+        offset = {"seconds": 0}
+        calls = []
+
+        def get_session_and_parameters():
+            calls.append(None)
+            if len(calls) == 3:
+                offset["seconds"] = 1000
+            return None, TW_PARAMS
+
+        monotonic = time.monotonic
+        with mock.patch.object(
+            app, "get_session_and_parameters", side_effect=get_session_and_parameters
+        ), mock.patch.object(
+            app.time, "monotonic", side_effect=lambda: monotonic() + offset["seconds"]
+        ):
+            first = self.run_backfill(deadline=monotonic() + 500)
+
+        self.assertFalse(first["complete"])
+        self.assertEqual(
+            (first["listed"], first["completed"], first["retry"]), (2, 1, 1)
+        )
+        checkpoint = first["checkpoint"]
+        self.assertEqual(checkpoint["start_after"], PREFIX + "b.csv")
+        self.assertEqual(
+            checkpoint["failed"], [{"key": PREFIX + "a.csv", "eTag": "a", "size": 10}]
+        )
+
+        # Resume: the failed object is retried first, then the listing carries on after `b`.
+        del self.statuses[PREFIX + "a.csv"]
+        self.processed.clear()
+        self.expect_listing(keys=["c.csv", "d.csv"], start_after=PREFIX + "b.csv")
+
+        second = self.run_backfill(checkpoint=checkpoint)
+
+        self.assertTrue(second["complete"])
+        self.assertEqual(
+            self.processed, [PREFIX + "a.csv", PREFIX + "c.csv", PREFIX + "d.csv"]
+        )
+        self.assertEqual((second["listed"], second["completed"]), (2, 3))
+        self.assertEqual(second["checkpoint"]["start_after"], PREFIX + "d.csv")
+        self.assertEqual(second["checkpoint"]["failed"], [])
+        self.stubber.assert_no_pending_responses()
+
+    def test_objects_failing_again_stay_in_the_checkpoint(self):
+        self.statuses[PREFIX + "a.csv"] = "retry"
+        self.statuses[PREFIX + "c.csv"] = "retry"
+        self.statuses[PREFIX + "d.csv"] = "ceased"
+        self.expect_listing(
+            keys=["c.csv", "d.csv", "notes.txt"], start_after=PREFIX + "b.csv"
+        )
+        checkpoint = {
+            "start_after": PREFIX + "b.csv",
+            "failed": [{"key": PREFIX + "a.csv", "eTag": "a", "size": 10}],
+        }
+
+        result = self.run_backfill(checkpoint=checkpoint)
+
+        self.assertEqual(
+            (result["retry"], result["ceased"], result["out_of_scope"]), (2, 1, 1)
+        )
+        self.assertEqual(
+            sorted(obj["key"] for obj in result["checkpoint"]["failed"]),
+            [PREFIX + "a.csv", PREFIX + "c.csv"],
+        )
+        # Ceased and out-of-scope objects are finished; only retryable failures are kept.
+        self.assertEqual(result["checkpoint"]["start_after"], PREFIX + "notes.txt")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+"""
+Tests for compressed samplesheets: gzip and zstd detection and decompression when downloading
+(`app.download_samplesheet`) and when streaming (`app.stream_samplesheet`).
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python -m pytest testing
+"""
+
+import gzip
+import hashlib
+import io
+import pathlib
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import zstandard  # noqa: E402
+
+import app  # noqa: E402
+
+CSV = b"sample,fastq_1,fastq_2\n" + b"".join(
+    b"S%d,s3://bucket/S%d_R1.fq.gz,s3://bucket/S%d_R2.fq.gz\n" % (i, i, i)
+    for i in range(2000)
+)
+TSV = CSV.replace(b",", b"\t")
+COMPRESSORS = {"gz": gzip.compress, "zst": zstandard.ZstdCompressor().compress}
+
+
+class FakeS3:
+    """
+    Just enough of an S3 client for `download_samplesheet` and `stream_samplesheet`.
+    """
+
+    def __init__(self, content=None):
+        self.content = content
+
+    def download_file(self, bucket, key, local_path):
+        pathlib.Path(local_path).write_bytes(self.content)
+
+    def get_object(self, Bucket=None, Key=None):
+        return {"ContentLength": len(self.content), "Body": io.BytesIO(self.content)}
+
+
+def make_record(key=None, content=None):
+    return {
+        "s3": {
+            "bucket": {"name": "bucket"},
+            "object": {
+                "key": key,
+                "size": len(content),
+                "eTag": hashlib.md5(content).hexdigest(),
+            },
+        }
+    }
+
+
+class CompressedSamplesheetTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.workspace = app.Workspace(root=self.root.name, max_bytes=10**8)
+        self.patches = [
+            mock.patch.object(app, "_workspace", self.workspace),
+            mock.patch.object(app, "STREAM_CHUNK_SIZE", 4096),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        self.workspace.close()
+        self.root.cleanup()
+
+    def download(self, key=None, content=None):
+        with mock.patch.object(app, "get_client", return_value=FakeS3(content=content)):
+            return app.download_samplesheet(
+                record=make_record(key=key, content=content)
+            )
+
+    def stream(self, key=None, content=None):
+        with mock.patch.object(app, "get_client", return_value=FakeS3(content=content)):
+            samplesheet_stream, dataset_name = app.stream_samplesheet(
+                record=make_record(key=key, content=content)
+            )
+        chunks = list(
+            app.iter_samplesheet_chunks(samplesheet_stream=samplesheet_stream)
+        )
+        return samplesheet_stream, dataset_name, chunks
+
+    def test_download_is_decompressed_and_named_after_its_inner_file(self):
+        for suffix, compress in COMPRESSORS.items():
+            with self.subTest(suffix=suffix):
+                path, dataset_name = self.download(
+                    key=f"lambda_tutorial/run.1.csv.{suffix}", content=compress(CSV)
+                )
+
+                self.assertEqual(pathlib.Path(path).name, "run.1.csv")
+                self.assertEqual(pathlib.Path(path).read_bytes(), CSV)
+                self.assertEqual(dataset_name, "run_1")
+                # Only the decompressed copy is left.
+                self.assertEqual(
+                    list(pathlib.Path(path).parent.iterdir()), [pathlib.Path(path)]
+                )
+                self.workspace.release(path=path)
+
+    def test_file_type_without_an_inner_extension_comes_from_the_header(self):
+        for suffix, compress in COMPRESSORS.items():
+            for content, expected in [(CSV, "run.csv"), (TSV, "run.tsv")]:
+                with self.subTest(suffix=suffix, expected=expected):
+                    path, _ = self.download(
+                        key=f"lambda_tutorial/run.{suffix}", content=compress(content)
+                    )
+                    self.assertEqual(pathlib.Path(path).name, expected)
+                    self.workspace.release(path=path)
+
+                    samplesheet_stream, _, _ = self.stream(
+                        key=f"lambda_tutorial/run.{suffix}", content=compress(content)
+                    )
+                    self.assertEqual(samplesheet_stream["filename"], expected)
+
+    def test_stream_is_decompressed_a_chunk_at_a_time(self):
+        for suffix, compress in COMPRESSORS.items():
+            # Compressed objects read in one call and ones kept open as a stream.
+            for threshold in [10**8, 0]:
+                with self.subTest(
+                    suffix=suffix, threshold=threshold
+                ), mock.patch.object(app, "STREAM_IN_MEMORY_THRESHOLD", threshold):
+                    samplesheet_stream, dataset_name, chunks = self.stream(
+                        key=f"lambda_tutorial/run.tsv.{suffix}", content=compress(TSV)
+                    )
+
+                    self.assertEqual(samplesheet_stream["filename"], "run.tsv")
+                    # The decompressed size isn't known until the stream is read.
+                    self.assertIsNone(samplesheet_stream["size"])
+                    self.assertEqual(dataset_name, "run")
+                    self.assertEqual(b"".join(chunks), TSV)
+                    self.assertLessEqual(max(len(chunk) for chunk in chunks), 4096)
+
+    def test_uncompressed_samplesheets_are_left_alone(self):
+        path, _ = self.download(key="lambda_tutorial/run.csv", content=CSV)
+        self.assertEqual(pathlib.Path(path).read_bytes(), CSV)
+
+        samplesheet_stream, _, chunks = self.stream(
+            key="lambda_tutorial/run.csv", content=CSV
+        )
+        self.assertEqual(samplesheet_stream["size"], len(CSV))
+        self.assertEqual(b"".join(chunks), CSV)
+
+    def test_corrupt_or_binary_archives_are_ceased(self):
+        for suffix, compress in COMPRESSORS.items():
+            for content in [b"not compressed at all", compress(b"\x00\x01binary\n")]:
+                with self.subTest(suffix=suffix, content=content[:8]):
+                    key = f"lambda_tutorial/run.csv.{suffix}"
+                    with self.assertRaises(app.CeaseEventProcessing):
+                        self.download(key=key, content=content)
+                    with self.assertRaises(app.CeaseEventProcessing):
+                        self.stream(key=key, content=content)
+
+        # Nothing is left behind in the workspace.
+        self.assertEqual(list(self.workspace._dir.glob("scratch/*")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,243 @@
+"""
+Tests for the claim step of the idempotency stores (`app.SqliteIdempotencyStore`, `app.DynamoDbIdempotencyStore`)
+and `app.process_record`.
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python -m pytest testing
+"""
+
+import pathlib
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import boto3  # noqa: E402
+from botocore.stub import ANY, Stubber  # noqa: E402
+
+import app  # noqa: E402
+
+
+def later(seconds=60):
+    return time.time() + seconds
+
+
+class SqliteClaimTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.root.name) / "idempotency.db"
+        self.store = app.SqliteIdempotencyStore(path=self.path.as_posix())
+
+    def tearDown(self):
+        self.store._connection.close()
+        self.root.cleanup()
+
+    def test_claim_is_exclusive_until_released(self):
+        self.assertEqual(self.store.claim("key", "first", expires_at=later()), {})
+        self.assertIsNone(self.store.claim("key", "second", expires_at=later()))
+
+        self.store.release("key", "second")
+        self.assertIsNone(self.store.claim("key", "second", expires_at=later()))
+
+        self.store.release("key", "first")
+        self.assertEqual(self.store.claim("key", "second", expires_at=later()), {})
+
+    def test_claim_returns_stages_recorded_before_it(self):
+        self.store.put_stage("key", "dataset_created", {"datasetId": "abc"})
+
+        self.assertEqual(
+            self.store.claim("key", "first", expires_at=later()),
+            {"dataset_created": {"datasetId": "abc"}},
+        )
+
+    def test_expired_claim_is_taken_over(self):
+        self.store.claim("key", "first", expires_at=later(-1))
+
+        self.assertEqual(self.store.claim("key", "second", expires_at=later()), {})
+        self.assertIsNone(self.store.claim("key", "third", expires_at=later()))
+
+    def test_claim_is_exclusive_across_connections(self):
+        other = app.SqliteIdempotencyStore(path=self.path.as_posix())
+        try:
+            self.assertEqual(self.store.claim("key", "first", expires_at=later()), {})
+            self.assertIsNone(other.claim("key", "second", expires_at=later()))
+        finally:
+            other._connection.close()
+
+
+class DynamoDbClaimTest(unittest.TestCase):
+    def setUp(self):
+        client = boto3.client(
+            "dynamodb",
+            region_name="us-east-1",
+            aws_access_key_id="test",
+            aws_secret_access_key="test",
+        )
+        self.stubber = Stubber(client)
+        self.stubber.activate()
+        self.store = app.DynamoDbIdempotencyStore(
+            client=client, table_name="lambda_tutorial_idempotency"
+        )
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def test_claim_is_a_conditional_write(self):
+        self.stubber.add_response(
+            "update_item",
+            {
+                "Attributes": {
+                    "idempotency_key": {"S": "key"},
+                    "dataset_created": {"S": '{"datasetId": "abc"}'},
+                    "claim_owner": {"S": "first"},
+                }
+            },
+            expected_params={
+                "TableName": "lambda_tutorial_idempotency",
+                "Key": {"idempotency_key": {"S": "key"}},
+                "UpdateExpression": ANY,
+                "ConditionExpression": "attribute_not_exists(claim_owner) OR claim_expires_at < :now",
+                "ExpressionAttributeValues": {
+                    ":owner": {"S": "first"},
+                    ":claim_expires_at": {"N": "2000000000"},
+                    ":expires_at": ANY,
+                    ":now": ANY,
+                },
+                "ReturnValues": "ALL_NEW",
+            },
+        )
+
+        stages = self.store.claim("key", "first", expires_at=2000000000.5)
+
+        self.assertEqual(stages, {"dataset_created": {"datasetId": "abc"}})
+        self.stubber.assert_no_pending_responses()
+
+    def test_claim_held_elsewhere_returns_none(self):
+        self.stubber.add_client_error(
+            "update_item", service_error_code="ConditionalCheckFailedException"
+        )
+
+        self.assertIsNone(self.store.claim("key", "second", expires_at=later()))
+
+    def test_release_only_removes_its_own_claim(self):
+        self.stubber.add_client_error(
+            "update_item",
+            service_error_code="ConditionalCheckFailedException",
+            expected_params={
+                "TableName": "lambda_tutorial_idempotency",
+                "Key": {"idempotency_key": {"S": "key"}},
+                "UpdateExpression": "REMOVE claim_owner, claim_expires_at",
+                "ConditionExpression": "claim_owner = :owner",
+                "ExpressionAttributeValues": {":owner": {"S": "second"}},
+            },
+        )
+
+        # A claim taken over by another delivery is left alone, without failing the record.
+        self.store.release("key", "second")
+        self.stubber.assert_no_pending_responses()
+
+    def test_other_errors_are_retryable(self):
+        self.stubber.add_client_error(
+            "update_item", service_error_code="ProvisionedThroughputExceededException"
+        )
+
+        with self.assertRaises(Exception) as raised:
+            self.store.claim("key", "first", expires_at=later())
+        self.assertNotIsInstance(raised.exception, app.CeaseEventProcessing)
+
+
+class ProcessRecordClaimTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.tw_params = {
+            "/lambda_tutorial/idempotency_store": f"sqlite:{self.root.name}/idempotency.db",
+            "/lambda_tutorial/target_pipeline_name": "nf-core-rnaseq",
+        }
+        self.record = {
+            "s3": {
+                "bucket": {"name": "bucket"},
+                "object": {"key": "lambda_tutorial/run.csv", "sequencer": "01"},
+            }
+        }
+        app._idempotency_store.update(spec=None, store=None)
+        self.store = app.get_idempotency_store(tw_params=self.tw_params)
+        self.key = app.get_idempotency_key(record=self.record)
+
+    def tearDown(self):
+        self.store._connection.close()
+        app._idempotency_store.update(spec=None, store=None)
+        self.root.cleanup()
+
+    def read_claim(self):
+        return self.store._connection.execute(
+            "SELECT owner, expires_at FROM idempotency_claims"
+        ).fetchall()
+
+    def test_record_claimed_elsewhere_is_retried_without_tower_calls(self):
+        self.store.claim(self.key, "other", expires_at=later())
+
+        with mock.patch.object(app, "create_tower_dataset") as create:
+            result = app.process_record(record=self.record, tw_params=self.tw_params)
+
+        self.assertEqual(result["status"], "retry")
+        self.assertTrue(result["in_progress"])
+        create.assert_not_called()
+        # The other delivery's claim is left in place.
+        self.assertIsNone(self.store.claim(self.key, "third", expires_at=later()))
+
+    def test_completed_record_is_a_duplicate_even_while_claimed(self):
+        self.store.put_stage(self.key, "dataset_created", {"datasetId": "abc"})
+        self.store.put_stage(self.key, "dataset_url", {"datasetUrl": "url"})
+        self.store.put_stage(self.key, "pipeline_launched", {"workflowId": "wf"})
+        self.store.claim(self.key, "other", expires_at=later())
+
+        result = app.process_record(record=self.record, tw_params=self.tw_params)
+
+        self.assertEqual(result["status"], "completed")
+        self.assertTrue(result["duplicate"])
+
+    def test_claim_of_a_timed_out_invocation_is_taken_over(self):
+        # An invocation killed by its timeout claimed the record until shortly after its deadline.
+        context = mock.Mock(get_remaining_time_in_millis=mock.Mock(return_value=0))
+        with mock.patch.object(app, "IDEMPOTENCY_CLAIM_MARGIN", -1):
+            killed_expiry = app.get_claim_expiry(context=context)
+        self.store.claim(self.key, "killed", expires_at=killed_expiry)
+
+        # Lambda's retry is a new invocation with its own deadline.
+        context.get_remaining_time_in_millis.return_value = 60_000
+        claim_expires_at = app.get_claim_expiry(context=context)
+        claims = []
+        samplesheet = pathlib.Path(self.root.name) / "run.csv"
+        samplesheet.write_text("sample\nA\n")
+        with mock.patch.object(
+            app, "download_samplesheet", return_value=(samplesheet.as_posix(), "run")
+        ), mock.patch.object(
+            app,
+            "publish_samplesheet",
+            side_effect=lambda **kwargs: claims.extend(self.read_claim())
+            or {"datasetId": "abc", "datasetUrl": "url", "workflowId": "wf"},
+        ):
+            result = app.process_record(
+                record=self.record,
+                tw_params=self.tw_params,
+                claim_expires_at=claim_expires_at,
+            )
+
+        self.assertEqual(result["status"], "completed")
+        self.assertNotIn("in_progress", result)
+        # The retry held the claim until its own deadline (plus the margin), and released it when done.
+        self.assertEqual(len(claims), 1)
+        self.assertNotEqual(claims[0][0], "killed")
+        self.assertEqual(claims[0][1], claim_expires_at)
+        self.assertAlmostEqual(
+            claim_expires_at, time.time() + 60 + app.IDEMPOTENCY_CLAIM_MARGIN, delta=5
+        )
+        self.assertEqual(self.read_claim(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
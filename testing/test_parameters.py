@@ -0,0 +1,132 @@
+"""
+Tests for SSM parameter retrieval (`app.get_parameters`): GetParameters batching and the in-process cache TTL.
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python -m pytest testing
+"""
+
+import pathlib
+import sys
+import unittest
+from unittest import mock
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import boto3  # noqa: E402
+from botocore.stub import Stubber  # noqa: E402
+
+import app  # noqa: E402
+
+PARAMS = [f"/lambda_tutorial/param_{index:02d}" for index in range(12)]
+
+
+def parameters(names=None):
+    return [{"Name": name, "Type": "String", "Value": name[-2:]} for name in names]
+
+
+class GetParametersTest(unittest.TestCase):
+    def setUp(self):
+        client = boto3.client(
+            "ssm",
+            region_name="us-east-1",
+            aws_access_key_id="test",
+            aws_secret_access_key="test",
+        )
+        self.stubber = Stubber(client)
+        self.stubber.activate()
+        self.clock = mock.Mock(return_value=1000.0)
+        self.patches = [
+            mock.patch.object(app, "get_client", return_value=client),
+            mock.patch.object(app, "SSM_BATCH_RETRIEVAL", True),
+            mock.patch.object(app, "PARAMETER_CACHE_TTL", 300),
+            mock.patch.dict(app._parameter_cache, {"values": {}, "fetched_at": None}),
+            mock.patch.object(app.time, "monotonic", self.clock),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        self.stubber.deactivate()
+
+    def expect_batch(self, names=None, invalid=()):
+        response = {
+            "Parameters": parameters(
+                names=[name for name in names if name not in invalid]
+            )
+        }
+        if invalid:
+            response["InvalidParameters"] = list(invalid)
+        self.stubber.add_response(
+            "get_parameters",
+            response,
+            expected_params={"Names": names, "WithDecryption": False},
+        )
+
+    def test_names_are_retrieved_ten_per_call(self):
+        self.expect_batch(names=PARAMS[:10])
+        self.expect_batch(names=PARAMS[10:])
+
+        tw_params = app.get_parameters(params_to_retrieve=PARAMS)
+
+        self.assertEqual(tw_params, {name: name[-2:] for name in PARAMS})
+        self.stubber.assert_no_pending_responses()
+
+    def test_missing_optional_parameters_take_their_default(self):
+        optional = "/lambda_tutorial/optional"
+        self.expect_batch(names=PARAMS[:2] + [optional], invalid=[optional])
+
+        tw_params = app.get_parameters(
+            params_to_retrieve=PARAMS[:2], optional_params={optional: "none"}
+        )
+
+        self.assertEqual(tw_params[optional], "none")
+
+    def test_missing_required_parameters_are_retryable(self):
+        self.expect_batch(names=PARAMS[:2], invalid=[PARAMS[1]])
+
+        with self.assertRaises(Exception) as raised:
+            app.get_parameters(params_to_retrieve=PARAMS[:2])
+        self.assertNotIsInstance(raised.exception, app.CeaseEventProcessing)
+
+    def test_cached_values_are_reused_until_the_ttl_expires(self):
+        self.expect_batch(names=PARAMS[:2])
+        app.get_parameters(params_to_retrieve=PARAMS[:2])
+
+        # Within the TTL: no SSM call (the stubber has no response queued and would fail one).
+        self.clock.return_value += 299
+        self.assertEqual(
+            app.get_parameters(params_to_retrieve=PARAMS[:2]),
+            {PARAMS[0]: "00", PARAMS[1]: "01"},
+        )
+
+        # After it: retrieved again, picking up the changed value.
+        self.clock.return_value += 2
+        self.stubber.add_response(
+            "get_parameters",
+            {
+                "Parameters": [
+                    {"Name": PARAMS[0], "Type": "String", "Value": "changed"},
+                    {"Name": PARAMS[1], "Type": "String", "Value": "01"},
+                ]
+            },
+        )
+        self.assertEqual(
+            app.get_parameters(params_to_retrieve=PARAMS[:2])[PARAMS[0]], "changed"
+        )
+        self.stubber.assert_no_pending_responses()
+
+    def test_names_missing_from_the_cache_are_retrieved(self):
+        self.expect_batch(names=PARAMS[:2])
+        app.get_parameters(params_to_retrieve=PARAMS[:2])
+
+        self.expect_batch(names=PARAMS[:3])
+        app.get_parameters(params_to_retrieve=PARAMS[:3])
+
+        self.stubber.assert_no_pending_responses()
+
+
+if __name__ == "__main__":
+    unittest.main()
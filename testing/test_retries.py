@@ -0,0 +1,145 @@
+"""
+Tests for step-level retries (`app.retry_step`) and the Tower circuit breaker (`app.TowerCircuitBreaker`).
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python -m pytest testing
+"""
+
+import pathlib
+import sys
+import unittest
+from unittest import mock
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import app  # noqa: E402
+
+
+class RetryStepTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = mock.Mock(return_value=1000.0)
+        self.patches = [
+            mock.patch.object(app, "RETRY_MAX_ATTEMPTS", 6),
+            mock.patch.object(app, "RETRY_BASE_DELAY", 0.5),
+            mock.patch.object(app, "RETRY_MAX_DELAY", 3),
+            mock.patch.object(app, "RETRY_BUDGET", 20),
+            # Always draw the longest delay the jitter allows.
+            mock.patch.object(
+                app.random, "uniform", side_effect=lambda low, high: high
+            ),
+            mock.patch.object(app.time, "monotonic", self.clock),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.sleep = mock.patch.object(app.time, "sleep").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_backoff_doubles_up_to_the_cap(self):
+        for attempt in range(1, 6):
+            self.assertTrue(
+                app.retry_step(attempt=attempt, started=1000.0, step="call")
+            )
+
+        self.assertEqual(
+            [call.args[0] for call in self.sleep.call_args_list], [0.5, 1, 2, 3, 3]
+        )
+
+    def test_jitter_is_drawn_from_zero(self):
+        app.retry_step(attempt=3, started=1000.0, step="call")
+
+        app.random.uniform.assert_called_once_with(0, 2)
+
+    def test_no_retry_once_attempts_run_out(self):
+        self.assertFalse(app.retry_step(attempt=6, started=1000.0, step="call"))
+        self.sleep.assert_not_called()
+
+    def test_no_retry_past_the_budget(self):
+        # 18.5s spent: a 2s backoff would start the next attempt after the 20s budget.
+        self.clock.return_value = 1018.5
+        self.assertFalse(app.retry_step(attempt=3, started=1000.0, step="call"))
+
+        self.clock.return_value = 1017.5
+        self.assertTrue(app.retry_step(attempt=3, started=1000.0, step="call"))
+        self.sleep.assert_called_once_with(2)
+
+
+class TowerCircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = mock.Mock(return_value=1000.0)
+        self.patches = [
+            mock.patch.object(app, "BREAKER_WINDOW", 4),
+            mock.patch.object(app, "BREAKER_MIN_CALLS", 4),
+            mock.patch.object(app, "BREAKER_FAILURE_RATE", 0.5),
+            mock.patch.object(app, "BREAKER_COOLDOWN", 30),
+            mock.patch.object(app.time, "monotonic", self.clock),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.addCleanup(mock.patch.stopall)
+        self.breaker = app.TowerCircuitBreaker()
+
+    def open_breaker(self):
+        for success in [True, True, False, False]:
+            self.breaker.record(success=success)
+
+    def test_opens_at_the_failure_rate_once_enough_calls_are_made(self):
+        for success in [False, False, True]:
+            self.breaker.record(success=success)
+        # Two failures in three calls, but fewer than BREAKER_MIN_CALLS.
+        self.assertEqual(self.breaker.state, "closed")
+
+        self.breaker.record(success=True)
+        self.assertEqual(self.breaker.state, "open")
+        self.assertEqual(self.breaker.allow(), (False, False))
+
+    def test_single_trial_after_the_cooldown(self):
+        self.open_breaker()
+
+        self.clock.return_value += 29
+        self.assertEqual(self.breaker.allow(), (False, False))
+
+        self.clock.return_value += 1
+        self.assertEqual(self.breaker.state, "half_open")
+        self.assertEqual(self.breaker.allow(), (True, True))
+        # Only one trial at a time.
+        self.assertEqual(self.breaker.allow(), (False, False))
+
+    def test_successful_trial_closes_the_breaker(self):
+        self.open_breaker()
+        self.clock.return_value += 30
+        self.breaker.allow()
+
+        # A call started before the breaker opened doesn't decide anything.
+        self.breaker.record(success=True)
+        self.assertEqual(self.breaker.state, "half_open")
+
+        self.breaker.record(success=True, trial=True)
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertEqual(self.breaker.allow(), (True, False))
+        # The window starts afresh.
+        self.breaker.record(success=False)
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_failed_trial_reopens_the_breaker(self):
+        self.open_breaker()
+        self.clock.return_value += 30
+        self.breaker.allow()
+
+        self.breaker.record(success=False, trial=True)
+
+        self.assertEqual(self.breaker.state, "open")
+        self.clock.return_value += 30
+        self.assertEqual(self.breaker.allow(), (True, True))
+
+    def test_open_breaker_fails_fast_with_a_retryable_error(self):
+        self.open_breaker()
+
+        with mock.patch.object(app, "_tower_breaker", self.breaker):
+            with self.assertRaises(Exception) as raised:
+                app.check_tower_circuit(errorstring="Dataset creation failed.")
+        self.assertNotIsInstance(raised.exception, app.CeaseEventProcessing)
+
+
+if __name__ == "__main__":
+    unittest.main()
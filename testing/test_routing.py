@@ -0,0 +1,145 @@
+"""
+Tests for multi-tenant routing (`app.compile_routing_table`, `app.match_route` and `app.check_if_event_in_scope`):
+longest-prefix plus file-type matching, including a route with an empty (root) prefix.
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python -m pytest testing
+"""
+
+import json
+import pathlib
+import sys
+import unittest
+from unittest import mock
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import app  # noqa: E402
+
+ROUTES = [
+    {"prefix": "", "file_types": ["csv"], "workspace_id": "root"},
+    {"prefix": "lambda_tutorial/", "file_types": "csv,tsv", "workspace_id": "tutorial"},
+    {
+        "prefix": "lambda_tutorial/project_x/",
+        "file_types": [".csv.gz"],
+        "workspace_id": "project_x",
+        "target_pipeline_name": "nf-core-sarek",
+    },
+]
+
+
+def make_params(routes=None):
+    return {
+        "/lambda_tutorial/routing_table": json.dumps({"routes": routes}),
+        "/lambda_tutorial/s3_root_prefix": "lambda_tutorial",
+        "/lambda_tutorial/samplesheet_file_types": "csv",
+        "/lambda_tutorial/workspace_id": "default",
+        "/lambda_tutorial/target_pipeline_name": "nf-core-rnaseq",
+    }
+
+
+def make_record(key=None):
+    return {"s3": {"bucket": {"name": "bucket"}, "object": {"key": key}}}
+
+
+class MatchRouteTest(unittest.TestCase):
+    def match(self, key=None, routes=ROUTES):
+        table = app.compile_routing_table(tw_params=make_params(routes=routes))
+        prefix_matched, route = app.match_route(routing_table=table, key=key)
+        return prefix_matched, route and route["workspace_id"]
+
+    def test_longest_matching_prefix_wins(self):
+        self.assertEqual(
+            self.match(key="lambda_tutorial/project_x/run.csv.gz"), (True, "project_x")
+        )
+        self.assertEqual(self.match(key="lambda_tutorial/run.tsv"), (True, "tutorial"))
+        self.assertEqual(self.match(key="elsewhere/run.csv"), (True, "root"))
+
+    def test_shorter_prefix_is_used_when_the_longer_one_lacks_the_file_type(self):
+        self.assertEqual(
+            self.match(key="lambda_tutorial/project_x/run.csv"), (True, "tutorial")
+        )
+        self.assertEqual(
+            self.match(key="lambda_tutorial/project_x/run.txt"), (True, None)
+        )
+
+    def test_file_type_is_matched_on_the_longest_suffix(self):
+        # `run.1.csv` is a `csv`, not a `1.csv`; `run.csv.gz` is a `csv.gz`, not a `csv`.
+        self.assertEqual(
+            self.match(key="lambda_tutorial/run.1.csv"), (True, "tutorial")
+        )
+        self.assertEqual(self.match(key="elsewhere/run.csv.gz"), (True, None))
+        self.assertEqual(self.match(key="lambda_tutorial/README"), (True, None))
+
+    def test_root_prefix_matches_every_key(self):
+        self.assertEqual(self.match(key="run.csv"), (True, "root"))
+        self.assertEqual(self.match(key="run.csv", routes=ROUTES[1:]), (False, None))
+
+    def test_routes_default_to_the_standalone_parameters(self):
+        params = make_params(routes=ROUTES)
+        del params["/lambda_tutorial/routing_table"]
+        table = app.compile_routing_table(tw_params=params)
+
+        self.assertEqual(
+            app.match_route(routing_table=table, key="lambda_tutorial/run.csv")[1],
+            {
+                "prefix": "lambda_tutorial",
+                "file_types": ["csv"],
+                "workspace_id": "default",
+                "target_pipeline_name": "nf-core-rnaseq",
+            },
+        )
+
+
+class CheckIfEventInScopeTest(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.dict(app._routing_cache, {"source": None, "table": None})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_matched_route_is_applied_to_the_record_parameters(self):
+        params = make_params(routes=ROUTES)
+
+        record_params = app.check_if_event_in_scope(
+            record=make_record(key="lambda_tutorial/project_x/run.csv.gz"),
+            tw_params=params,
+        )
+
+        self.assertEqual(record_params["/lambda_tutorial/workspace_id"], "project_x")
+        self.assertEqual(
+            record_params["/lambda_tutorial/target_pipeline_name"], "nf-core-sarek"
+        )
+        self.assertEqual(params["/lambda_tutorial/workspace_id"], "default")
+
+    def test_unmatched_keys_are_ceased(self):
+        params = make_params(routes=ROUTES[1:])
+        for key in [
+            "elsewhere/run.csv",
+            "lambda_tutorial/run.txt",
+            "lambda_tutorial/README",
+        ]:
+            with self.subTest(key=key), self.assertRaises(app.CeaseEventProcessing):
+                app.check_if_event_in_scope(
+                    record=make_record(key=key), tw_params=params
+                )
+
+    def test_table_is_compiled_once_per_source(self):
+        params = make_params(routes=ROUTES)
+        with mock.patch.object(
+            app, "compile_routing_table", wraps=app.compile_routing_table
+        ) as compile_table:
+            for key in ["run.csv", "lambda_tutorial/run.csv"]:
+                app.check_if_event_in_scope(
+                    record=make_record(key=key), tw_params=params
+                )
+            app.check_if_event_in_scope(
+                record=make_record(key="run.csv"),
+                tw_params=make_params(routes=ROUTES[:1]),
+            )
+
+        self.assertEqual(compile_table.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+"""
+Tests for the Tower PAT cache (`app.get_secrets`): the DescribeSecret version check once SECRET_CACHE_TTL has
+passed, and invalidation after a rotation.
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python -m pytest testing
+"""
+
+import pathlib
+import sys
+import unittest
+from unittest import mock
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import boto3  # noqa: E402
+from botocore.stub import Stubber  # noqa: E402
+
+import app  # noqa: E402
+
+SECRET_NAME = "lambda_tutorial/tower_PAT"
+VERSION_1 = "a" * 32
+VERSION_2 = "b" * 32
+
+
+class GetSecretsTest(unittest.TestCase):
+    def setUp(self):
+        client = boto3.client(
+            "secretsmanager",
+            region_name="us-east-1",
+            aws_access_key_id="test",
+            aws_secret_access_key="test",
+        )
+        self.stubber = Stubber(client)
+        self.stubber.activate()
+        self.clock = mock.Mock(return_value=1000.0)
+        self.patches = [
+            mock.patch.object(app, "get_client", return_value=client),
+            mock.patch.object(app, "SECRET_CACHE_TTL", 300),
+            mock.patch.dict(
+                app._secret_cache,
+                {"values": None, "version_id": None, "checked_at": None},
+            ),
+            mock.patch.object(app.time, "monotonic", self.clock),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        self.stubber.deactivate()
+
+    def expect_value(self, value=None, version=None):
+        self.stubber.add_response(
+            "get_secret_value",
+            {"Name": SECRET_NAME, "SecretString": value, "VersionId": version},
+            expected_params={"SecretId": SECRET_NAME},
+        )
+
+    def expect_describe(self, current=None):
+        self.stubber.add_response(
+            "describe_secret",
+            {
+                "Name": SECRET_NAME,
+                "VersionIdsToStages": {
+                    current: ["AWSCURRENT"],
+                    "c" * 32: ["AWSPREVIOUS"],
+                },
+            },
+            expected_params={"SecretId": SECRET_NAME},
+        )
+
+    def test_value_is_cached_within_the_ttl(self):
+        self.expect_value(value="first", version=VERSION_1)
+
+        self.assertEqual(app.get_secrets(), {"tower_PAT": "first"})
+        self.clock.return_value += 299
+        self.assertEqual(app.get_secrets(), {"tower_PAT": "first"})
+
+        self.stubber.assert_no_pending_responses()
+
+    def test_unchanged_version_is_not_retrieved_again(self):
+        self.expect_value(value="first", version=VERSION_1)
+        app.get_secrets()
+
+        self.clock.return_value += 301
+        self.expect_describe(current=VERSION_1)
+        self.assertEqual(app.get_secrets(), {"tower_PAT": "first"})
+
+        # The check restarts the TTL.
+        self.clock.return_value += 299
+        self.assertEqual(app.get_secrets(), {"tower_PAT": "first"})
+        self.stubber.assert_no_pending_responses()
+
+    def test_rotated_secret_is_retrieved_again(self):
+        self.expect_value(value="first", version=VERSION_1)
+        app.get_secrets()
+
+        self.clock.return_value += 301
+        self.expect_describe(current=VERSION_2)
+        self.expect_value(value="second", version=VERSION_2)
+        self.assertEqual(app.get_secrets(), {"tower_PAT": "second"})
+        self.stubber.assert_no_pending_responses()
+
+    def test_failed_version_check_retrieves_the_value(self):
+        self.expect_value(value="first", version=VERSION_1)
+        app.get_secrets()
+
+        self.clock.return_value += 301
+        self.stubber.add_client_error(
+            "describe_secret", service_error_code="Throttling"
+        )
+        self.expect_value(value="first", version=VERSION_1)
+        self.assertEqual(app.get_secrets(), {"tower_PAT": "first"})
+        self.stubber.assert_no_pending_responses()
+
+    def test_invalidated_cache_retrieves_the_value_within_the_ttl(self):
+        # E.g. Tower rejected the cached token because the secret was rotated.
+        self.expect_value(value="first", version=VERSION_1)
+        app.get_secrets()
+
+        app.invalidate_secrets_cache()
+        self.expect_value(value="second", version=VERSION_2)
+        self.assertEqual(app.get_secrets(), {"tower_PAT": "second"})
+        self.stubber.assert_no_pending_responses()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Tests for `app.split_samplesheet`.
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python -m pytest testing
+"""
+
+import pathlib
+import sys
+import tempfile
+import unittest
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import app  # noqa: E402
+
+
+class SplitSamplesheetTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.workspace = app._workspace
+        app._workspace = app.Workspace(root=self.root.name, max_bytes=0)
+
+    def tearDown(self):
+        app._workspace = self.workspace
+        self.root.cleanup()
+
+    def split(self, data=None, shard_size=None, group_column=""):
+        local_samplesheet = pathlib.Path(self.root.name) / "sheet.csv"
+        local_samplesheet.write_bytes(data)
+        return app.split_samplesheet(
+            local_samplesheet=local_samplesheet.as_posix(),
+            dataset_name="sheet",
+            sharding_config={
+                "shard_size": shard_size,
+                "group_column": group_column,
+                "max_concurrency": 1,
+            },
+        )
+
+    def test_header_only_samplesheet_gives_one_header_only_shard(self):
+        shard_dir, shards = self.split(
+            data=b"sample,fastq_1,fastq_2,strandedness\n", shard_size=2
+        )
+
+        self.assertEqual(len(shards), 1)
+        self.assertEqual(shards[0]["rows"], 0)
+        self.assertEqual(
+            pathlib.Path(shards[0]["local_samplesheet"]).read_text(),
+            "sample,fastq_1,fastq_2,strandedness\n",
+        )
+
+        app._workspace.release(path=shard_dir)
+        self.assertFalse(shard_dir.exists())
+
+    def test_group_column_after_byte_order_mark(self):
+        data = "\ufeffsample,fastq_1\nA,a1.fq\nB,b1.fq\nA,a2.fq\nC,c1.fq\n"
+        shard_dir, shards = self.split(
+            data=data.encode("utf-8"), shard_size=2, group_column="sample"
+        )
+
+        contents = [
+            pathlib.Path(shard["local_samplesheet"]).read_text() for shard in shards
+        ]
+        self.assertEqual(
+            contents,
+            [
+                "sample,fastq_1\nA,a1.fq\nA,a2.fq\n",
+                "sample,fastq_1\nB,b1.fq\nC,c1.fq\n",
+            ],
+        )
+        app._workspace.release(path=shard_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
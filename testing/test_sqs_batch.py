@@ -0,0 +1,174 @@
+"""
+Tests for the SQS batch consumer (`app.process_sqs_batch`), replaying `testing/test_event_sqs_batch.json` with
+S3 and Tower replaced by mocks.
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python -m pytest testing
+"""
+
+import copy
+import json
+import pathlib
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import app  # noqa: E402
+
+TESTING_DIR = REPO_ROOT / "testing"
+TW_PARAMS = {
+    "/lambda_tutorial/workspace_id": "34830707738561",
+    "/lambda_tutorial/s3_root_prefix": "lambda_tutorial",
+    "/lambda_tutorial/samplesheet_file_types": "csv,tsv",
+    "/lambda_tutorial/target_pipeline_name": "nf-core-rnaseq",
+}
+
+
+def load_batch():
+    with open(TESTING_DIR / "test_event_sqs_batch.json") as f:
+        return json.load(f)
+
+
+def add_message(batch=None, message_id=None, key=None):
+    """
+    Append a message carrying one notification for `key`, modelled on the fixture's first message.
+    """
+    message = copy.deepcopy(batch["Records"][0])
+    body = json.loads(message["body"])
+    body["Records"][0]["s3"]["object"]["key"] = key
+    message.update(messageId=message_id, body=json.dumps(body))
+    batch["Records"].append(message)
+
+
+class ProcessSqsBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.downloads = []
+        self.patches = [
+            mock.patch.object(
+                app, "get_session_and_parameters", return_value=(None, TW_PARAMS)
+            ),
+            mock.patch.object(app, "prepare_tower_credentials"),
+            mock.patch.object(app, "download_samplesheet", side_effect=self.download),
+            mock.patch.object(app, "publish_samplesheet", side_effect=self.publish),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        self.root.cleanup()
+
+    def download(self, session=None, record=None):
+        s3 = record["s3"]["object"]
+        self.downloads.append((s3["key"], s3["sequencer"]))
+        path = pathlib.Path(self.root.name) / f"{len(self.downloads)}.csv"
+        path.write_text("sample,fastq_1\nA,s3://bucket/a.fq\n")
+        return path.as_posix(), pathlib.Path(s3["key"]).stem
+
+    def publish(self, dataset_name=None, **kwargs):
+        if dataset_name == "transient":
+            # E.g. Tower unreachable after the in-place retries.
+            app.log_error_and_raise_exception(
+                errorstring="Tower unavailable", e=None, retry_transaction=True
+            )
+        if dataset_name == "rejected":
+            # E.g. Tower rejecting the request itself.
+            app.log_error_and_raise_exception(
+                errorstring="Tower rejected the dataset",
+                e=None,
+                retry_transaction=False,
+            )
+        return {"datasetId": "ds1", "datasetUrl": "url", "workflowId": "wf1"}
+
+    def test_mixed_batch_reports_only_retryable_messages(self):
+        batch = load_batch()
+        add_message(
+            batch=batch, message_id="transient", key="lambda_tutorial/transient.csv"
+        )
+        add_message(
+            batch=batch, message_id="rejected", key="lambda_tutorial/rejected.csv"
+        )
+
+        result = app.process_sqs_batch(event=batch)
+
+        self.assertEqual(result["batchItemFailures"], [{"itemIdentifier": "transient"}])
+        statuses = {
+            (entry["messageId"], entry["key"]): entry["status"]
+            for entry in result["records"]
+        }
+        self.assertEqual(
+            statuses,
+            {
+                # Two versions of the same key: only the newer one is processed.
+                (
+                    "00000000-0000-0000-0000-000000000001",
+                    "lambda_tutorial/samplesheet_full.csv",
+                ): "superseded",
+                (
+                    "00000000-0000-0000-0000-000000000002",
+                    "lambda_tutorial/samplesheet_full.csv",
+                ): "completed",
+                # Out of scope.
+                (
+                    "00000000-0000-0000-0000-000000000003",
+                    "DontSendEventToTower/S3TriggerSamplesheet.csv",
+                ): "ceased",
+                ("transient", "lambda_tutorial/transient.csv"): "retry",
+                ("rejected", "lambda_tutorial/rejected.csv"): "ceased",
+            },
+        )
+        # The S3 test event carries no records.
+        self.assertNotIn(
+            "00000000-0000-0000-0000-000000000004",
+            {entry["messageId"] for entry in result["records"]},
+        )
+        self.assertEqual(
+            sorted(self.downloads),
+            [
+                ("lambda_tutorial/rejected.csv", "0A1B2C3D4E5F678900"),
+                ("lambda_tutorial/samplesheet_full.csv", "0A1B2C3D4E5F678901"),
+                ("lambda_tutorial/transient.csv", "0A1B2C3D4E5F678900"),
+            ],
+        )
+
+    def test_unparseable_and_sns_wrapped_messages(self):
+        batch = load_batch()
+        wrapped = copy.deepcopy(batch["Records"][1])
+        wrapped.update(
+            messageId="sns",
+            body=json.dumps({"Type": "Notification", "Message": wrapped["body"]}),
+        )
+        batch["Records"] = [wrapped, {"messageId": "garbled", "body": "{not json"}]
+
+        result = app.process_sqs_batch(event=batch)
+
+        self.assertEqual(result["batchItemFailures"], [])
+        self.assertEqual(
+            [(entry["messageId"], entry["status"]) for entry in result["records"]],
+            [("sns", "completed")],
+        )
+
+    def test_failed_set_up_retries_every_message_with_records(self):
+        batch = load_batch()
+        with mock.patch.object(
+            app, "get_session_and_parameters", side_effect=Exception("SSM throttled")
+        ):
+            result = app.process_sqs_batch(event=batch)
+
+        self.assertEqual(
+            result["batchItemFailures"],
+            [
+                {"itemIdentifier": "00000000-0000-0000-0000-000000000002"},
+                {"itemIdentifier": "00000000-0000-0000-0000-000000000003"},
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
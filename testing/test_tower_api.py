@@ -0,0 +1,247 @@
+"""
+Tests for the Tower API client (`app.invoke_tower_api`, `app.tower_api_*` and `app.create_tower_dataset`) against the local stub in
+`testing/stub_tower.py`, and for the classification of `tw` error output (`app.TW_ERROR_STATUS`).
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python -m pytest testing
+"""
+
+import os
+import pathlib
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import app  # noqa: E402
+from stub_tower import StubTowerHandler, start_stub_tower  # noqa: E402
+
+WORKSPACE_ID = "34830707738561"
+
+
+class TowerApiTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server, cls.endpoint = start_stub_tower()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubTowerHandler.reset()
+        self.tw_params = {
+            "/lambda_tutorial/tower_api_endpoint": self.endpoint,
+            "/lambda_tutorial/workspace_id": WORKSPACE_ID,
+        }
+        self.patches = [
+            mock.patch.dict(os.environ, {"TOWER_ACCESS_TOKEN": "token"}),
+            mock.patch.object(app, "_tower_breaker", app.TowerCircuitBreaker()),
+            mock.patch.object(app, "RETRY_BASE_DELAY", 0),
+            mock.patch.dict(app._tower_index, {"datasets": {}, "pipelines": {}}),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.root = tempfile.TemporaryDirectory()
+        self.samplesheet = pathlib.Path(self.root.name) / "run.tsv"
+        self.samplesheet.write_text("sample\tfastq_1\nA\ta.fq\n")
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        self.root.cleanup()
+
+    def upload(self, datasetid=None):
+        return app.tower_api_upload_dataset(
+            workspace_id=WORKSPACE_ID,
+            datasetid=datasetid,
+            local_samplesheet=self.samplesheet.as_posix(),
+            tw_params=self.tw_params,
+            errorstring="upload failed",
+        )
+
+    def test_create_upload_and_version_a_dataset(self):
+        datasetid = app.tower_api_create_dataset(
+            workspace_id=WORKSPACE_ID,
+            dataset_name="run",
+            description="test",
+            tw_params=self.tw_params,
+            errorstring="create failed",
+        )
+
+        first = self.upload(datasetid=datasetid)
+        second = self.upload(datasetid=datasetid)
+
+        self.assertEqual(StubTowerHandler.datasets[datasetid], ["run", 2])
+        self.assertEqual((first["version"], second["version"]), (1, 2))
+        self.assertTrue(
+            second["datasetUrl"].endswith(f"{datasetid}/v/2/n/samplesheet.csv")
+        )
+
+    def test_launch_passes_dataset_url_as_input(self):
+        result = app.tower_api_launch(
+            workspace_id=WORKSPACE_ID,
+            pipeline_name="nf-core-rnaseq",
+            input_params={"input": "https://tower.stub/datasets/ds1/v/1"},
+            tw_params=self.tw_params,
+            errorstring="launch failed",
+            retry_transaction=False,
+        )
+
+        self.assertTrue(result["workflowId"].startswith("wf"))
+        self.assertEqual(
+            result["paramsText"], '{"input": "https://tower.stub/datasets/ds1/v/1"}'
+        )
+        # The pipeline ID is indexed, so a second launch skips the search.
+        self.assertEqual(
+            app.get_cached_tower_id(
+                kind="pipelines", workspace_id=WORKSPACE_ID, name="nf-core-rnaseq"
+            ),
+            1,
+        )
+
+    def test_server_error_is_retried_in_place(self):
+        StubTowerHandler.scripted.append((503, {"message": "Service Unavailable"}))
+
+        result = app.invoke_tower_api(
+            method="GET",
+            path=f"/workspaces/{WORKSPACE_ID}/datasets",
+            tw_params=self.tw_params,
+            errorstring="list failed",
+            retry_transaction=True,
+        )
+
+        self.assertEqual(result, {"datasets": []})
+        self.assertEqual(len(StubTowerHandler.requests), 2)
+
+    def test_server_error_is_not_retried_unless_retryable(self):
+        # E.g. a launch without an idempotency store: Tower may have started the run before failing.
+        StubTowerHandler.scripted.append((503, {"message": "Service Unavailable"}))
+
+        with self.assertRaises(app.CeaseEventProcessing):
+            app.invoke_tower_api(
+                method="POST",
+                path="/workflow/launch",
+                tw_params=self.tw_params,
+                payload={"launch": {}},
+                errorstring="launch failed",
+                retry_transaction=False,
+            )
+
+        self.assertEqual(len(StubTowerHandler.requests), 1)
+
+    def test_client_error_ceases_without_retry(self):
+        StubTowerHandler.scripted.append((400, {"message": "Bad request"}))
+
+        with self.assertRaises(app.CeaseEventProcessing):
+            app.invoke_tower_api(
+                method="GET",
+                path=f"/workspaces/{WORKSPACE_ID}/datasets",
+                tw_params=self.tw_params,
+                errorstring="list failed",
+                retry_transaction=True,
+            )
+
+        self.assertEqual(len(StubTowerHandler.requests), 1)
+
+    def test_authentication_error_drops_the_cached_token(self):
+        StubTowerHandler.scripted.append((401, {"message": "Unauthorized"}))
+
+        with mock.patch.object(app, "invalidate_secrets_cache") as invalidate:
+            with self.assertRaises(Exception) as raised:
+                app.invoke_tower_api(
+                    method="GET",
+                    path=f"/workspaces/{WORKSPACE_ID}/datasets",
+                    tw_params=self.tw_params,
+                    errorstring="list failed",
+                    retry_transaction=False,
+                )
+
+        self.assertNotIsInstance(raised.exception, app.CeaseEventProcessing)
+        invalidate.assert_called_once()
+
+    def create_dataset(self, dataset_name=None):
+        return app.create_tower_dataset(
+            local_samplesheet=self.samplesheet.as_posix(),
+            dataset_name=dataset_name,
+            record={"s3": {"bucket": {"name": "bucket"}, "object": {"key": "run.tsv"}}},
+            tw_params={**self.tw_params, "/lambda_tutorial/tower_client": "api"},
+        )
+
+    def test_existing_dataset_gets_a_new_version(self):
+        # More datasets matching the search than fit on one page, with the wanted one last.
+        for index in range(2 * app.TOWER_LIST_PAGE_SIZE + 50):
+            StubTowerHandler.datasets[f"other{index}"] = [f"run_{index}", 1]
+        StubTowerHandler.datasets["existing"] = ["run", 1]
+
+        datasetid, dataset_url = self.create_dataset(dataset_name="run")
+
+        self.assertEqual(datasetid, "existing")
+        self.assertTrue(dataset_url.endswith("existing/v/2/n/samplesheet.csv"))
+        listings = [r for r in StubTowerHandler.requests if r[0] == "GET"]
+        self.assertEqual(len(listings), 3)
+
+        # The name is now indexed, so the next upload goes straight to a new version.
+        StubTowerHandler.requests.clear()
+        self.assertEqual(self.create_dataset(dataset_name="run")[0], "existing")
+        self.assertEqual([r[0] for r in StubTowerHandler.requests], ["POST"])
+        self.assertEqual(StubTowerHandler.datasets["existing"], ["run", 3])
+
+    def test_other_client_errors_cease_without_a_listing(self):
+        StubTowerHandler.scripted.append((400, {"message": "Invalid dataset name"}))
+
+        with self.assertRaises(app.CeaseEventProcessing) as raised:
+            self.create_dataset(dataset_name="run")
+
+        self.assertNotIsInstance(raised.exception, app.TowerNameConflict)
+        self.assertEqual([r[0] for r in StubTowerHandler.requests], ["POST"])
+
+
+class TwErrorClassificationTest(unittest.TestCase):
+    def test_reported_statuses(self):
+        cases = {
+            "ERROR: [503] Service Unavailable": {503},
+            "Unexpected response: HTTP/1.1 429": {429},
+            "Request failed with status code: 401": {401},
+            "status 502 from upstream": {502},
+            "Dataset 'run_404' not found": set(),
+            "Pipeline nf-core-rnaseq-3.14.0 not found in workspace 34830707738561": set(),
+        }
+        for output, statuses in cases.items():
+            with self.subTest(output=output):
+                self.assertEqual(app.get_tw_error_statuses(output), statuses)
+
+    def test_transient_errors(self):
+        self.assertTrue(
+            app.is_tower_transient_error("ERROR: [503] Service Unavailable")
+        )
+        self.assertTrue(
+            app.is_tower_transient_error(b"java.net.SocketTimeoutException")
+        )
+        self.assertTrue(
+            app.is_tower_transient_error("Connection refused (Connection refused)")
+        )
+        self.assertFalse(
+            app.is_tower_transient_error("Dataset 'batch_500' already exists")
+        )
+        self.assertFalse(app.is_tower_transient_error("ERROR: [400] Bad Request"))
+
+    def test_name_conflicts(self):
+        self.assertTrue(app.is_tower_name_conflict("ERROR: [409] Conflict"))
+        self.assertTrue(app.is_tower_name_conflict(b"Dataset 'run' already exists"))
+        self.assertFalse(app.is_tower_name_conflict("Dataset 'run_409' not found"))
+
+    def test_authentication_errors(self):
+        self.assertTrue(app.is_tower_authentication_error("ERROR: [401] Unauthorized"))
+        self.assertTrue(app.is_tower_authentication_error("status code 403"))
+        self.assertFalse(
+            app.is_tower_authentication_error("Dataset 'cohort_401' not found")
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+"""
+Tests for samplesheet validation (`app.compile_samplesheet_schema` and `app.validate_samplesheet`).
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python -m pytest testing
+"""
+
+import pathlib
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import app  # noqa: E402
+
+COLUMNS = "sample,fastq_1,fastq_2,strandedness"
+
+
+class ValidateSamplesheetTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        # Small blocks, so checks carry across them.
+        patch = mock.patch.object(app, "VALIDATION_BLOCK_ROWS", 2)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def validate(self, lines=None, schema=COLUMNS):
+        path = pathlib.Path(self.root.name) / "samplesheet.csv"
+        path.write_text("\n".join(lines) + "\n")
+        return app.validate_samplesheet(
+            local_samplesheet=path.as_posix(),
+            schema=app.compile_samplesheet_schema(schema=schema),
+        )
+
+    def test_valid_samplesheet(self):
+        result = self.validate(
+            lines=[
+                COLUMNS,
+                "A,s3://bucket/a_1.fq.gz,s3://bucket/a_2.fq.gz,auto",
+                "B,s3://bucket/b_1.fq.gz,,auto",
+                "",
+                "C,https://host.example/c_1.fq.gz,,reverse",
+            ]
+        )
+
+        self.assertEqual(result, {"rows": 3, "error_count": 0, "errors": []})
+
+    def test_uri_columns_are_inferred_from_any_row(self):
+        # `fastq_2` is empty in the first row (single-end), and its first URI only comes in a later block.
+        result = self.validate(
+            lines=[
+                COLUMNS,
+                "A,s3://bucket/a_1.fq.gz,,auto",
+                "B,s3://bucket/b_1.fq.gz,b_2.fq.gz,auto",
+                "C,s3://bucket/c_1.fq.gz,c_2.fq.gz,auto",
+                "D,s3://bucket/d_1.fq.gz,s3://bucket/d 2.fq.gz,auto",
+                "E,s3://bucket/e_1.fq.gz,s3://bucket/e_2.fq.gz,auto",
+            ]
+        )
+
+        self.assertEqual(
+            result["errors"],
+            [
+                "row 2: fastq_2 is not a URI: 'b_2.fq.gz'",
+                "row 3: fastq_2 is not a URI: 'c_2.fq.gz'",
+                "row 4: fastq_2 is not a URI: 's3://bucket/d 2.fq.gz'",
+            ],
+        )
+
+    def test_enums_in_the_column_list(self):
+        result = self.validate(
+            lines=[
+                COLUMNS,
+                "A,s3://b/a.fq,,revers",
+                "B,s3://b/b.fq,,",
+                "C,s3://b/c.fq,,auto",
+            ],
+            schema="sample,fastq_1,fastq_2,strandedness=auto|forward|reverse|unstranded",
+        )
+
+        self.assertEqual(
+            result["errors"],
+            [
+                "row 1: strandedness 'revers' is not one of ['auto', 'forward', 'reverse', 'unstranded']"
+            ],
+        )
+
+    def test_duplicates_across_blocks_report_the_first_row(self):
+        result = self.validate(
+            lines=[COLUMNS]
+            + [f"{sample},s3://b/{n}.fq,,auto" for n, sample in enumerate("ABCDBA")]
+        )
+
+        self.assertEqual(
+            result["errors"],
+            [
+                "row 5: duplicate sample 'B' (first seen in row 2)",
+                "row 6: duplicate sample 'A' (first seen in row 1)",
+            ],
+        )
+
+    def test_errors_are_listed_by_row_up_to_the_limit(self):
+        lines = [COLUMNS] + [f"S{n},s3://b/{n}.fq,,auto" for n in range(6)]
+        lines[2] = "S1,s3://b/1.fq,,auto,extra"
+        lines[3] = ",s3://b/2.fq,,auto"
+        lines[4] = "S3,3.fq,,auto"
+        lines[6] = "S3,s3://b/5.fq,,sideways"
+
+        with mock.patch.object(app, "VALIDATION_MAX_ERRORS", 3):
+            result = self.validate(
+                lines=lines, schema=COLUMNS + "=auto|forward|reverse|unstranded"
+            )
+
+        self.assertEqual(result["rows"], 5)
+        self.assertEqual(result["error_count"], 5)
+        self.assertEqual(
+            result["errors"],
+            [
+                "row 2: expected 4 fields, found 5",
+                "row 3: sample is empty",
+                "row 4: fastq_1 is not a URI: '3.fq'",
+            ],
+        )
+
+    def test_header_errors_skip_the_rows(self):
+        result = self.validate(lines=["sample,fastq_1,fastq_1,notes", "A,a,a,"])
+
+        self.assertEqual(
+            result["errors"],
+            [
+                "header is missing column(s) ['fastq_2', 'strandedness']",
+                "header repeats column(s) ['fastq_1']",
+                "header has unexpected column(s) ['notes']",
+            ],
+        )
+        self.assertEqual(result["rows"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+"""
+Tests for the long-running worker: the SQS visibility heartbeat (`app.SqsWorkerSource.hold`) and finishing the
+batches in progress on SIGTERM (`app.run_worker_command`).
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python -m pytest testing
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import pathlib
+import signal
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import app  # noqa: E402
+
+MESSAGES = [
+    {"messageId": "m1", "receiptHandle": "r1", "body": "{}"},
+    {"messageId": "m2", "receiptHandle": "r2", "body": "{}"},
+]
+
+
+class VisibilityHeartbeatTest(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.change_message_visibility_batch.return_value = {"Successful": []}
+        # Beats every 0.1s.
+        self.source = app.SqsWorkerSource(
+            queue_url="https://queue", visibility_timeout=0.3
+        )
+        patch = mock.patch.object(self.source, "_client", return_value=self.client)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_visibility_is_extended_while_the_batch_runs(self):
+        with self.source.hold(messages=MESSAGES):
+            time.sleep(0.35)
+        beats = self.client.change_message_visibility_batch.call_count
+
+        self.assertGreaterEqual(beats, 2)
+        self.client.change_message_visibility_batch.assert_called_with(
+            QueueUrl="https://queue",
+            Entries=[
+                {"Id": "0", "ReceiptHandle": "r1", "VisibilityTimeout": 0.3},
+                {"Id": "1", "ReceiptHandle": "r2", "VisibilityTimeout": 0.3},
+            ],
+        )
+        # The heartbeat stops with the batch.
+        time.sleep(0.2)
+        self.assertEqual(self.client.change_message_visibility_batch.call_count, beats)
+
+    def test_failed_beat_is_tried_again(self):
+        self.client.change_message_visibility_batch.side_effect = [
+            Exception("Throttling"),
+            {"Failed": [{"Id": "1", "Code": "ReceiptHandleIsInvalid"}]},
+            {"Successful": []},
+        ]
+
+        with self.source.hold(messages=MESSAGES):
+            time.sleep(0.35)
+
+        self.assertGreaterEqual(
+            self.client.change_message_visibility_batch.call_count, 3
+        )
+
+    def test_batch_is_held_around_processing(self):
+        calls = []
+        source = mock.Mock(name="source")
+
+        @contextlib.contextmanager
+        def hold(messages=None):
+            calls.append("hold")
+            yield
+            calls.append("release")
+
+        source.hold.side_effect = hold
+        worker_state = {
+            "in_flight": 0,
+            "batches": 0,
+            "messages": 0,
+            "batch_errors": 0,
+            "records": {},
+            "stages": {},
+        }
+        with mock.patch.dict(app._worker_state, worker_state), mock.patch.object(
+            app,
+            "process_sqs_batch",
+            side_effect=lambda event=None: calls.append("process")
+            or {"batchItemFailures": [], "records": []},
+        ):
+            app.run_worker_batch(source=source, messages=MESSAGES)
+
+        self.assertEqual(calls, ["hold", "process", "release"])
+        source.complete.assert_called_once_with(messages=MESSAGES, failed=set())
+
+
+class WorkerShutdownTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.spool = pathlib.Path(self.root.name)
+        self.handlers = {
+            signum: signal.getsignal(signum)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        self.patches = [
+            mock.patch.object(app, "prewarm"),
+            mock.patch.object(app, "_workspace"),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+        self.root.cleanup()
+
+    def test_sigterm_finishes_the_batch_in_progress(self):
+        (self.spool / "first.json").write_text(json.dumps({"Records": []}))
+        finished = []
+
+        def process_sqs_batch(event=None):
+            # The container is stopped while the batch runs.
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(0.3)
+            # Arrives after the stop: left for the next worker.
+            (self.spool / "second.json").write_text(json.dumps({"Records": []}))
+            finished.append(event)
+            return {"batchItemFailures": [], "records": []}
+
+        args = argparse.Namespace(
+            source=f"spool:{self.spool}",
+            concurrency=2,
+            batch_size=10,
+            poll_seconds=1,
+            port=None,
+            tower_rate=0,
+            tower_burst=1,
+        )
+        output = io.StringIO()
+        with mock.patch.object(
+            app, "process_sqs_batch", side_effect=process_sqs_batch
+        ), contextlib.redirect_stdout(output):
+            timer = threading.Timer(10, lambda: os.kill(os.getpid(), signal.SIGINT))
+            timer.start()
+            try:
+                app.run_worker_command(args=args)
+            finally:
+                timer.cancel()
+
+        self.assertEqual(len(finished), 1)
+        result = json.loads(output.getvalue())
+        self.assertEqual((result["status"], result["batches"]), ("stopped", 1))
+        # The batch was acknowledged (its file deleted) before the worker exited.
+        self.assertEqual(list((self.spool / "processing").iterdir()), [])
+        self.assertEqual(list((self.spool / "failed").iterdir()), [])
+        self.assertTrue((self.spool / "second.json").exists())
+        app._workspace.close.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
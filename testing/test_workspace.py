@@ -0,0 +1,125 @@
+"""
+Tests for the bounded local workspace (`app.Workspace`): scratch directories, the samplesheet cache and its
+least-recently-used eviction, which skips samplesheets pinned by a record in progress, and the removal of
+directories left by processes that are no longer running.
+
+Example (run from the repository root, with the packages in requirements.txt installed):
+    $ python -m pytest testing
+"""
+
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import app  # noqa: E402
+
+
+class WorkspaceTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.workspace = app.Workspace(root=self.root.name, max_bytes=300)
+
+    def tearDown(self):
+        self.workspace.close()
+        self.root.cleanup()
+
+    def add(self, key=None, size=100):
+        path = self.workspace.scratch_dir() / "samplesheet.csv"
+        path.write_bytes(b"x" * size)
+        return self.workspace.add(key=key, path=path.as_posix())
+
+    def cached_keys(self):
+        return list(self.workspace._entries)
+
+    def test_least_recently_used_samplesheets_are_evicted(self):
+        for key in ["a", "b", "c"]:
+            self.workspace.release(path=self.add(key=key))
+        # `a` is used again, so `b` is now the least recently used.
+        self.workspace.release(path=self.workspace.checkout(key="a"))
+
+        self.workspace.reserve(size=100)
+
+        self.assertEqual(self.cached_keys(), ["c", "a"])
+        self.assertIsNone(self.workspace.checkout(key="b"))
+        self.assertFalse((self.workspace._dir / "cache" / "b").exists())
+
+    def test_pinned_samplesheets_are_not_evicted(self):
+        pinned = self.add(key="a")
+        for key in ["b", "c"]:
+            self.workspace.release(path=self.add(key=key))
+
+        self.workspace.release(path=self.add(key="d"))
+
+        self.assertEqual(self.cached_keys(), ["a", "c", "d"])
+        self.assertTrue(pathlib.Path(pinned).exists())
+
+    def test_released_samplesheets_are_evicted_once_over_the_limit(self):
+        # Everything is pinned, so the cache goes over its limit...
+        paths = [self.add(key=key) for key in ["a", "b", "c", "d"]]
+        self.assertEqual(self.workspace._total, 400)
+
+        # ...until a samplesheet is released.
+        self.workspace.release(path=paths[1])
+
+        self.assertEqual(self.cached_keys(), ["a", "c", "d"])
+        self.assertEqual(self.workspace._total, 300)
+
+    def test_checkout_pins_until_every_user_releases(self):
+        path = self.add(key="a")
+        self.assertEqual(self.workspace.checkout(key="a"), path)
+        for key in ["b", "c"]:
+            self.workspace.release(path=self.add(key=key))
+
+        self.workspace.release(path=path)
+        self.workspace.reserve(size=100)
+        self.assertIn("a", self.cached_keys())
+
+        self.workspace.release(path=path)
+        self.workspace.reserve(size=300)
+        self.assertEqual(self.cached_keys(), [])
+
+    def test_samplesheets_too_large_to_cache_stay_in_scratch(self):
+        path = self.add(key="a", size=301)
+
+        self.assertEqual(
+            pathlib.Path(path).parent.parent, self.workspace._dir / "scratch"
+        )
+        self.assertEqual(self.cached_keys(), [])
+        self.workspace.release(path=path)
+        self.assertFalse(pathlib.Path(path).exists())
+
+    def test_same_key_cached_twice_keeps_the_first_copy(self):
+        first = self.add(key="a")
+        second = self.add(key="a")
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.workspace._total, 100)
+        self.assertEqual(list(self.workspace._dir.glob("scratch/*")), [])
+
+    def test_directories_of_exited_processes_are_removed(self):
+        exited = subprocess.Popen([sys.executable, "-c", "pass"])
+        exited.wait()
+        root = pathlib.Path(self.root.name)
+        orphan = root / f"{exited.pid}-abc"
+        (orphan / "cache").mkdir(parents=True)
+        running = root / f"{os.getppid()}-abc"
+        running.mkdir()
+        other = root / "notes"
+        other.mkdir()
+
+        self.workspace.scratch_dir()
+
+        self.assertFalse(orphan.exists())
+        self.assertEqual(
+            sorted(root.iterdir()), sorted([running, other, self.workspace._dir])
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()